@@ -12,11 +12,24 @@
 
 '''
 
-import subprocess, argparse, sys, glob, os, csv, json
-import SimpleITK as sitk
-import nibabel as nb
-import numpy as np
-import matplotlib.pyplot as plt
+import subprocess, argparse, sys, os, csv, json, time, tempfile, shutil, threading
+# SimpleITK, nibabel, numpy and matplotlib are imported by the functions using them, so that
+# the help and the submission of batch jobs do not wait for them to load
+from hmc_backends import BACKENDS, LocalPoolBackend, getBackend, defaultCpuCount
+from hmc_budget import CpuBudget, resolveSplit, calibrateSplit
+from hmc_pipeline import AnalysisPipeline
+from hmc_memory import MemoryModel, headerEstimate, defaultMemoryBudget, GIGABYTE
+from hmc_runtime import RuntimeModel, parameterSet, recordJobInfo, estimateMakespan, packByRuntime, formatDuration, scanSize
+from hmc_queue import WorkQueue, runWorker
+from hmc_manifest import Manifest
+from hmc_input_cache import InputCache, defaultInputCache, linkProduct
+from hmc_dataset import indexDataset, indexSubject, completeRuns, defaultIndexCache
+from hmc_preflight import preflight, PREFLIGHT_FILENAME
+from hmc_prefetch import Prefetcher
+from hmc_watch import DatasetWatcher
+from hmc_loaders import loadCsvTable, loadMotionTable, loadFramewiseDisplacement, rigidParameters
+from hmc_drift import subjectDrift, DRIFT_ESTIMATORS
+from hmc_stats import temporalStd, imageInformation
 
 NIFTI_UNITS_METER = 1 # Meter
 NIFTI_UNITS_MM = 2 # Millimeter
@@ -26,6 +39,20 @@ NIFTI_UNITS_MSEC = 16 # Milliseconds
 NIFTI_UNITS_USEC = 24 # Microseconds
 NIFTI_SPACE_MASK = 0x03
 NIFTI_TIME_MASK = 0x18
+MOVPARAMS_FIELDNAMES = ['Euler rotation about X', 'Euler rotation about Y', 'Euler rotation about Z', 
+                        'Translation in X', 'Translation in Y', 'Translation in Z']
+# Bump these versions when the analysis or the figures change, to redo them on the next run
+ANALYSIS_VERSION = 1
+FIGURES_VERSION = 1
+MOCO_STAGES = ('motion_correction', 'fd_stats') # Stages executed by antsMotCor.sh
+MOCO_FAILED_FILENAME = "motion_correction_failed.txt" # Written by antsMotCor.sh for the failed subjects of a packed job
+
+# Analysis figures are only saved to file, possibly from worker threads
+def pyplot():
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
 
 def parseArguments():
     parser = argparse.ArgumentParser(description='Head motion correction stage of RABIES pipeline preprocessing stage', formatter_class=argparse.RawTextHelpFormatter)
@@ -42,6 +69,65 @@ def parseArguments():
     parser.add_argument('-l', '--latest_ants', action='store_true', help='Specify to use latest install of ANTs motion correction')
     parser.add_argument('-c', '--containerized', action='store_true', help='Specify this option if we are running in a container. This argument must also be followed by the path to container to use.')
     parser.add_argument('-s', nargs='?', default=None, const=None, help='Option to specify the subfolder in which to store the output for each subject in a dataset')
+    parser.add_argument('-a', '--analysis_only', action='store_true', help='Only run the analysis of motion corrections already present in the output folder')
+    parser.add_argument('--backend', choices=sorted(BACKENDS), default=None, 
+                        help="Execution backend used to run the motion correction of the subjects:\n"
+                             " - serial : one subject at a time (default)\n"
+                             " - local  : several subjects in parallel on this machine, see -j\n"
+                             " - qbatch : submit the subjects to the cluster (same as -b)")
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='Number of subjects processed in parallel by the local backend')
+    parser.add_argument('--cpus', type=int, default=defaultCpuCount(), help='Number of cores shared between the concurrent motion corrections (default: all available cores)')
+    parser.add_argument('--threads', type=int, default=None, help='Number of ITK threads given to each motion correction. By default the CPU budget is split evenly\n'
+                                                                  'between the subjects processed in parallel.')
+    parser.add_argument('--pin', action='store_true', help='Pin each concurrent motion correction to its own disjoint set of cores')
+    parser.add_argument('--calibrate', action='store_true', help='Pick the number of subjects in parallel and threads per subject with a short calibration run\n'
+                                                                 'on the first frames of the first subject to process')
+    parser.add_argument('--pack', type=int, default=None, help='Number of subjects processed by each batch job. By default, subjects are packed in jobs running\n'
+                                                               'for about --target_job_minutes based on their predicted runtime.')
+    parser.add_argument('--target_job_minutes', type=float, default=60, help='Target duration of the batch jobs used to pack subjects (default: 60)')
+    parser.add_argument('--runtime_history', action='append', default=[], help='Output folder of previous runs from which the runtime of the motion correction is learned.\n'
+                                                                               'The output folder of the current run is always used. Can be given several times.')
+    parser.add_argument('--memory_budget', type=float, default=defaultMemoryBudget(),
+                        help='Memory in GB shared between the concurrent motion corrections. A subject is only started while the\n'
+                             'estimated peak memory of the running subjects stays under this budget. 0 disables the limit\n'
+                             '(default: 80%% of the physical memory)')
+    parser.add_argument('--analysis_workers', type=int, default=1, help='Number of worker processes running the analysis of the corrected subjects while the\n'
+                                                                         'motion correction of the next subjects is executing (default: 1)')
+    parser.add_argument('--analysis_queue', type=int, default=2, help='Maximum number of corrected subjects waiting for an analysis worker (default: 2)')
+    parser.add_argument('--calibration_frames', type=int, default=10, help='Number of frames used by the calibration run (default: 10)')
+    parser.add_argument('-f', '--force', action='store_true', help='Execute every stage again, even when the manifest of the subject shows it is up to date')
+    parser.add_argument('--input_cache', default=None, help='Folder caching the products of the input timeseries shared by the subfolders of a subject\n'
+                                                            '(default: .hmc_input_cache in the output folder of the dataset)')
+    parser.add_argument('--run', default=None, help='Name of the run to process when the subject folder holds several sessions or runs, as used for\n'
+                                                    'the output folders (sub-0XX_ses-Y[_run-Z])')
+    parser.add_argument('--no_preflight', action='store_true', help='Skip the validation of the headers of the inputs executed before scheduling the subjects')
+    parser.add_argument('--preflight_only', action='store_true', help='Only validate the headers of the inputs and write the preflight_report.csv file of the output folder')
+    parser.add_argument('--prefetch', type=int, default=0, help='Number of subjects whose inputs are copied to the scratch folder ahead of their motion correction\n'
+                                                                '(default: 0, the inputs are read in place)')
+    parser.add_argument('--scratch', default=tempfile.gettempdir(), help='Local folder, or tmpfs, into which the inputs are prefetched (default: %(default)s)')
+    parser.add_argument('--scratch_budget', type=float, default=20, help='Maximum size in GB of the prefetched inputs held in the scratch folder (default: 20)')
+    parser.add_argument('--prefetch_decompress', action='store_true', help='Decompress the .nii.gz inputs while prefetching them')
+    parser.add_argument('--chunks', type=int, default=1, help='Number of chunks of frames of each subject corrected in parallel, the threads of the subject\n'
+                                                              'being split between them. Not available in batch mode (default: 1)')
+    parser.add_argument('--crop', action='store_true', help='Correct the images cropped to the bounding box of the mask, the results being mapped back to\n'
+                                                            'the full images. Not available in batch mode.')
+    parser.add_argument('--crop_margin', type=int, default=4, help='Margin in voxels added around the bounding box of the mask when cropping (default: 4)')
+    parser.add_argument('--drift_estimator', choices=DRIFT_ESTIMATORS, default='ols',
+                        help="Estimator of the drift slopes of the motion parameters and framewise displacement:\n"
+                             " - ols             : least squares (default)\n"
+                             " - theil_sen       : median of the slopes between pairs of frames\n"
+                             " - repeated_median : median over the frames of the median slope to the other frames\n"
+                             " - huber           : Huber M-estimator, down-weighting the motion spikes")
+    parser.add_argument('--watch', action='store_true', help='Keep polling the dataset and process the subjects as their inputs land in it. A subject is processed\n'
+                                                             'once its files are complete and unchanged for --settle_seconds. Requires -d.')
+    parser.add_argument('--poll_seconds', type=float, default=300, help='Time between two polls of the dataset in watch mode (default: 300)')
+    parser.add_argument('--settle_seconds', type=float, default=120, help='Time during which the files of a subject must not change before it is processed in watch mode (default: 120)')
+    parser.add_argument('--combined_output', default=None, help='Folder of the combined scan parameters refreshed in watch mode as the analyses are written\n'
+                                                                '(default: the output folder)')
+    parser.add_argument('-w', '--worker', action='store_true', help='Run as a worker claiming subjects from the work queue in the output folder, one at a time.\n'
+                                                                   'Any number of workers can be started, on any node sharing the output folder.')
+    parser.add_argument('--lease_minutes', type=float, default=10, help='Time after which the subject of a worker that stopped responding is queued again (default: 10)')
+    parser.add_argument('--max_attempts', type=int, default=3, help='Number of times a worker tries to process a subject before marking it as failed (default: 3)')
     
     return parser.parse_args()
 
@@ -63,6 +149,8 @@ def copyInfo_3DImage(image_3d, ref_3d):
 
 #from rabies.visualisation
 def plot_3d(axes,sitk_img,fig,vmin=0,vmax=1,cmap='gray', alpha=1, cbar=False, threshold=None, planes=('sagittal', 'coronal', 'horizontal'), num_slices=4, slice_spacing=0.1):
+    import SimpleITK as sitk
+    import numpy as np
     physical_dimensions = (np.array(sitk_img.GetSpacing())*np.array(sitk_img.GetSize()))[::-1] # invert because the array is inverted indices
     array=sitk.GetArrayFromImage(sitk_img)
 
@@ -119,7 +207,26 @@ def plot_3d(axes,sitk_img,fig,vmin=0,vmax=1,cmap='gray', alpha=1, cbar=False, th
             cbar_list.append(fig.colorbar(pos, ax=ax))
     return cbar_list
 
-def hmcAnalysis(moving, scan_info, output, mask):
+# Products derived from the input timeseries alone: its temporal STD and the header fields
+# giving the scan parameters
+def computeInputProducts(moving, folder):
+    import SimpleITK as sitk
+    import nibabel as nb
+    std_i = temporalStd(moving)
+    std_image_i = copyInfo_3DImage(
+        sitk.GetImageFromArray(std_i, isVector=False), imageInformation(moving))
+    sitk.WriteImage(std_image_i, os.path.join(folder, 'inputSTD.nii.gz'))
+    header = nb.load(moving).header
+    with open(os.path.join(folder, 'scan_header.json'), 'w') as header_fp:
+        json.dump({"xyzt_units" : int(header['xyzt_units']),
+                   "pixdim"     : [float(value) for value in header['pixdim']]}, header_fp, indent=2)
+
+# Analysis stage: linear fits of the motion parameters and framewise displacement, temporal STD
+# images and the parameters of the scan. The products of the input are taken from the input cache
+# when one is given. moving_data is a local copy of the moving image to read instead, if any.
+def hmcAnalysisData(moving, scan_info, output, mask, input_cache=None, moving_digest=None, moving_data=None, drift_estimator : str = 'ols'):
+    import SimpleITK as sitk
+    import numpy as np
     print(f"Running analysis with the following inputs:\n" 
             f" - Moving image = {moving}\n"
             f" - Scan info = {scan_info}\n"
@@ -127,111 +234,56 @@ def hmcAnalysis(moving, scan_info, output, mask):
     
     motcorr_csv = os.path.join(output, "motcorrMOCOparams.csv")
     movparams_csv = os.path.join(output, "mov_params.csv")
-    temporal_features = os.path.join(output, "temporal_features.png")
     FD_csv = os.path.join(output, "FD_calculations.csv")
     fitting_params_csv = os.path.join(output, "lin_reg_params.csv")
     analysis_data_csv = os.path.join(output, "analysis_data.csv")
-    movparams_fieldnames = ['Euler rotation about X', 'Euler rotation about Y', 'Euler rotation about Z', 
-                           'Translation in X', 'Translation in Y', 'Translation in Z']
     scan_params_fieldnames = ['Subject ID', 'Pixel Volume (mm^3)', 'Repetition Time (s)', 'Echo Time (s)', 
                                 'Drift Rotation X', 'Drift Rotation Y', 'Drift Rotation Z',
                                 'Drift Translation X', 'Drift Translation Y', 'Drift Translation Z', 
                                 'Drift Framewise', 'Framewise Displacement STD', 'Mean of STD Difference', 
                                 'Algorithm Version' ]
     warped_output = os.path.join(output, "motcorr_warped.nii.gz")
-    motion_np = np.zeros((1,6)) 
-    fd_np = np.zeros([0])
-
-    with open(motcorr_csv, 'r') as motcorr_fp, open(movparams_csv, 'w') as movparams_fp, open(FD_csv, 'r') as FD_fp:
-        motcorr_r   = csv.reader(motcorr_fp, delimiter=',', quotechar='|')
+    motion_np = rigidParameters(loadMotionTable(motcorr_csv)).T
+    fd_np = loadFramewiseDisplacement(FD_csv)
+    with open(movparams_csv, 'w') as movparams_fp:
         movparam_w = csv.writer(movparams_fp, delimiter=',', quotechar='|')
-        fd_r = csv.reader(FD_fp, delimiter=',', quotechar='|')
-        movparam_w.writerow(movparams_fieldnames)
-        idx = 0
-        for row in motcorr_r:
-            if idx != 0:
-                movparam_w.writerow(row[2:len(row)])
-                motion_np = np.vstack([motion_np, np.array(row[2:len(row)])])
-            else:
-                idx = idx + 1
-        idx = 0
-        for row in fd_r:
-            if idx != 0:
-                fd_np = np.hstack([fd_np, np.array(row[0])])
-            else:
-                idx = idx + 1
-
-        motion_np = np.transpose(motion_np)
-    
-    fig,axes = plt.subplots(nrows=3, ncols=4, figsize=(30,10))
+        movparam_w.writerow(MOVPARAMS_FIELDNAMES)
+        movparam_w.writerows(motion_np.T.tolist())
 
-    # Linear fitting of the parameters
-    lin_reg_params = []
-    x_1 = range(0, len(motion_np[0, 1:]))
-    for mot_param in motion_np:
-        A = np.vstack([x_1, np.ones(len(x_1))]).T
-        m, c = np.linalg.lstsq(A, mot_param[1:].astype(np.float64), rcond=None)[0]
-        lin_reg_params.append([m, c])
-    
-    # Linear fitting framewise displacement
-    x_2 = range(0, len(fd_np[1:]))
-    A = np.vstack([x_2, np.ones(len(x_2))]).T
-    m, c = np.linalg.lstsq(A, fd_np[1:].astype(np.float64), rcond=None)[0]
-    lin_reg_params.append([m, c])
+    # Linear fitting of the parameters and of the framewise displacement
+    slopes, intercepts = subjectDrift(motion_np.T, fd_np, drift_estimator)
+    lin_reg_params = [[m, c] for m, c in zip(slopes, intercepts)]
 
     with open(fitting_params_csv, 'w') as fitting_params_fp:
         fitting_w = csv.writer(fitting_params_fp, delimiter=',', quotechar='|')
         col_names = ['Parameter', 'm', 'c']
-        res = np.vstack([np.asarray(movparams_fieldnames), 
+        res = np.vstack([np.asarray(MOVPARAMS_FIELDNAMES), 
                         np.asarray(lin_reg_params[0:6]).astype(np.float64).T[0], 
                         np.asarray(lin_reg_params[0:6]).astype(np.float64).T[1]]).T
         fitting_w.writerow(col_names)
         for row in res:
             fitting_w.writerow(row)
         fitting_w.writerow(['Framewise Displacement', lin_reg_params[6][0], lin_reg_params[6][1]])
-    
-    #Plot the Rotation and Translation parameters 
-    rotations = axes[0,0]
-    rotations.plot(motion_np[0, 1:].astype(np.float64), color='#0099ff', linestyle='solid')
-    rotations.plot(motion_np[1, 1:].astype(np.float64), color='#ff9900', linestyle='solid')
-    rotations.plot(motion_np[2, 1:].astype(np.float64), color='#00cc00', linestyle='solid')
-    rotations.plot(x_1, lin_reg_params[0][0]*x_1 + lin_reg_params[0][1], color='#0099ff', linestyle='dashed')
-    rotations.plot(x_1, lin_reg_params[1][0]*x_1 + lin_reg_params[1][1], color='#ff9900', linestyle='dashed')
-    rotations.plot(x_1, lin_reg_params[2][0]*x_1 + lin_reg_params[2][1], color='#00cc00', linestyle='dashed')
-    rotations.legend(movparams_fieldnames[0:3])
-    rotations.set_title('Rotation parameters of each frame with reference to the average frame', fontsize=10, color='black')
-    translations = axes[1,0]
-    translations.plot(motion_np[3, 1:].astype(np.float64), color='#0099ff', linestyle='solid')
-    translations.plot(motion_np[4, 1:].astype(np.float64), color='#ff9900', linestyle='solid')
-    translations.plot(motion_np[5, 1:].astype(np.float64), color='#00cc00', linestyle='solid')
-    translations.plot(x_1, lin_reg_params[3][0]*x_1 + lin_reg_params[3][1], color='#0099ff', linestyle='dashed')
-    translations.plot(x_1, lin_reg_params[4][0]*x_1 + lin_reg_params[4][1], color='#ff9900', linestyle='dashed')
-    translations.plot(x_1, lin_reg_params[5][0]*x_1 + lin_reg_params[5][1], color='#00cc00', linestyle='dashed')
-    translations.legend(movparams_fieldnames[3:6])
-    translations.set_title('Translation parameters of each frame with reference to the average frame', fontsize=10, color='black')
-
-    # Plot the FD
-    fd = axes[2,0]
-    fd.plot(fd_np[1:].astype(np.float64), color='#0099ff', linestyle='solid')
-    fd.plot(x_2, lin_reg_params[6][0]*x_2 + lin_reg_params[6][1], color='#0099ff', linestyle='dashed')
-    fd.set_yticks(np.arange(0, 0.03, 0.005))
-    fd.set_title('Framewise displacement of each frame with reference to the average frame', fontsize=10, color='black')
 
-    #Calculate and plot the SNR and STD
+    #Calculate the STD of the input and output timeseries
     mask_img = sitk.ReadImage(mask, 8)
     mask_arr = sitk.GetArrayFromImage(mask_img)
 
-    img_i = sitk.ReadImage(moving, 8)
-    array_i = sitk.GetArrayFromImage(img_i)
-    std_i = array_i.std(axis=0)
+    if input_cache is not None and moving_digest is not None:
+        products = InputCache(input_cache).products(moving_digest, moving, lambda folder: computeInputProducts(moving_data or moving, folder))
+    else:
+        products = tempfile.mkdtemp(prefix='hmc_input_')
+        computeInputProducts(moving_data or moving, products)
     std_i_filename = os.path.join(output, 'inputSTD.nii.gz')
-    std_image_i = copyInfo_3DImage(
-        sitk.GetImageFromArray(std_i, isVector=False), img_i)
-    sitk.WriteImage(std_image_i, std_i_filename)
-
-    img_o = sitk.ReadImage(warped_output, 8)
-    array_o = sitk.GetArrayFromImage(img_o)
-    std_o = array_o.std(axis=0)
+    linkProduct(os.path.join(products, 'inputSTD.nii.gz'), std_i_filename)
+    std_i = sitk.GetArrayFromImage(sitk.ReadImage(std_i_filename))
+    with open(os.path.join(products, 'scan_header.json'), 'r') as header_fp:
+        scan_header = json.load(header_fp)
+    if input_cache is None or moving_digest is None:
+        shutil.rmtree(products, ignore_errors=True)
+
+    img_o = imageInformation(warped_output)
+    std_o = temporalStd(warped_output)
     std_o_filename = os.path.join(output, 'outputSTD.nii.gz')
     std_image_o = copyInfo_3DImage(
         sitk.GetImageFromArray(std_o, isVector=False), img_o)
@@ -244,34 +296,15 @@ def hmcAnalysis(moving, scan_info, output, mask):
         sitk.GetImageFromArray(std_diff, isVector=False), img_o)
     sitk.WriteImage(std_image_diff, std_diff_filename)
 
-    axes[0,1].set_title('Temporal STD of Input BOLD', fontsize=20, color='black')
-    std_i=std_i.flatten()
-    std_i.sort()
-    std_i_vmax = std_i[int(len(std_i)*0.95)]
-    plot_3d(axes[:,1],std_image_i,fig=fig,vmin=0,vmax=std_i_vmax,cmap='inferno', cbar=True)
-    axes[0,2].set_title('Temporal STD of Corrected\nTimeseries', fontsize=20, color='black')
-    std_o=std_o.flatten()
-    std_o.sort()
-    std_o_vmax = std_o[int(len(std_o)*0.95)]
-    plot_3d(axes[:,2],std_image_o,fig=fig,vmin=0,vmax=std_o_vmax,cmap='inferno', cbar=True)
-    axes[0,3].set_title('Temporal STD Difference', fontsize=20, color='black')
-    std_diff=std_diff.flatten()
-    std_diff.sort()
-    std_diff_vmax = std_diff[int(len(std_diff)*0.95)]
-    plot_3d(axes[:,3],std_image_diff,fig=fig,vmin=0,vmax=std_diff_vmax,cmap='inferno', cbar=True)
-
-    fig.savefig(temporal_features)
-
     # Extract useful parameters of the initial moving timeseries
     with open(scan_info, 'r') as scan_info_fp, open(analysis_data_csv, 'w') as analysis_data_fp:
         scan_params_w = csv.writer(analysis_data_fp, delimiter=',', quotechar='|')
-        moving_obj = nb.load(moving)
-        xyzt_units = moving_obj.header['xyzt_units']
+        xyzt_units = np.uint8(scan_header["xyzt_units"])
         space_unit = 1
         time_unit = 1
         algo_version = 'new' if(os.path.exists(os.path.join(output, "new_ants.txt"))) else 'old'
-        fd_std = np.std(fd_np.astype(np.float64))
-        NA1, xdim, ydim, zdim, tdim, NA2, NA3, NA4 = moving_obj.header['pixdim']
+        fd_std = np.std(fd_np)
+        NA1, xdim, ydim, zdim, tdim, NA2, NA3, NA4 = np.asarray(scan_header["pixdim"], dtype=np.float32)
         if(xyzt_units & NIFTI_SPACE_MASK == NIFTI_UNITS_METER):
             space_unit = 1000
         elif (xyzt_units & NIFTI_SPACE_MASK == NIFTI_UNITS_MICRON):
@@ -293,7 +326,363 @@ def hmcAnalysis(moving, scan_info, output, mask):
         scan_params_w.writerow(scan_params_fieldnames)
         scan_params_w.writerow(row)
 
-def executeANTsMotionCorr(subjects, latest_ants : bool, containerized : bool, performance : bool, batch : bool):
+def readCsvRows(path : str):
+    with open(path, 'r') as csv_fp:
+        return [row for row in csv.reader(csv_fp, delimiter=',', quotechar='|')][1:]
+
+# Figures stage: plots of the motion parameters, framewise displacement and temporal STD images
+# drawn from the outputs of the analysis stage
+def hmcFigures(output):
+    import SimpleITK as sitk
+    import numpy as np
+    plt = pyplot()
+    temporal_features = os.path.join(output, "temporal_features.png")
+    motion_np = loadCsvTable(os.path.join(output, "mov_params.csv")).data.T
+    fd_np = loadFramewiseDisplacement(os.path.join(output, "FD_calculations.csv"))
+    lin_reg_params = [[float(row[1]), float(row[2])] for row in readCsvRows(os.path.join(output, "lin_reg_params.csv"))]
+    x_1 = np.arange(motion_np.shape[1])
+    x_2 = np.arange(len(fd_np[1:]))
+
+    fig,axes = plt.subplots(nrows=3, ncols=4, figsize=(30,10))
+
+    #Plot the Rotation and Translation parameters 
+    rotations = axes[0,0]
+    rotations.plot(motion_np[0], color='#0099ff', linestyle='solid')
+    rotations.plot(motion_np[1], color='#ff9900', linestyle='solid')
+    rotations.plot(motion_np[2], color='#00cc00', linestyle='solid')
+    rotations.plot(x_1, lin_reg_params[0][0]*x_1 + lin_reg_params[0][1], color='#0099ff', linestyle='dashed')
+    rotations.plot(x_1, lin_reg_params[1][0]*x_1 + lin_reg_params[1][1], color='#ff9900', linestyle='dashed')
+    rotations.plot(x_1, lin_reg_params[2][0]*x_1 + lin_reg_params[2][1], color='#00cc00', linestyle='dashed')
+    rotations.legend(MOVPARAMS_FIELDNAMES[0:3])
+    rotations.set_title('Rotation parameters of each frame with reference to the average frame', fontsize=10, color='black')
+    translations = axes[1,0]
+    translations.plot(motion_np[3], color='#0099ff', linestyle='solid')
+    translations.plot(motion_np[4], color='#ff9900', linestyle='solid')
+    translations.plot(motion_np[5], color='#00cc00', linestyle='solid')
+    translations.plot(x_1, lin_reg_params[3][0]*x_1 + lin_reg_params[3][1], color='#0099ff', linestyle='dashed')
+    translations.plot(x_1, lin_reg_params[4][0]*x_1 + lin_reg_params[4][1], color='#ff9900', linestyle='dashed')
+    translations.plot(x_1, lin_reg_params[5][0]*x_1 + lin_reg_params[5][1], color='#00cc00', linestyle='dashed')
+    translations.legend(MOVPARAMS_FIELDNAMES[3:6])
+    translations.set_title('Translation parameters of each frame with reference to the average frame', fontsize=10, color='black')
+
+    # Plot the FD
+    fd = axes[2,0]
+    fd.plot(fd_np[1:], color='#0099ff', linestyle='solid')
+    fd.plot(x_2, lin_reg_params[6][0]*x_2 + lin_reg_params[6][1], color='#0099ff', linestyle='dashed')
+    fd.set_yticks(np.arange(0, 0.03, 0.005))
+    fd.set_title('Framewise displacement of each frame with reference to the average frame', fontsize=10, color='black')
+
+    #Plot the STD images
+    std_image_i = sitk.ReadImage(os.path.join(output, 'inputSTD.nii.gz'))
+    std_image_o = sitk.ReadImage(os.path.join(output, 'outputSTD.nii.gz'))
+    std_image_diff = sitk.ReadImage(os.path.join(output, 'diffSTD.nii.gz'))
+
+    axes[0,1].set_title('Temporal STD of Input BOLD', fontsize=20, color='black')
+    std_i=sitk.GetArrayFromImage(std_image_i).flatten()
+    std_i.sort()
+    std_i_vmax = std_i[int(len(std_i)*0.95)]
+    plot_3d(axes[:,1],std_image_i,fig=fig,vmin=0,vmax=std_i_vmax,cmap='inferno', cbar=True)
+    axes[0,2].set_title('Temporal STD of Corrected\nTimeseries', fontsize=20, color='black')
+    std_o=sitk.GetArrayFromImage(std_image_o).flatten()
+    std_o.sort()
+    std_o_vmax = std_o[int(len(std_o)*0.95)]
+    plot_3d(axes[:,2],std_image_o,fig=fig,vmin=0,vmax=std_o_vmax,cmap='inferno', cbar=True)
+    axes[0,3].set_title('Temporal STD Difference', fontsize=20, color='black')
+    std_diff=sitk.GetArrayFromImage(std_image_diff).flatten()
+    std_diff.sort()
+    std_diff_vmax = std_diff[int(len(std_diff)*0.95)]
+    plot_3d(axes[:,3],std_image_diff,fig=fig,vmin=0,vmax=std_diff_vmax,cmap='inferno', cbar=True)
+
+    fig.savefig(temporal_features)
+    plt.close(fig)
+
+def analysisInputs(moving, scan_info, output, mask):
+    return {"moving"             : moving,
+            "scan_info"          : scan_info,
+            "mask"               : mask,
+            "motion_parameters"  : os.path.join(output, "motcorrMOCOparams.csv"),
+            "fd"                 : os.path.join(output, "FD_calculations.csv"),
+            "warped"             : os.path.join(output, "motcorr_warped.nii.gz")}
+
+def figuresInputs(output):
+    return {name : os.path.join(output, name) for name in ('mov_params.csv', 'FD_calculations.csv', 'lin_reg_params.csv',
+                                                            'inputSTD.nii.gz', 'outputSTD.nii.gz', 'diffSTD.nii.gz')}
+
+# Run the analysis and figures stages of a subject, each stage being skipped while its manifest entry is valid
+def hmcAnalysis(moving, scan_info, output, mask, force : bool = False, input_cache=None, moving_data=None, drift_estimator : str = 'ols'):
+    manifest = Manifest(output)
+    inputs = analysisInputs(moving, scan_info, output, mask)
+    params = {"analysis_version" : ANALYSIS_VERSION,
+              "algorithm_version" : 'new' if os.path.exists(os.path.join(output, "new_ants.txt")) else 'old'}
+    # The least-squares drift of the analyses done before the estimators were selectable stays valid
+    if drift_estimator != 'ols':
+        params["drift_estimator"] = drift_estimator
+    reason = "forced" if force else manifest.staleReason('analysis', inputs, params)
+    if reason is None:
+        print(f"Analysis of {output} is up to date")
+    else:
+        print(f"Running the analysis of {output} ({reason})")
+        manifest.plan('analysis', inputs, params)
+        hmcAnalysisData(moving, scan_info, output, mask, input_cache, manifest.digest(moving), moving_data, drift_estimator)
+        manifest.finalize('analysis')
+
+    inputs = figuresInputs(output)
+    params = {"figures_version" : FIGURES_VERSION}
+    reason = "forced" if force else manifest.staleReason('figures', inputs, params)
+    if reason is None:
+        print(f"Figures of {output} are up to date")
+    else:
+        print(f"Drawing the figures of {output} ({reason})")
+        manifest.plan('figures', inputs, params)
+        hmcFigures(output)
+        manifest.finalize('figures')
+
+def writeSubjectInfo(subject):
+    with open(os.path.join(subject["output"], "info.txt"), 'w') as info_fp:
+        info_fp.write(f'ANTS motion correction was executed with the following inputs:\n'
+                      f'- Moving = {subject["moving"]}\n'
+                      f'- Reference = {subject["reference"]}\n'
+                      f'- Mask = {subject["mask"]}\n'
+                      f'- Output folder = {subject["output"]}\n')
+
+# With several chunks, the frames of the subject are corrected in parallel by hmc_chunked.py. With cropping,
+# hmc_crop.py corrects the images cropped to the mask and maps the results back to the full images.
+def motionCorrCommand(subject, motcor_path : str, ants_opts : str, execution=None):
+    stages_opt = ' --stats_only' if subject.get("moco_stages") == ['fd_stats'] else ''
+    images_opts = f"-m {subject['moving']} -r {subject['reference']} -x {subject['mask']} -o {subject['output']}"
+    if execution is not None and stages_opt == '':
+        if execution["crop"]:
+            return f"python3 {motcor_path}hmc_crop.py {images_opts} --margin {execution['crop_margin']} --chunks {execution['chunks']} --motcor_path {motcor_path} {ants_opts}"
+        if execution["chunks"] > 1:
+            return f"python3 {motcor_path}hmc_chunked.py {images_opts} --chunks {execution['chunks']} --motcor_path {motcor_path} {ants_opts}"
+    return f"{motcor_path}antsMotCor.sh {images_opts} {ants_opts}{stages_opt}"
+
+# Command running the analysis of a single subject, used by the batch jobs
+def analysisCommand(subject, motcor_path : str, execution):
+    force_opt = ' --force' if execution["force"] else ''
+    estimator_opt = f" --drift_estimator {execution['drift_estimator']}" if execution["drift_estimator"] != 'ols' else ''
+    return f"python3 {motcor_path}HMC_isolated.py {subject['input']} {subject['output']} --analysis_only --run {subject['run']} --input_cache {execution['input_cache']}{force_opt}{estimator_opt}"
+
+def outputRoot(subjects):
+    return os.path.commonpath([os.path.abspath(subject["output"]) for subject in subjects])
+
+# Pack the subjects so that a batch job runs for about the target duration, the packs
+# holding the longest subjects first
+def packSubjects(subjects, execution):
+    if execution["pack"] is not None:
+        pack = max(1, execution["pack"])
+        return [subjects[start:start + pack] for start in range(0, len(subjects), pack)]
+    runtimes = [subject.get("runtime") for subject in subjects]
+    if None in runtimes:
+        print("No runtime prediction available, submitting one subject per job")
+        return [[subject] for subject in subjects]
+    return packByRuntime(subjects, runtimes, execution["target_job_minutes"] * 60)
+
+# Group the subjects in batch jobs sharing the environment setup of ANTs
+def batchJobs(execution_backend, motcorr_jobs, corrected, motcor_path : str, ants_opts : str, execution):
+    batch_root = outputRoot([job["subject"] for job in motcorr_jobs] + corrected)
+    batch_jobs = []
+    for packed in packSubjects([job["subject"] for job in motcorr_jobs], execution):
+        subjects_file = os.path.join(execution_backend.batchFolder(os.path.join(batch_root, ".hmc_batch")), f"subjects_{len(batch_jobs)}.txt")
+        with open(subjects_file, 'w') as subjects_fp:
+            for subject in packed:
+                stages = 'stats' if subject["moco_stages"] == ['fd_stats'] else 'all'
+                subjects_fp.write(f"{subject['moving']} {subject['reference']} {subject['mask']} {subject['output']} {stages}\n")
+        batch_jobs.append({"name"             : ', '.join(subject["output"] for subject in packed),
+                           "subjects"         : packed,
+                           # The motion correction job removes its list of subjects when it exits
+                           "command"          : execution_backend.cleanupPrefix([subjects_file]) + f"{motcor_path}antsMotCor.sh -f {subjects_file} {ants_opts}",
+                           "analysis_command" : '; '.join(analysisCommand(subject, motcor_path, execution) for subject in packed)})
+    pack = max(1, execution["pack"] or 1)
+    for start in range(0, len(corrected), pack):
+        packed = corrected[start:start + pack]
+        batch_jobs.append({"name"             : ', '.join(subject["output"] for subject in packed),
+                           "subjects"         : packed,
+                           "command"          : None,
+                           "analysis_command" : '; '.join(analysisCommand(subject, motcor_path, execution) for subject in packed)})
+    return batch_jobs
+
+# Estimate the peak memory of each job and the budget available to the motion correction. The memory
+# of the analysis workers is reserved from the budget since they hold the full input and output timeseries.
+def memoryBudget(motcorr_jobs, corrected, execution):
+    if execution["memory_budget"] is None or execution["memory_budget"] <= 0 or len(motcorr_jobs) == 0:
+        return None
+    model = MemoryModel.fromHistory(execution["runtime_history"] + [outputRoot([job["subject"] for job in motcorr_jobs] + corrected)])
+    for job in motcorr_jobs:
+        job["memory"] = model.predict(job["subject"]["header_estimate"])
+    reserved = execution["analysis_workers"] * max(job["subject"]["header_estimate"] for job in motcorr_jobs)
+    memory_budget = max(0, int(execution["memory_budget"] * GIGABYTE) - reserved)
+    print(f"Memory budget of {memory_budget / GIGABYTE:.1f} GB for the motion correction ({reserved / GIGABYTE:.1f} GB reserved for the analysis), "
+          f"estimates scaled by {model.scale:.2f} from {len(model.ratios)} previous measurements")
+    return memory_budget
+
+# Predict the runtime of each job from previous runs and order the jobs longest first
+def scheduleLongestFirst(motcorr_jobs, history):
+    model = RuntimeModel.fromHistory(history)
+    if not model.available():
+        print("No previous motion correction runtime found, the runtime of the subjects cannot be predicted")
+        return motcorr_jobs
+    print(f"Runtime model learned from {len(model.samples)} previous motion corrections")
+    for job in motcorr_jobs:
+        # Subjects only missing their framewise displacement are quick to process
+        job["subject"]["runtime"] = model.predict(job["subject"]["job_info"]) if "job_info" in job["subject"] else 0.0
+    return sorted(motcorr_jobs, key=lambda job: -job["subject"]["runtime"])
+
+def printRuntimeEstimate(motcorr_jobs, budget, remote : bool):
+    runtimes = [job["subject"].get("runtime") for job in motcorr_jobs]
+    if len(runtimes) == 0 or None in runtimes:
+        return
+    if remote:
+        print(f"Predicted motion correction time: {formatDuration(sum(runtimes))} in total, "
+              f"{formatDuration(max(runtimes))} for the longest subject")
+    else:
+        cpu_hours = sum(runtimes) * budget.threads / 3600
+        print(f"Predicted wall-clock time of the motion correction: {formatDuration(estimateMakespan(runtimes, budget.jobs))} "
+              f"({cpu_hours:.2f} CPU-hours)")
+
+# Time the motion correction of the first frames of a subject for every candidate split of the CPU budget
+def calibrateThreadSplit(subject, motcor_path : str, ants_opts : str, execution):
+    print(f"Calibrating the split of {execution['cpus']} cores with the first {execution['calibration_frames']} frames of {subject['moving']}")
+    import nibabel as nb
+    import numpy as np
+    workdir = tempfile.mkdtemp(prefix='hmc_calibration_')
+    try:
+        moving_obj = nb.load(subject["moving"])
+        frames = min(execution["calibration_frames"], moving_obj.shape[3])
+        calibration_moving = os.path.join(workdir, 'calibration_moving.nii.gz')
+        nb.save(nb.Nifti1Image(np.asanyarray(moving_obj.dataobj[..., :frames]), moving_obj.affine, moving_obj.header), calibration_moving)
+
+        def runTrial(jobs, threads):
+            trial_jobs = []
+            for i in range(jobs):
+                trial_output = os.path.join(workdir, f'{jobs}x{threads}', str(i))
+                os.makedirs(trial_output)
+                trial_subject = dict(subject, moving=calibration_moving, output=trial_output, moco_stages=list(MOCO_STAGES))
+                trial_jobs.append({"subject" : trial_subject, "command" : motionCorrCommand(trial_subject, motcor_path, ants_opts)})
+            start = time.time()
+            LocalPoolBackend(CpuBudget(execution["cpus"], jobs, threads, execution["pin"])).run(trial_jobs)
+            return time.time() - start
+
+        return calibrateSplit(runTrial, execution["cpus"])
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def cpuBudget(backend : str, pending, motcor_path : str, ants_opts : str, execution):
+    cpus = execution["cpus"]
+    calibration = None
+    if backend == 'serial':
+        jobs, threads = 1, execution["threads"] or cpus
+    elif execution["calibrate"] and backend == 'local' and len(pending) > 0 and execution["jobs"] is None and execution["threads"] is None:
+        jobs, threads, calibration = calibrateThreadSplit(pending[0], motcor_path, ants_opts, execution)
+    else:
+        jobs, threads = resolveSplit(cpus, execution["jobs"], execution["threads"], len(pending))
+    print(f"Splitting {cpus} cores into {jobs} subjects in parallel with {threads} threads each")
+    return CpuBudget(cpus, jobs, threads, execution["pin"], calibration)
+
+# ANTs version and antsMotionCorr arguments selected by the options, as reported by antsMotCor.sh
+def describeAnts(motcor_path : str, ants_opts : str):
+    result = subprocess.run(f"{motcor_path}antsMotCor.sh --describe {ants_opts}", shell=True, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT, universal_newlines=True)
+    description = {"ants_version" : 'unknown', "arguments" : 'unknown'}
+    for line in result.stdout.splitlines():
+        if line.startswith("ANTs version:"):
+            description["ants_version"] = line.split(':', 1)[1].strip()
+        elif line.startswith("Arguments:"):
+            description["arguments"] = line.split(':', 1)[1].strip()
+    if result.returncode != 0 or 'unknown' in description.values():
+        print(f"[ WARNING ] - Failed to get the ANTs version and arguments from antsMotCor.sh:\n{result.stdout}")
+    return description
+
+def motionCorrInputs(subject):
+    return {"moving" : subject["moving"], "reference" : subject["reference"], "mask" : subject["mask"]}
+
+def fdStatsInputs(subject):
+    return {"moving" : subject["moving"], "mask" : subject["mask"],
+            "motion_parameters" : os.path.join(subject["output"], "motcorrMOCOparams.csv")}
+
+# Reason why the outputs of a folder processed before the manifests existed cannot be kept, None when they were
+# produced with the same -l option and their tables and warped image hold every frame of the moving image
+def legacyMotionCorrProblem(subject, latest_ants : bool):
+    import nibabel as nb
+    output = subject["output"]
+    if os.path.exists(os.path.join(output, "new_ants.txt")) != latest_ants:
+        return f"produced {'without' if latest_ants else 'with'} the latest ANTs"
+    _, frames = scanSize(subject["moving"])
+    try:
+        parameters_frames = len(loadMotionTable(os.path.join(output, "motcorrMOCOparams.csv")))
+        warped_shape = nb.load(os.path.join(output, "motcorr_warped.nii.gz")).shape
+        nb.load(os.path.join(output, "motcorr_avg.nii.gz"))
+    except (OSError, EOFError, ValueError, nb.filebasedimages.ImageFileError) as error:
+        return f"unreadable outputs ({error})"
+    warped_frames = warped_shape[3] if len(warped_shape) > 3 else 1
+    if parameters_frames != frames or warped_frames != frames:
+        return f"{parameters_frames} motion parameters and {warped_frames} warped frames for {frames} frames"
+    return None
+
+def legacyFdProblem(subject):
+    _, frames = scanSize(subject["moving"])
+    try:
+        fd_frames = len(loadFramewiseDisplacement(os.path.join(subject["output"], "FD_calculations.csv")))
+    except (OSError, ValueError) as error:
+        return f"unreadable FD_calculations.csv ({error})"
+    return None if fd_frames == frames else f"{fd_frames} framewise displacements for {frames} frames"
+
+# Record the complete outputs of a folder processed before the manifests existed, instead of correcting it again
+def adoptLegacyMotionCorr(subject, ants_description, latest_ants : bool):
+    manifest = Manifest(subject["output"])
+    if 'motion_correction' in manifest.stages or not os.path.exists(os.path.join(subject["output"], "motcorrMOCOparams.csv")):
+        return
+    problem = legacyMotionCorrProblem(subject, latest_ants)
+    if problem is not None:
+        print(f"[ WARNING ] - {subject['output']} has no manifest and its motion correction outputs cannot be kept: {problem}")
+        return
+    if not manifest.adopt('motion_correction', motionCorrInputs(subject), ants_description):
+        return
+    adopted_fd = legacyFdProblem(subject) is None and manifest.adopt('fd_stats', fdStatsInputs(subject), {"ants_version" : ants_description["ants_version"]})
+    print(f"[ WARNING ] - {subject['output']} has no manifest, recording its existing motion correction{' and framewise displacement' if adopted_fd else ''} "
+          f"outputs as up to date. Use --force to correct it again with {ants_description['ants_version']}")
+
+# Stages of antsMotCor.sh to execute for the subject, given its manifest
+def staleMotionCorrStages(subject, ants_description, force : bool, latest_ants : bool):
+    if not force:
+        adoptLegacyMotionCorr(subject, ants_description, latest_ants)
+    manifest = Manifest(subject["output"])
+    reason = "forced" if force else manifest.staleReason('motion_correction', motionCorrInputs(subject), ants_description)
+    if reason is not None:
+        print(f"Motion correction of {subject['output']} required: {reason}")
+        return list(MOCO_STAGES)
+    reason = manifest.staleReason('fd_stats', fdStatsInputs(subject), {"ants_version" : ants_description["ants_version"]})
+    if reason is not None:
+        print(f"Framewise displacement of {subject['output']} required: {reason}")
+        return ['fd_stats']
+    return []
+
+def planMotionCorrStages(subject, ants_description):
+    failed_marker = os.path.join(subject["output"], MOCO_FAILED_FILENAME)
+    if os.path.exists(failed_marker):
+        os.remove(failed_marker)
+    manifest = Manifest(subject["output"])
+    if "motion_correction" in subject["moco_stages"]:
+        manifest.plan('motion_correction', motionCorrInputs(subject), ants_description)
+    manifest.plan('fd_stats', fdStatsInputs(subject), {"ants_version" : ants_description["ants_version"]})
+
+# Reason why the motion correction of the subject cannot be analysed, None when its outputs are complete
+def incompleteMotionCorr(subject):
+    failed_marker = os.path.join(subject["output"], MOCO_FAILED_FILENAME)
+    if os.path.exists(failed_marker):
+        with open(failed_marker, 'r') as marker_fp:
+            return marker_fp.read().strip() or "motion correction failed"
+    stages = Manifest(subject["output"]).stages
+    for stage in MOCO_STAGES:
+        if stage in stages and stages[stage].get("outputs") is None:
+            return f"{stage} did not complete"
+    for name in ('motcorrMOCOparams.csv', 'motcorr_warped.nii.gz', 'FD_calculations.csv'):
+        if not os.path.exists(os.path.join(subject["output"], name)):
+            return f"{name} is missing"
+    return None
+
+# The analyses run in the given pipeline when there is one, else in a pipeline created for these subjects
+def executeANTsMotionCorr(subjects, latest_ants : bool, containerized : bool, performance : bool, backend : str, execution, pipeline=None):
     
     motcor_path = './'
 
@@ -310,142 +699,195 @@ def executeANTsMotionCorr(subjects, latest_ants : bool, containerized : bool, pe
     if performance:
         performance_opt = '-p'
     
-    if batch:
-        with open("batch_cmds.sh", 'w') as batch_file:
-            for subject in subjects:
-                if not os.path.exists(os.path.join(subject["output"], "motcorrMOCOparams.csv")):
-                    if not os.path.exists(subject["output"]):
-                        os.makedirs(subject["output"])
-                else:
-                    print(f"Output files already present in folder {subject['output']}, skipping motion correction.")
-                    continue
-
-                command = (f'echo ANTS motion correction was executed with the following inputs: >> {subject["output"]}/info.txt &&' 
-                           f'echo - Moving = {subject["moving"]} >> {subject["output"]}/info.txt && ' 
-                           f'echo - Reference = {subject["reference"]} >> {subject["output"]}/info.txt && ' 
-                           f'echo - Mask = {subject["mask"]} >> {subject["output"]}/info.txt && ' 
-                           f'echo - Output folder = {subject["output"]} > {subject["output"]}/info.txt && ' 
-                           f'{motcor_path}antsMotCor.sh -m {subject["moving"]} -r {subject["reference"]} -x {subject["mask"]} ' 
-                           f'-o {subject["output"]} {latest_ants_opt} {containerized_opt} {performance_opt}\n')
-                batch_file.write(command)
-        
-        execution_cmd = "./launch_batch.sh"
-        process = subprocess.Popen( execution_cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=True )
-        while True:
-            out = process.stdout.read(1)
-            if process.poll() != None:
-                break
-            if out != '':
-                sys.stdout.write(out.decode("utf-8", 'replace'))
-                sys.stdout.flush()
-        
-        os.remove("batch_cmds.sh")
-
-        for subject in subjects:
-            hmcAnalysis(subject["moving"], subject["scan_info"], subject["output"], subject["mask"])
-    
-    else:
-        for subject in subjects:
-            skip_to_analysis = False
-            print(f'Executing ANTS motion correction with the following inputs:\n'
-                  f'   - Moving = {subject["moving"]}\n'
-                  f'   - Reference = {subject["reference"]}\n'
-                  f'   - Mask = {subject["mask"]}\n'
-                  f'   - Output folder = {subject["output"]}')
-            
-            if not os.path.exists(os.path.join(subject["output"], "motcorrMOCOparams.csv")):
-                if not os.path.exists(subject["output"]):
-                    os.makedirs(subject["output"])
+    ants_opts = f"{latest_ants_opt} {containerized_opt} {performance_opt}"
+    ants_description = describeAnts(motcor_path, ants_opts)
+    motcorr_jobs = []
+    corrected = []
+    for subject in subjects:
+        print(f'Executing ANTS motion correction with the following inputs:\n'
+              f'   - Moving = {subject["moving"]}\n'
+              f'   - Reference = {subject["reference"]}\n'
+              f'   - Mask = {subject["mask"]}\n'
+              f'   - Output folder = {subject["output"]}')
+
+        if not os.path.exists(subject["output"]):
+            os.makedirs(subject["output"])
+        subject["moco_stages"] = staleMotionCorrStages(subject, ants_description, execution["force"], latest_ants)
+        if len(subject["moco_stages"]) == 0:
+            print(f"Motion correction of {subject['output']} is up to date, skipping motion correction.")
+            corrected.append(subject)
+            continue
+
+        if "motion_correction" in subject["moco_stages"]:
+            if latest_ants:
+                open(os.path.join(subject["output"], "new_ants.txt"), 'w').close()
             else:
-                print(f"Output files already present in folder {subject['output']}, skipping motion correction.")
-                skip_to_analysis = True
-
-            if not skip_to_analysis:
-                if latest_ants:
-                    open(os.path.join(subject["output"], "new_ants.txt"), 'w').close()
-                else:
-                    if os.path.exists(os.path.join(subject["output"], "new_ants.txt")):
-                        os.remove(os.path.join(subject["output"], "new_ants.txt"))
-                
-                command = f"{motcor_path}antsMotCor.sh -m {subject['moving']} -r {subject['reference']} -x {subject['mask']} -o {subject['output']} {latest_ants_opt} {containerized_opt} {performance_opt}"
-                process = subprocess.Popen( command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=True )
-                while True:
-                    out = process.stdout.read(1)
-                    if process.poll() != None:
-                        break
-                    if out != '':
-                        sys.stdout.write(out.decode("utf-8", 'replace'))
-                        sys.stdout.flush()
-            
-            hmcAnalysis(subject["moving"], subject["scan_info"], subject["output"], subject["mask"])
-
-def hmcMain(input_folder : str, output_folder : str, dataset : bool, latest_ants : bool, containerized : bool, performance : bool, subfolder : str, batch : bool):
+                if os.path.exists(os.path.join(subject["output"], "new_ants.txt")):
+                    os.remove(os.path.join(subject["output"], "new_ants.txt"))
+            writeSubjectInfo(subject)
+            subject["job_info"] = recordJobInfo(subject, parameterSet(latest_ants, containerized, performance))
+        subject["header_estimate"] = headerEstimate(subject["moving"])
+        planMotionCorrStages(subject, ants_description)
+
+        motcorr_jobs.append({"subject" : subject, "command" : motionCorrCommand(subject, motcor_path, ants_opts, execution)})
+
+    if len(motcorr_jobs) != 0:
+        motcorr_jobs = scheduleLongestFirst(motcorr_jobs, execution["runtime_history"] + [outputRoot(subjects)])
+
+    budget = cpuBudget(backend, [job["subject"] for job in motcorr_jobs], motcor_path, ants_opts, execution)
+    memory_budget = memoryBudget(motcorr_jobs, corrected, execution)
+    execution_backend = getBackend(backend, budget, memory_budget)
+    printRuntimeEstimate(motcorr_jobs, budget, execution_backend.remote_analysis)
+
+    if execution_backend.remote_analysis:
+        if len(motcorr_jobs) + len(corrected) != 0:
+            execution_backend.run(batchJobs(execution_backend, motcorr_jobs, corrected, motcor_path, ants_opts, execution))
+        return []
+
+    # The analysis of the corrected subjects runs in worker processes while the
+    # motion correction of the following subjects is executing
+    prefetcher = None
+    if execution["prefetch"] > 0 and len(motcorr_jobs) != 0:
+        prefetcher = Prefetcher(execution["scratch"], execution["prefetch"], int(execution["scratch_budget"] * GIGABYTE), execution["decompress"])
+    on_done = prefetcher.release if prefetcher is not None else None
+    shared_pipeline = pipeline is not None
+    if shared_pipeline:
+        pipeline.on_done = on_done
+        previous_failures = len(pipeline.failed)
+    else:
+        pipeline = AnalysisPipeline(hmcAnalysis, execution["analysis_workers"], execution["analysis_queue"], on_done=on_done)
+
+    def analyse(subject):
+        moving_data = prefetcher.path(subject, "moving") if prefetcher is not None else None
+        pipeline.submit(subject["output"], subject["moving"], subject["scan_info"], subject["output"], subject["mask"], execution["force"], execution["input_cache"], moving_data, execution["drift_estimator"])
+
+    failed = []
+    def analyseFinished(job, returncode):
+        if returncode == 0:
+            Manifest(job["subject"]["output"]).finalizePlanned()
+            analyse(job["subject"])
+        else:
+            failed.append(job["subject"]["output"])
+            if prefetcher is not None:
+                prefetcher.release(job["subject"]["output"])
+
+    if prefetcher is not None:
+        # The command of each job points at its staged inputs, which are waited for when it starts
+        for job in motcorr_jobs:
+            job["prepare"] = lambda subject=job["subject"]: motionCorrCommand(prefetcher.stagedSubject(subject), motcor_path, ants_opts, execution)
+        prefetcher.start([job["subject"] for job in motcorr_jobs])
+    feeder = threading.Thread(target=lambda: [analyse(subject) for subject in corrected])
+    feeder.start()
+    try:
+        execution_backend.run(motcorr_jobs, on_finished=analyseFinished)
+        feeder.join()
+        # Output folders of the subjects whose motion correction or analysis failed
+        if shared_pipeline:
+            pipeline.drain()
+            return failed + pipeline.failed[previous_failures:]
+        return failed + pipeline.close()
+    finally:
+        if prefetcher is not None:
+            prefetcher.close()
+
+# Process the subjects of the work queue shared by all the workers started on the same output folder.
+# Each worker queues the subjects it finds that were never queued, and the longest scans are claimed first.
+def runQueueWorker(subjects, output_folder : str, latest_ants : bool, containerized : bool, performance : bool, execution):
+    queue = WorkQueue(output_folder, execution["lease_minutes"] * 60, execution["max_attempts"])
+    sizes = {}
+    for subject in subjects:
+        voxels, frames = scanSize(subject["moving"])
+        sizes[subject["output"]] = voxels * frames
+    added = queue.enqueue(subjects, os.path.abspath(output_folder), sizes)
+    print(f"Worker {queue.worker} queued {added} new subjects in {queue.folder}")
+    # The analysis workers are forked once, before the heartbeat thread of the first lease is started
+    pipeline = AnalysisPipeline(hmcAnalysis, execution["analysis_workers"], execution["analysis_queue"])
+    process = lambda subject: len(executeANTsMotionCorr([subject], latest_ants, containerized, performance, 'serial', execution, pipeline)) == 0
+    try:
+        runWorker(queue, process)
+    finally:
+        pipeline.close()
+
+def datasetSubject(run, output_folder : str, subfolder : str):
+    return {"input"     : run["folder"],
+            "output"    : os.path.join(output_folder, run["name"] + "/" + subfolder),
+            "run"       : run["name"],
+            "moving"    : run["moving"],
+            "mask"      : run["mask"],
+            "scan_info" : run["scan_info"],
+            "reference" : run["reference"]}
+
+# Process the subjects of the dataset as they land in the input folder, until interrupted
+def watchDataset(input_folder : str, output_folder : str, subfolder : str, latest_ants : bool, containerized : bool, performance : bool, backend : str, execution):
+    def process(subjects):
+        valid = subjects
+        if execution["preflight"]:
+            valid = preflight(subjects, os.path.join(output_folder, PREFLIGHT_FILENAME))
+        invalid = [subject["output"] for subject in subjects if subject not in valid]
+        if len(valid) == 0:
+            return invalid
+        return invalid + executeANTsMotionCorr(valid, latest_ants, containerized, performance, backend, execution)
+    watcher = DatasetWatcher(input_folder, output_folder, lambda run: datasetSubject(run, output_folder, subfolder), process,
+                             execution["settle_seconds"], execution["combined_output"] or output_folder)
+    watcher.run(execution["poll_seconds"])
+
+def hmcMain(input_folder : str, output_folder : str, dataset : bool, latest_ants : bool, containerized : bool, performance : bool, subfolder : str, backend : str, execution, analysis_only : bool = False, worker : bool = False, run_name = None):
     subjects_to_process = []
-    
+
+    if execution["watch"] and not dataset:
+        print("[ WARNING ] - Watch mode requires a dataset folder (-d), processing the subject once")
     if not dataset:
-        # Check that all required files are present
-        moving = glob.glob(os.path.join(input_folder, "ses-1/func/*.nii.gz"))
-        mask = glob.glob(os.path.join(input_folder, f"ses-1/func/_scan_info_subject_id*/*mask.nii.gz"))
-        scan_info = glob.glob(os.path.join(input_folder, "ses-1/func/*.json"))
-        if len(scan_info) == None:
-                print(f"Failed to find the scan info json file in subject folder ses-1/func")
-                return 
-        if len(moving) == 0:
-            print(f"Failed to find the moving images nifti file in subject folder ses-1/func")
-            return
-        if len(mask) == 0:
-            print(f"Failed to find the mask nifti file in subject folder /ses-1/func")
-            return
-        reference = glob.glob(os.path.join(input_folder,"ses-1/func/_scan_info_subject_id*/*ref.nii.gz"))
-        if len(reference) == 0:
-            print(f"Failed to find the reference nifti file in subject folder ses-1/func")
-            return
-        # If all is present, add subject to the list
-        subjects_to_process.append({"output"    : output_folder, 
-                                    "moving"    : moving[0],
-                                    "mask"      : mask[0], 
-                                    "scan_info" : scan_info[0], 
-                                    "reference" : reference[0]})
-        
+        runs = completeRuns(indexSubject(input_folder)[0])
+        if run_name is not None:
+            runs = [run for run in runs if run["name"] == run_name]
+            if len(runs) == 0:
+                print(f"Failed to find the run {run_name} in subject folder {input_folder}")
+                return
+        for run in runs:
+            # The outputs of the runs of a subject with several runs go to their own folder
+            subjects_to_process.append({"input"     : input_folder,
+                                        "output"    : output_folder if len(runs) == 1 else os.path.join(output_folder, run["name"]),
+                                        "run"       : run["name"],
+                                        "moving"    : run["moving"],
+                                        "mask"      : run["mask"],
+                                        "scan_info" : run["scan_info"],
+                                        "reference" : run["reference"]})
+    elif execution["watch"] and not analysis_only and not worker:
+        watchDataset(input_folder, output_folder, subfolder, latest_ants, containerized, performance, backend, execution)
+        return
     else:
-        all_subjects = glob.glob(os.path.join(input_folder, "sub-*/"))
-        commands  = []
-
-        if len(all_subjects) == 0:
+        runs = indexDataset(input_folder, defaultIndexCache(output_folder))
+        if len(runs) == 0:
             print("No subjects found in dataset. Finishing job.")
             return
+        for run in completeRuns(runs):
+            subjects_to_process.append(datasetSubject(run, output_folder, subfolder))
 
-        for subject in all_subjects:
-            # Get output folder and subject ID
-            sub_name = subject.split('/')[-1] if subject.split('/')[-1] != '' else subject.split('/')[-2]
-            sub_num  = sub_name.split('-')[-1]
-            sub_output_folder = os.path.join(output_folder, sub_name + "/" + subfolder)
-            
-            # Check that all required files are present
-            moving = glob.glob(os.path.join(subject, "ses-1/func/*.nii.gz"))
-            mask = glob.glob(os.path.join(subject, f"ses-1/func/_scan_info_subject_id{sub_num}*/*mask.nii.gz"))
-            scan_info = glob.glob(os.path.join(subject, "ses-1/func/*.json"))
-            reference = glob.glob(os.path.join(subject, f"ses-1/func/_scan_info_subject_id{sub_num}*/*ref.nii.gz"))
-            if len(reference) == 0:
-                print(f"Failed to find the reference nifti file in subject folder {subject}/ses-1/func")
-                return
-            if len(scan_info) == 0:
-                print(f"Failed to find the scan info json file in subject folder {subject}/ses-1/func")
-                return
-            if len(moving) == 0:
-                print(f"Failed to find the moving images nifti file in subject folder {subject}/ses-1/func")
-                return 
-            if len(mask) == 0:
-                    print(f"Failed to find the mask nifti file in subject folder {subject}/ses-1/func")
-                    return
-            # If all is present, add subject to the list
-            subjects_to_process.append({"output"    : sub_output_folder, 
-                                        "moving"    : moving[0],
-                                        "mask"      : mask[0], 
-                                        "scan_info" : scan_info[0], 
-                                        "reference" : reference[0]})
-            
-    executeANTsMotionCorr(subjects_to_process, latest_ants, containerized, performance, batch)
+    if execution["preflight"] and not analysis_only:
+        subjects_to_process = preflight(subjects_to_process, os.path.join(output_folder, PREFLIGHT_FILENAME))
+        if execution["preflight_only"]:
+            return
+
+    if len(subjects_to_process) == 0:
+        print("No complete subjects to process. Finishing job.")
+        return
+
+    if analysis_only:
+        for subject in subjects_to_process:
+            # Stages executed by the batch jobs are only recorded once their outputs are there
+            Manifest(subject["output"]).finalizePlanned()
+            reason = incompleteMotionCorr(subject)
+            if reason is not None:
+                print(f"[ WARNING ] - Skipping the analysis of {subject['output']}: {reason}")
+                continue
+            hmcAnalysis(subject["moving"], subject["scan_info"], subject["output"], subject["mask"], execution["force"], execution["input_cache"], None, execution["drift_estimator"])
+        return
+
+    if worker:
+        runQueueWorker(subjects_to_process, output_folder, latest_ants, containerized, performance, execution)
+        return
+
+    executeANTsMotionCorr(subjects_to_process, latest_ants, containerized, performance, backend, execution)
         
 if __name__ == "__main__":
     print("Running HMC in isolation...")
@@ -454,6 +896,39 @@ if __name__ == "__main__":
     subfolder = ''
     if(args.s != None):
         subfolder = args.s
+    backend = args.backend
+    if backend == None:
+        backend = 'qbatch' if args.batch else 'serial'
+    execution = {"jobs"               : args.jobs,
+                 "cpus"               : args.cpus,
+                 "threads"            : args.threads,
+                 "pin"                : args.pin,
+                 "calibrate"          : args.calibrate,
+                 "calibration_frames" : args.calibration_frames,
+                 "analysis_workers"   : args.analysis_workers,
+                 "analysis_queue"     : args.analysis_queue,
+                 "pack"               : args.pack,
+                 "target_job_minutes" : args.target_job_minutes,
+                 "runtime_history"    : args.runtime_history,
+                 "memory_budget"      : args.memory_budget,
+                 "lease_minutes"      : args.lease_minutes,
+                 "max_attempts"       : args.max_attempts,
+                 "force"              : args.force,
+                 "input_cache"        : args.input_cache or defaultInputCache(args.output_folder, args.dataset),
+                 "preflight"          : not args.no_preflight or args.preflight_only,
+                 "preflight_only"     : args.preflight_only,
+                 "prefetch"           : args.prefetch,
+                 "scratch"            : args.scratch,
+                 "scratch_budget"     : args.scratch_budget,
+                 "decompress"         : args.prefetch_decompress,
+                 "chunks"             : args.chunks,
+                 "crop"               : args.crop,
+                 "crop_margin"        : args.crop_margin,
+                 "drift_estimator"    : args.drift_estimator,
+                 "watch"              : args.watch,
+                 "poll_seconds"       : args.poll_seconds,
+                 "settle_seconds"     : args.settle_seconds,
+                 "combined_output"    : args.combined_output}
     hmcMain(args.input_folder, 
             args.output_folder, 
             args.dataset, 
@@ -461,4 +936,8 @@ if __name__ == "__main__":
             args.containerized, 
             args.performance, 
             subfolder,
-            args.batch)
+            backend,
+            execution,
+            args.analysis_only,
+            args.worker,
+            args.run)
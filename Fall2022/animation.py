@@ -2,17 +2,16 @@
     Python script used to run the animation to help detect motion 
 '''
 
-import subprocess, argparse, sys, glob, os, csv
-import nibabel as nb
-import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib import animation, rc
-from IPython.display import HTML
-import SimpleITK as sitk
+import subprocess, argparse, sys, os, csv
+# SimpleITK, numpy and matplotlib are imported by the functions using them, so that
+# the help is printed without waiting for them to load
+from hmc_dataset import indexDataset, indexSubject, completeRuns, defaultIndexCache
 #from rabies.visualization import plot_3d
 
 #from rabies.visualisation
 def plot_3d(axes,sitk_img,fig,vmin=0,vmax=1,cmap='gray', alpha=1, cbar=False, threshold=None, planes=('sagittal', 'coronal', 'horizontal'), num_slices=4, slice_spacing=0.1):
+    import SimpleITK as sitk
+    import numpy as np
     physical_dimensions = (np.array(sitk_img.GetSpacing())*np.array(sitk_img.GetSize()))[::-1] # invert because the array is inverted indices
     array=sitk.GetArrayFromImage(sitk_img)
 
@@ -92,11 +91,17 @@ def parseArguments():
 
 #Function convert the nifti into a numpy array
 def extractFile(path):
+    import SimpleITK as sitk
     sitk_image = sitk.ReadImage(path, sitk.sitkFloat32)
     return sitk_image
 
 #Function that defines the animation 
 def animationSubject(sitk_image, output_path):
+    import SimpleITK as sitk
+    import matplotlib
+    matplotlib.use('Agg') # The animation is only saved to file
+    import matplotlib.pyplot as plt
+    from matplotlib import animation
     fig,axes = plt.subplots(nrows=3, ncols=1,figsize=(20,10))
     axes[0].set_title('Coronal view', fontsize=30, color='black')
     axes[1].set_title('Saggital view', fontsize=30, color='black')
@@ -127,32 +132,26 @@ def animationSubject(sitk_image, output_path):
 def animationMain(input_folder, output_folder, dataset):
     #animate a single file
     if not dataset:
-        moving = glob.glob(os.path.join(input_folder, "ses-1/func/*.nii.gz"))
-        if len(moving) == 0:
-            print(f"Failed to find the moving images nifti file in subject folder ses-1/func")
+        runs = completeRuns(indexSubject(input_folder)[0], ('moving', ))
+        if len(runs) == 0:
             return
-        else: 
-            if not os.path.exists(output_folder):
-                os.makedirs(output_folder)
-            animationSubject(extractFile(moving[0]), output_folder)
+        for run in runs:
+            run_output_folder = output_folder if len(runs) == 1 else os.path.join(output_folder, run["name"])
+            if not os.path.exists(run_output_folder):
+                os.makedirs(run_output_folder)
+            animationSubject(extractFile(run["moving"]), run_output_folder)
     #animate an entire dataset
     else:
-        all_subjects = glob.glob(os.path.join(input_folder, "sub-*/"))
-        if len(all_subjects) == 0:
+        runs = indexDataset(input_folder, defaultIndexCache(output_folder))
+        if len(runs) == 0:
             print("No subjects found in dataset. Finishing job.")
             return
-        for subject in all_subjects:
-            sub_name = subject.split('/')[-1] if subject.split('/')[-1] != '' else subject.split('/')[-2]
-            sub_num  = sub_name.split('-')[-1]
-            sub_output_folder = os.path.join(output_folder, sub_name + "/animation")
-            print(f"\n+ PROCESSING ANIMATION {sub_num} --------------------------------------------------------------+")
-            moving = glob.glob(os.path.join(subject, "ses-1/func/*.nii.gz"))
-            if len(moving) == 0:
-                print(f"Failed to find the moving images nifti file in subject folder {subject}/ses-1/func")
-                return 
+        for run in completeRuns(runs, ('moving', )):
+            sub_output_folder = os.path.join(output_folder, run["name"] + "/animation")
+            print(f"\n+ PROCESSING ANIMATION {run['name']} --------------------------------------------------------------+")
             if not os.path.exists(sub_output_folder):
                     os.makedirs(sub_output_folder)
-            animationSubject(extractFile(moving[0]), sub_output_folder)
+            animationSubject(extractFile(run["moving"]), sub_output_folder)
 
 
 if __name__ == "__main__":
@@ -8,6 +8,9 @@ ARGUMENTS=""
 CONTAINERIZED=0
 MASK=""
 PERFORMANCE=0
+SUBJECTS_FILE=""
+STAGES="all"
+DESCRIBE=0
 
 while [[ $# -gt 0 ]]; do
   case $1 in
@@ -31,6 +34,11 @@ while [[ $# -gt 0 ]]; do
       shift # past argument
       shift # past value
       ;;
+    -f|--subjects_file)
+      SUBJECTS_FILE="$2"
+      shift # past argument
+      shift # past value
+      ;;
     -l|--latest_ants)
       LATEST_ANTS=1
       shift # past argument
@@ -43,6 +51,18 @@ while [[ $# -gt 0 ]]; do
       PERFORMANCE=1
       shift # past argument
       ;;
+    --stats_only)
+      STAGES="stats"
+      shift # past argument
+      ;;
+    --no_stats)
+      STAGES="correction"
+      shift # past argument
+      ;;
+    --describe)
+      DESCRIBE=1
+      shift # past argument
+      ;;
     -*|--*)
       echo "Unknown option $1"
       exit 1
@@ -54,53 +74,42 @@ while [[ $# -gt 0 ]]; do
   esac
 done
 
-if [ "$MOVING" == "" ]; then
-    echo Failed to provide a moving image
-    exit 1
-fi
-if [ "$REFERENCE" == "" ]; then
-    echo Failed to provide a reference image
-    exit 1
-fi
-if [ "$MASK" == "" ]; then
-    echo Failed to provide a mask image
-    exit 1
-fi
-if [ "$OUTPUT" == "" ]; then
-    echo Failed to provide an output folder
-    exit 1
-fi
+# Reload ANTs if we are not running in a container
+setupEnvironment() {
+  if [ $CONTAINERIZED == 0 ]; then 
+    module unload ANTs # Unload ANTs
+    if [ $LATEST_ANTS == 0 ]; then 
+        module load ANTs/2.3.1 # Reload ANTs with expected version 
+        if [ $? != 0 ]; then
+            echo "Failed to load ANTs version 2.3.1"
+            exit 1
+        fi
+        echo "Successfully loaded ANTs 2.3.1"
+    else
+        module load ANTs/2.4.0 # Reload ANTs with expected version 
+        if [ $? != 0 ]; then
+            echo "Failed to load ANTs version 2.4.0"
+            exit 1
+        fi
+        echo "Successfully loaded ANTs 2.4.0"
+    fi
+  fi
+}
 
-# Define arguments for ANTs version 2.3.1
-ARGUMENTS="-d 3 --n-images 10 -v 1 \
-                --metric MI[ $REFERENCE , $MOVING, 1, 20, regular, 0.2 ] \
-                --useFixedReferenceImage 1 \
-                --useScalesEstimator 1 \
-                --use-estimate-learning-rate-once 1 \
-                --transform Rigid[ 0.25 ] \
-                --iterations 50x20 \
-                --smoothingSigmas 1x0 \
-                --shrinkFactors 2x1 \
-                -o [ $OUTPUT/motcorr, $OUTPUT/motcorr_warped.nii.gz, $OUTPUT/motcorr_avg.nii.gz ]"
+setArguments() {
+  # Define arguments for ANTs version 2.3.1
+  ARGUMENTS="-d 3 --n-images 10 -v 1 \
+                  --metric MI[ $REFERENCE , $MOVING, 1, 20, regular, 0.2 ] \
+                  --useFixedReferenceImage 1 \
+                  --useScalesEstimator 1 \
+                  --use-estimate-learning-rate-once 1 \
+                  --transform Rigid[ 0.25 ] \
+                  --iterations 50x20 \
+                  --smoothingSigmas 1x0 \
+                  --shrinkFactors 2x1 \
+                  -o [ $OUTPUT/motcorr, $OUTPUT/motcorr_warped.nii.gz, $OUTPUT/motcorr_avg.nii.gz ]"
 
-# Reload ANTs if we are not running in a container
-if [ $CONTAINERIZED == 0 ]; then 
-  module unload ANTs # Unload ANTs
-  if [ $LATEST_ANTS == 0 ]; then 
-      module load ANTs/2.3.1 # Reload ANTs with expected version 
-      if [ $? != 0 ]; then
-          echo "Failed to load ANTs version 2.3.1"
-          exit 1
-      fi
-      echo "Successfully loaded ANTs 2.3.1"
-  else
-      module load ANTs/2.4.0 # Reload ANTs with expected version 
-      if [ $? != 0 ]; then
-          echo "Failed to load ANTs version 2.4.0"
-          exit 1
-      fi
-      echo "Successfully loaded ANTs 2.4.0"
-      # Set arguments
+  if [ $CONTAINERIZED == 0 ] && [ $LATEST_ANTS == 1 ]; then 
       if [ $PERFORMANCE == 0 ]; then
           ARGUMENTS="-d 3 --n-images 10 -v 1 \
                     --metric  MI[ $REFERENCE, $MOVING, 1, 32, Regular, 0.25, 1 ] \
@@ -123,16 +132,91 @@ if [ $CONTAINERIZED == 0 ]; then
                     --output [ $OUTPUT/motcorr, $OUTPUT/motcorr_warped.nii.gz, $OUTPUT/motcorr_avg.nii.gz ]"
       fi
   fi
+}
+
+# The stages executed are "all" (motion correction and FD statistics), "correction" or "stats"
+correctSubject() {
+  setArguments
+  if [ "$STAGES" != "stats" ]; then
+    START=`date +%s`
+    antsMotionCorr $ARGUMENTS
+    if [ $? != 0 ]; then
+      return 1
+    fi
+    END=`date +%s`
+    EXECUTION_TIME=`expr $END - $START`
+    echo $EXECUTION_TIME s > $OUTPUT/execution_time.txt
+  fi
+  if [ "$STAGES" != "correction" ]; then
+    # # Need to change motion corr stat call to calculate FD properly
+    antsMotionCorrStats -m $OUTPUT/motcorrMOCOparams.csv \
+                        -o $OUTPUT/FD_calculations.csv \
+                        -x $MASK \
+                        -d $MOVING \
+                        -s $OUTPUT/spacial_map.nii.gz \
+                        -f 1 
+  fi
+}
+
+# Print the ANTs version and the arguments given to antsMotionCorr for the selected
+# options, which are recorded in the manifest of each subject
+if [ $DESCRIBE == 1 ]; then
+  setupEnvironment > /dev/null
+  MOVING='<moving>'
+  REFERENCE='<reference>'
+  OUTPUT='<output>'
+  setArguments
+  echo "ANTs version: `antsMotionCorr --version 2>&1 | grep -v '^ *$' | head -n 1`"
+  echo "Arguments: `echo "$ARGUMENTS" | tr -s ' '`"
+  exit 0
+fi
+
+# Several subjects can be processed by one invocation with a subjects file holding one
+# "<moving> <reference> <mask> <output> [stages]" line per subject. The environment is then
+# only set up once for all the subjects. A subject that fails does not fail the others: the
+# failure is recorded in the FAILED_MARKER file of its output folder, which the analysis job
+# of the subjects checks, and the invocation still succeeds.
+FAILED_MARKER="motion_correction_failed.txt"
+if [ "$SUBJECTS_FILE" != "" ]; then
+    setupEnvironment
+    FAILED=0
+    DEFAULT_STAGES=$STAGES
+    while read -r MOVING REFERENCE MASK OUTPUT SUBJECT_STAGES; do
+        if [ "$OUTPUT" == "" ]; then
+            continue
+        fi
+        STAGES=${SUBJECT_STAGES:-$DEFAULT_STAGES}
+        rm -f "$OUTPUT/$FAILED_MARKER"
+        echo "Motion correction of $MOVING"
+        correctSubject < /dev/null
+        if [ $? != 0 ]; then
+            echo "Motion correction failed for $MOVING"
+            echo "Motion correction of $MOVING failed in job ${JOB_ID:-$$} on `hostname` at `date`" > "$OUTPUT/$FAILED_MARKER"
+            FAILED=$((FAILED + 1))
+        fi
+    done < "$SUBJECTS_FILE"
+    if [ $FAILED != 0 ]; then
+        echo "Motion correction failed for $FAILED subjects, see the $FAILED_MARKER file of their output folders"
+    fi
+    exit 0
+fi
+
+if [ "$MOVING" == "" ]; then
+    echo Failed to provide a moving image
+    exit 1
 fi
-START=`date +%s`
-antsMotionCorr $ARGUMENTS
-END=`date +%s`
-EXECUTION_TIME=`expr $END - $START`
-echo $EXECUTION_TIME s > $OUTPUT/execution_time.txt
-# # Need to change motion corr stat call to calculate FD properly
-antsMotionCorrStats -m $OUTPUT/motcorrMOCOparams.csv \
-                    -o $OUTPUT/FD_calculations.csv \
-                    -x $MASK \
-                    -d $MOVING \
-                    -s $OUTPUT/spacial_map.nii.gz \
-                    -f 1 
+if [ "$REFERENCE" == "" ]; then
+    echo Failed to provide a reference image
+    exit 1
+fi
+if [ "$MASK" == "" ]; then
+    echo Failed to provide a mask image
+    exit 1
+fi
+if [ "$OUTPUT" == "" ]; then
+    echo Failed to provide an output folder
+    exit 1
+fi
+
+setupEnvironment
+correctSubject
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+'''
+    Benchmark of the startup time of the HMC entry points. Each measurement starts
+    a fresh interpreter, so it includes the interpreter startup and every import
+    made before the script prints its help. The import time of the heavy modules
+    used by the scripts is measured the same way for reference.
+
+        python3 bench_imports.py --runs 10 --output import_times.csv
+
+    With --output, a row per measurement is appended to the CSV file together with
+    the date and the git commit, so that the startup time can be tracked over time.
+'''
+
+import argparse, csv, os, statistics, subprocess, sys, time
+
+ENTRY_POINTS = ('HMC_isolated.py', 'animation.py', 'combined_analysis.py', 'hmc_client.py')
+HEAVY_MODULES = ('numpy', 'nibabel', 'SimpleITK', 'pandas', 'matplotlib.pyplot')
+FIELDNAMES = ['Date', 'Commit', 'Target', 'Median (s)', 'Min (s)', 'Runs']
+
+def parseArguments():
+    parser = argparse.ArgumentParser(description='Startup time benchmark of the HMC scripts', formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5, help='Number of runs of each measurement (default: 5)')
+    parser.add_argument('--output', default=None, help='CSV file to which the results are appended')
+    return parser.parse_args()
+
+def timeCommand(command, runs : int):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True,
+                       cwd=os.path.dirname(os.path.abspath(__file__)))
+        times.append(time.perf_counter() - start)
+    return statistics.median(times), min(times)
+
+def gitCommit():
+    result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                            universal_newlines=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    return result.stdout.strip() if result.returncode == 0 else ''
+
+def benchmark(runs : int):
+    results = [('python (empty)', ) + timeCommand([sys.executable, '-c', 'pass'], runs)]
+    for script in ENTRY_POINTS:
+        results.append((f'{script} -h', ) + timeCommand([sys.executable, script, '-h'], runs))
+    for module in HEAVY_MODULES:
+        try:
+            results.append((f'import {module}', ) + timeCommand([sys.executable, '-c', f'import {module}'], runs))
+        except subprocess.CalledProcessError:
+            print(f"[ WARNING ] - Failed to import {module}")
+    return results
+
+if __name__ == "__main__":
+    args = parseArguments()
+    results = benchmark(max(1, args.runs))
+    print(f"{'Target':32s} {'Median (s)':>10s} {'Min (s)':>10s}")
+    for target, median, minimum in results:
+        print(f"{target:32s} {median:10.3f} {minimum:10.3f}")
+    if args.output is not None:
+        new_file = not os.path.exists(args.output)
+        with open(args.output, 'a') as output_fp:
+            output_w = csv.writer(output_fp, delimiter=',', quotechar='|')
+            if new_file:
+                output_w.writerow(FIELDNAMES)
+            date = time.strftime('%Y-%m-%d %H:%M:%S')
+            commit = gitCommit()
+            for target, median, minimum in results:
+                output_w.writerow([date, commit, target, f"{median:.4f}", f"{minimum:.4f}", args.runs])
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+'''
+    Check of the chunked and cropped motion corrections against a single run of
+    antsMotCor.sh, on a small synthetic timeseries. The frames of the series are a
+    smooth volume, surrounded by an empty margin, moved by known rigid transforms.
+     - chunked : the motcorrMOCOparams.csv, frame indices included, and the warped
+                 timeseries must be identical to the ones of the single run, and the
+                 average equal up to the rounding of its float32 voxels
+     - cropped : the rotations, translations and relative RMS differences of the
+                 warped timeseries and average within the mask must be within tolerance
+
+        python3 check_motcorr.py --chunks 3 --crop --margin 2 [-l] [-c] [-p]
+'''
+
+import argparse, os, shutil, subprocess, sys, tempfile
+from hmc_loaders import loadMotionTable, rigidParameters
+
+SIZE = (40, 36, 24)
+SPACING = (0.4, 0.4, 0.6)
+SEED = 0
+
+def parseArguments():
+    parser = argparse.ArgumentParser(description='Check of the chunked and cropped motion corrections against a single run', formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--chunks', type=int, default=0, help='Check hmc_chunked.py with this number of chunks against a single run')
+    parser.add_argument('--crop', action='store_true', help='Check hmc_crop.py against an uncropped run')
+    parser.add_argument('--margin', type=int, default=2, help='Margin in voxels of the cropped run (default: 2)')
+    parser.add_argument('--frames', type=int, default=12, help='Number of frames of the synthetic timeseries (default: 12)')
+    parser.add_argument('--rotation_tolerance', type=float, default=2e-3, help='Largest difference of the rotations in radians (default: 2e-3)')
+    parser.add_argument('--translation_tolerance', type=float, default=0.05, help='Largest difference of the translations in mm (default: 0.05)')
+    parser.add_argument('--image_tolerance', type=float, default=0.02, help='Largest RMS difference of the images within the mask, relative to their RMS (default: 0.02)')
+    parser.add_argument('--average_tolerance', type=float, default=1e-5, help='Largest difference of the chunked average relative to the largest voxel (default: 1e-5)')
+    parser.add_argument('--motcor_path', default='./', help='Folder holding antsMotCor.sh (default: ./)')
+    parser.add_argument('--folder', default=None, help='Folder receiving the series and the corrections (default: a temporary folder, removed afterwards)')
+    parser.add_argument('-l', '--latest_ants', action='store_true', help='Passed to antsMotCor.sh')
+    parser.add_argument('-c', '--containerized', action='store_true', help='Passed to antsMotCor.sh')
+    parser.add_argument('-p', '--performance', action='store_true', help='Passed to antsMotCor.sh')
+    return parser.parse_args()
+
+# Reference volume made of a few gaussian blobs, the moving timeseries of its frames moved by small rigid
+# transforms, and the mask of the blobs
+def syntheticSeries(folder : str, frames : int):
+    import SimpleITK as sitk
+    import numpy as np
+    rng = np.random.RandomState(SEED)
+    z, y, x = np.meshgrid(*[np.arange(size) for size in SIZE[::-1]], indexing='ij')
+    volume = np.zeros(SIZE[::-1])
+    for _ in range(5):
+        center = [size * rng.uniform(0.35, 0.65) for size in SIZE[::-1]]
+        width = rng.uniform(2, 4)
+        volume += rng.uniform(0.5, 1) * np.exp(-((z - center[0]) ** 2 + (y - center[1]) ** 2 + (x - center[2]) ** 2) / (2 * width ** 2))
+    reference = sitk.GetImageFromArray((1000 * volume).astype(np.float32))
+    reference.SetSpacing(SPACING)
+    mask = sitk.BinaryThreshold(reference, 50.0, 1e9, 1, 0)
+    center = reference.TransformContinuousIndexToPhysicalPoint([(size - 1) / 2.0 for size in SIZE])
+    moved = []
+    for frame in range(frames):
+        transform = sitk.Euler3DTransform(center, *rng.normal(0, 0.01, 3).tolist(), rng.normal(0, 0.2, 3).tolist())
+        moved.append(sitk.Resample(reference, reference, transform, sitk.sitkLinear, 0.0))
+    paths = {name : os.path.join(folder, f"{name}.nii.gz") for name in ('moving', 'reference', 'mask')}
+    sitk.WriteImage(sitk.JoinSeries(moved, 0.0, 1.0), paths["moving"])
+    sitk.WriteImage(reference, paths["reference"])
+    sitk.WriteImage(mask, paths["mask"])
+    return paths
+
+def runCorrection(command : str, output : str):
+    os.makedirs(output, exist_ok=True)
+    print(f"Running {command}")
+    with open(os.path.join(output, 'check_log.txt'), 'w') as log_fp:
+        returncode = subprocess.call(command, shell=True, stdout=log_fp, stderr=subprocess.STDOUT)
+    if returncode != 0:
+        print(f"[ WARNING ] - {command} failed, see {os.path.join(output, 'check_log.txt')}")
+    return returncode == 0
+
+# RMS of the difference of two images within the mask, relative to the RMS of the expected image
+def relativeRms(expected : str, actual : str, mask : str):
+    import nibabel as nb
+    import numpy as np
+    expected_data = np.asanyarray(nb.load(expected).dataobj).astype(np.float64)
+    actual_data = np.asanyarray(nb.load(actual).dataobj).astype(np.float64)
+    if expected_data.shape != actual_data.shape:
+        return float('inf')
+    inside = np.asanyarray(nb.load(mask).dataobj).reshape(expected_data.shape[:3]) != 0
+    difference = (expected_data - actual_data)[inside]
+    return float(np.sqrt((difference ** 2).mean() / max((expected_data[inside] ** 2).mean(), 1e-12)))
+
+# Differences between the chunked outputs and the single run, which must be the same
+def compareChunked(expected : str, actual : str, args):
+    import nibabel as nb
+    import numpy as np
+    problems = []
+    with open(os.path.join(expected, 'motcorrMOCOparams.csv'), 'r') as expected_fp, open(os.path.join(actual, 'motcorrMOCOparams.csv'), 'r') as actual_fp:
+        expected_lines = expected_fp.read().split()
+        actual_lines = actual_fp.read().split()
+    if expected_lines != actual_lines:
+        different = [line for line, (expected_line, actual_line) in enumerate(zip(expected_lines, actual_lines)) if expected_line != actual_line]
+        problems.append(f"motcorrMOCOparams.csv has {len(actual_lines)} lines instead of {len(expected_lines)}, "
+                        f"{len(different)} of them different{f' from line {different[0] + 1}' if len(different) != 0 else ''}")
+    expected_obj = nb.load(os.path.join(expected, 'motcorr_warped.nii.gz'))
+    actual_obj = nb.load(os.path.join(actual, 'motcorr_warped.nii.gz'))
+    if not np.allclose(expected_obj.affine, actual_obj.affine, rtol=0, atol=1e-6) or not np.array_equal(np.asanyarray(expected_obj.dataobj), np.asanyarray(actual_obj.dataobj)):
+        problems.append("motcorr_warped.nii.gz differs from the single run")
+    expected_average = nb.load(os.path.join(expected, 'motcorr_avg.nii.gz')).get_fdata()
+    actual_average = nb.load(os.path.join(actual, 'motcorr_avg.nii.gz')).get_fdata()
+    difference = np.abs(expected_average - actual_average).max() / max(np.abs(expected_average).max(), 1e-12) if expected_average.shape == actual_average.shape else float('inf')
+    print(f"    - Largest difference of motcorr_avg.nii.gz relative to its largest voxel: {difference:.3g}")
+    if difference > args.average_tolerance:
+        problems.append(f"motcorr_avg.nii.gz differs by up to {difference:.3g} of its largest voxel")
+    return problems
+
+def compareOutputs(expected : str, actual : str, mask : str, args):
+    import numpy as np
+    problems = []
+    expected_parameters = rigidParameters(loadMotionTable(os.path.join(expected, 'motcorrMOCOparams.csv')))
+    actual_parameters = rigidParameters(loadMotionTable(os.path.join(actual, 'motcorrMOCOparams.csv')))
+    if expected_parameters.shape != actual_parameters.shape:
+        return [f"{len(actual_parameters)} frames of motion parameters instead of {len(expected_parameters)}"]
+    difference = np.abs(expected_parameters - actual_parameters)
+    print(f"    - Largest difference of the rotations {difference[:, :3].max():.3g} rad, of the translations {difference[:, 3:].max():.3g} mm")
+    if difference[:, :3].max() > args.rotation_tolerance:
+        problems.append(f"rotations differ by up to {difference[:, :3].max():.3g} rad")
+    if difference[:, 3:].max() > args.translation_tolerance:
+        problems.append(f"translations differ by up to {difference[:, 3:].max():.3g} mm")
+    for name in ('motcorr_warped.nii.gz', 'motcorr_avg.nii.gz'):
+        rms = relativeRms(os.path.join(expected, name), os.path.join(actual, name), mask)
+        print(f"    - Relative RMS difference of {name} within the mask: {rms:.3g}")
+        if rms > args.image_tolerance:
+            problems.append(f"{name} differs by a relative RMS of {rms:.3g}")
+    return problems
+
+def checkMotionCorr(folder : str, args):
+    ants_opts = ' '.join(option for option, selected in (('-l', args.latest_ants), ('-c', args.containerized), ('-p', args.performance)) if selected)
+    paths = syntheticSeries(folder, args.frames)
+    images_opts = f"-m {paths['moving']} -r {paths['reference']} -x {paths['mask']}"
+    single = os.path.join(folder, 'single')
+    if not runCorrection(f"{args.motcor_path}antsMotCor.sh {images_opts} -o {single} --no_stats {ants_opts}", single):
+        return 1
+    problems = []
+    if args.chunks > 1:
+        chunked = os.path.join(folder, 'chunked')
+        if runCorrection(f"python3 {args.motcor_path}hmc_chunked.py {images_opts} -o {chunked} --chunks {args.chunks} --motcor_path {args.motcor_path} {ants_opts}", chunked):
+            problems += [f"chunked run: {problem}" for problem in compareChunked(single, chunked, args)]
+        else:
+            problems.append("chunked run failed")
+    if args.crop:
+        cropped = os.path.join(folder, 'cropped')
+        if runCorrection(f"python3 {args.motcor_path}hmc_crop.py {images_opts} -o {cropped} --margin {args.margin} --motcor_path {args.motcor_path} {ants_opts}", cropped):
+            problems += [f"cropped run: {problem}" for problem in compareOutputs(single, cropped, paths["mask"], args)]
+        else:
+            problems.append("cropped run failed")
+    for problem in problems:
+        print(f"[ WARNING ] - {problem}")
+    print(f"Motion correction check: {'FAILED' if len(problems) != 0 else 'OK'}")
+    return 1 if len(problems) != 0 else 0
+
+if __name__ == "__main__":
+    args = parseArguments()
+    if args.chunks <= 1 and not args.crop:
+        print("Nothing to check, select --chunks K (K > 1) or --crop")
+        sys.exit(1)
+    folder = args.folder or tempfile.mkdtemp(prefix='hmc_motcorr_check_')
+    os.makedirs(folder, exist_ok=True)
+    try:
+        result = checkMotionCorr(os.path.abspath(folder), args)
+    finally:
+        if args.folder is None:
+            shutil.rmtree(folder)
+    sys.exit(result)
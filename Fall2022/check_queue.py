@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+'''
+    Check of the work queue of hmc_queue.py with several local worker processes.
+    The workers are started at different times and each one finds more subjects
+    than the previous ones, as when new subjects land in the dataset while workers
+    are running, and in a different order. Processing a subject only records it,
+    so the check runs in seconds. The check fails unless every subject was queued
+    once and processed exactly once.
+
+        python3 check_queue.py --workers 4 --subjects 24 --stagger 0.5
+'''
+
+import argparse, os, random, shutil, subprocess, sys, tempfile, time
+from hmc_queue import WorkQueue, runWorker, QUEUE_FOLDER
+
+PROCESSED_FILENAME = "processed.log"
+
+def parseArguments():
+    parser = argparse.ArgumentParser(description='Check of the HMC work queue with several local worker processes', formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--workers', type=int, default=4, help='Number of worker processes (default: 4)')
+    parser.add_argument('--subjects', type=int, default=24, help='Number of subjects found by the last worker (default: 24)')
+    parser.add_argument('--stagger', type=float, default=0.5, help='Time in seconds between the starts of two workers (default: 0.5)')
+    parser.add_argument('--work_seconds', type=float, default=0.1, help='Time taken to process a subject (default: 0.1)')
+    parser.add_argument('--folder', default=None, help='Output folder holding the queue (default: a temporary folder, removed afterwards)')
+    parser.add_argument('--worker', type=int, default=None, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+def checkSubjects(folder : str, count : int):
+    return [{"output" : os.path.join(folder, f"sub-{index:03d}")} for index in range(count)]
+
+# Worker finding the first `count` subjects of the dataset, in its own order
+def runCheckWorker(folder : str, count : int, work_seconds : float):
+    subjects = checkSubjects(folder, count)
+    random.shuffle(subjects)
+    sizes = {subject["output"] : random.randint(1, 1000) for subject in subjects}
+    queue = WorkQueue(folder, lease_seconds=60)
+    print(f"Worker {queue.worker} queued {queue.enqueue(subjects, folder, sizes)} of {count} subjects")
+    def process(subject):
+        # Appends of a single short line are atomic, so the lines of the workers do not mix
+        with open(os.path.join(folder, PROCESSED_FILENAME), 'a') as processed_fp:
+            processed_fp.write(f"{os.path.basename(subject['output'])} {queue.worker}\n")
+        time.sleep(work_seconds)
+        return True
+    runWorker(queue, process, poll_seconds=work_seconds)
+
+def checkQueue(folder : str, workers : int, subjects : int, stagger : float, work_seconds : float):
+    processes = []
+    for worker in range(workers):
+        if worker > 0:
+            time.sleep(stagger)
+        count = subjects * (worker + 1) // workers
+        processes.append(subprocess.Popen([sys.executable, os.path.abspath(__file__), '--folder', folder, '--worker', str(count),
+                                           '--work_seconds', str(work_seconds)], cwd=os.path.dirname(os.path.abspath(__file__))))
+    failures = [process.wait() for process in processes].count(0) != workers
+    if failures:
+        print("[ WARNING ] - A worker exited with an error")
+    processed = {}
+    with open(os.path.join(folder, PROCESSED_FILENAME), 'r') as processed_fp:
+        for line in processed_fp:
+            name = line.split()[0]
+            processed[name] = processed.get(name, 0) + 1
+    expected = [os.path.basename(subject["output"]) for subject in checkSubjects(folder, subjects)]
+    for name in expected:
+        if processed.get(name, 0) != 1:
+            print(f"[ WARNING ] - Subject {name} was processed {processed.get(name, 0)} times")
+            failures = True
+    counts = WorkQueue(folder).counts()
+    queued = len(os.listdir(os.path.join(folder, QUEUE_FOLDER, 'subjects')))
+    if queued != subjects or counts != {'pending' : 0, 'claimed' : 0, 'done' : subjects, 'failed' : 0}:
+        print(f"[ WARNING ] - Unexpected queue state, {queued} subjects queued: {counts}")
+        failures = True
+    print(f"{workers} workers processed {sum(processed.values())} subjects of {subjects}: {'FAILED' if failures else 'OK'}")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    args = parseArguments()
+    if args.worker is not None:
+        runCheckWorker(args.folder, args.worker, args.work_seconds)
+        sys.exit(0)
+    folder = args.folder or tempfile.mkdtemp(prefix='hmc_queue_check_')
+    try:
+        result = checkQueue(folder, max(1, args.workers), args.subjects, args.stagger, args.work_seconds)
+    finally:
+        if args.folder is None:
+            shutil.rmtree(folder)
+    sys.exit(result)
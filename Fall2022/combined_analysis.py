@@ -1,7 +1,15 @@
-import csv, argparse, glob, os
-import numpy as np
-import pandas as pd
-import matplotlib.pyplot as plt
+import csv, argparse, glob, json, os
+# numpy, pandas and matplotlib are imported by presentAnalysis, so that the help is
+# printed without waiting for them to load
+
+COMBINED_SCAN_PARAMS_FILENAME = "combined_bold_scan_params.csv"
+# Row of each analysis_data.csv already combined, with its size and modification time
+COMBINED_INDEX_FILENAME = ".combined_scan_params_index.json"
+SCAN_PARAMS_FIELDNAMES = ['Subject ID', 'Pixel Volume (mm^3)', 'Repetition Time (s)', 'Echo Time (s)', 
+                            'Drift Rotation X', 'Drift Rotation Y', 'Drift Rotation Z',
+                            'Drift Translation X', 'Drift Translation Y', 'Drift Translation Z', 
+                            'Drift Framewise', 'Framewise Displacement STD', 'Mean of STD Difference', 
+                            'Algorithm Version', 'Dataset' ]
 
 def parseArguments():
     parser = argparse.ArgumentParser(description='Head motion correction stage of RABIES pipeline preprocessing stage', formatter_class=argparse.RawTextHelpFormatter)
@@ -10,33 +18,110 @@ def parseArguments():
                                 " from each subjects")
     parser.add_argument('output_folder', 
                         help='Output folder')
+    parser.add_argument('--drift_table', default=None,
+                        help="Drift table written by hmc_drift.py whose drift slopes and framewise displacement STD replace\n"
+                             "the ones of the analysis_data.csv files of the same subjects")
 
     return parser.parse_args()
 
-def presentAnalysis(input_folder : str, output_folder : str):
+# Key of an analysis_data.csv in the combined index, the same whatever the spelling of its path
+def combinedKey(drift_file : str):
+    return os.path.realpath(drift_file)
+
+def loadCombinedIndex(index_path : str):
+    try:
+        with open(index_path, 'r') as index_fp:
+            index = json.load(index_fp)
+    except (OSError, ValueError):
+        return {}
+    return {combinedKey(drift_file) : entry for drift_file, entry in index.items()}
+
+# Dataset of an analysis_data.csv, the folder 3 levels above it (<dataset>/<subject>/<subfolder>/analysis_data.csv).
+# It is taken from the resolved path so that it does not depend on how the path was spelled.
+def datasetName(drift_file : str):
+    folders = os.path.realpath(drift_file).split(os.sep)
+    return folders[-4] if len(folders) >= 4 else ''
+
+def readScanParams(drift_file : str):
+    with open(drift_file, 'r') as drift_file_fp:
+        drift_file_r = csv.reader(drift_file_fp, delimiter=',', quotechar='|')
+        dataset = datasetName(drift_file)
+        for i, row in enumerate(drift_file_r):
+            if (i == 1):
+                return row + [dataset]
+    return None
+
+# Update the combined scan parameters with the given analysis_data.csv files. Only the files that changed
+# since they were last combined are read. With complete, the files that are not given are dropped.
+def updateCombinedParams(output_folder : str, drift_files, complete : bool = False):
+    os.makedirs(output_folder, exist_ok=True)
+    index_path = os.path.join(output_folder, COMBINED_INDEX_FILENAME)
+    index = loadCombinedIndex(index_path)
+    combined_scan_params = os.path.join(output_folder, COMBINED_SCAN_PARAMS_FILENAME)
+    indexed = len(index)
+    if complete:
+        given = set(combinedKey(drift_file) for drift_file in drift_files)
+        index = {key : entry for key, entry in index.items() if key in given}
+    read = 0
+    for drift_file in drift_files:
+        key = combinedKey(drift_file)
+        try:
+            stat = os.stat(drift_file)
+        except OSError:
+            index.pop(key, None)
+            continue
+        entry = index.get(key)
+        if entry is not None and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime_ns:
+            continue
+        index[key] = {"size" : stat.st_size, "mtime" : stat.st_mtime_ns, "row" : readScanParams(drift_file)}
+        read += 1
+    # Nothing to write when every file is unchanged, as for the repeated updates of the watch mode
+    if read == 0 and len(index) == indexed and os.path.exists(combined_scan_params):
+        return combined_scan_params
+    with open(combined_scan_params + ".tmp", 'w') as combined_scan_params_fp:
+        combined_scan_params_w = csv.writer(combined_scan_params_fp, delimiter=',', quotechar='|')
+        combined_scan_params_w.writerow(SCAN_PARAMS_FIELDNAMES)
+        for drift_file in sorted(index):
+            if index[drift_file]["row"] is not None:
+                combined_scan_params_w.writerow(index[drift_file]["row"])
+    os.replace(combined_scan_params + ".tmp", combined_scan_params)
+    with open(index_path + ".tmp", 'w') as index_fp:
+        json.dump(index, index_fp)
+    os.replace(index_path + ".tmp", index_path)
+    print(f"    - Combined the scan parameters of {len(index)} subjects ({read} read, {len(index) - read} unchanged)")
+    return combined_scan_params
+
+# Output folders of the subjects in the order of the rows of the combined scan parameters
+def combinedOutputs(output_folder : str):
+    index = loadCombinedIndex(os.path.join(output_folder, COMBINED_INDEX_FILENAME))
+    return [os.path.dirname(key) for key in sorted(index) if index[key]["row"] is not None]
+
+def replaceDrift(df, outputs, drift_table : str):
+    import pandas as pd
+    drift = pd.read_csv(drift_table, quotechar='|')
+    drift = drift.set_index(drift['Output'].map(os.path.realpath))
+    outputs = pd.Series(outputs, index=df.index)
+    matched = outputs.isin(drift.index)
+    for name in [name for name in SCAN_PARAMS_FIELDNAMES if name.startswith('Drift ')] + ['Framewise Displacement STD']:
+        df.loc[matched, name] = drift.loc[outputs[matched], name].values
+    print(f"    - Drift of {int(matched.sum())} of {len(df)} subjects taken from {drift_table}")
+    return df
+
+def presentAnalysis(input_folder : str, output_folder : str, drift_table : str = None):
+    import numpy as np
+    import pandas as pd
+    import matplotlib
+    matplotlib.use('Agg') # The plots are only saved to file
+    import matplotlib.pyplot as plt
     print(f"    - Looking for drift parameters starting at folder: {input_folder}")
     print(f"    - Output folder: {output_folder}")
 
-    combined_scan_params = os.path.join(output_folder, "combined_bold_scan_params.csv")
-    scan_params_fieldnames = ['Subject ID', 'Pixel Volume (mm^3)', 'Repetition Time (s)', 'Echo Time (s)', 
-                                'Drift Rotation X', 'Drift Rotation Y', 'Drift Rotation Z',
-                                'Drift Translation X', 'Drift Translation Y', 'Drift Translation Z', 
-                                'Drift Framewise', 'Framewise Displacement STD', 'Mean of STD Difference', 
-                                'Algorithm Version', 'Dataset' ]
-
     all_drift_files = glob.glob(os.path.join(input_folder, "**/analysis_data.csv"), recursive=True)
-    with open(combined_scan_params, 'w') as combined_scan_params_fp:
-        combined_scan_params_w = csv.writer(combined_scan_params_fp, delimiter=',', quotechar='|')
-        combined_scan_params_w.writerow(scan_params_fieldnames)
-        for drift_file in all_drift_files:
-            with  open(drift_file, 'r') as drift_file_fp:
-                drift_file_r   = csv.reader(drift_file_fp, delimiter=',', quotechar='|')
-                dataset = drift_file.split('/')[-4]
-                for i, row in enumerate(drift_file_r):
-                    if (i == 1):
-                        combined_scan_params_w.writerow(np.hstack([row, [dataset]]))
+    combined_scan_params = updateCombinedParams(output_folder, all_drift_files, complete=True)
     
     df = pd.read_csv(combined_scan_params)
+    if drift_table is not None:
+        df = replaceDrift(df, combinedOutputs(output_folder), drift_table)
     longer_df_rot = pd.wide_to_long(df.reset_index(), stubnames=['Drift Rotation'], 
                                 i='index', j='Drift Rotation Axis', suffix="\\D+")
 
@@ -185,4 +270,4 @@ if __name__ == "__main__":
     print("Assembling the analysis conducted on a variety of subjects")
     args = parseArguments()
 
-    presentAnalysis(args.input_folder, args.output_folder)
\ No newline at end of file
+    presentAnalysis(args.input_folder, args.output_folder, args.drift_table)
\ No newline at end of file
@@ -0,0 +1,121 @@
+'''
+    Execution backends used by HMC_isolated.py to run the ANTs motion correction
+    of each subject. A backend receives a list of jobs, each job being a dictionary
+    holding the subject dictionary and the shell command to execute, and calls back
+    into the caller every time a job finishes (or is handed off to a scheduler).
+
+    Available backends:
+     - serial : runs the jobs one after the other in the current process
+     - local  : runs up to N jobs concurrently on the local node
+     - qbatch : submits the jobs to the cluster through launch_batch.sh/qbatch. The
+                analysis of each subject is submitted as its own job depending on
+                the motion correction job of the subject. A job packing several
+                subjects succeeds even when some of them fail, their failure being
+                recorded in their output folder, so that the analysis of the others
+                still runs.
+'''
+
+import os, subprocess, tempfile, time
+from hmc_budget import CpuBudget, availableCores
+from hmc_supervisor import JobSupervisor, jobName
+
+def defaultCpuCount():
+    return len(availableCores())
+
+class ExecutionBackend:
+    name = None
+    # Backends running the analysis themselves expect an "analysis_command" in each job
+    # and do not call on_finished
+    remote_analysis = False
+
+    def __init__(self, budget : CpuBudget, memory_budget=None):
+        self.budget = budget
+        self.jobs = budget.jobs
+        self.memory_budget = memory_budget
+
+    # Execute all the jobs. on_finished(job, returncode) is called for each job once it is done.
+    def run(self, jobs, on_finished=None):
+        raise NotImplementedError
+
+    def _finished(self, on_finished, job, returncode):
+        if returncode != 0:
+            print(f"[ WARNING ] - Motion correction failed for {job['subject']['output']} (exit code {returncode})")
+        if on_finished is not None:
+            on_finished(job, returncode)
+
+class SerialBackend(ExecutionBackend):
+    name = 'serial'
+
+    def run(self, jobs, on_finished=None):
+        supervisor = JobSupervisor(1, self.budget, echo=True, memory_budget=self.memory_budget)
+        supervisor.run(jobs, on_finished=lambda job, returncode: self._finished(on_finished, job, returncode))
+
+class LocalPoolBackend(ExecutionBackend):
+    name = 'local'
+
+    # The output of each job is written to a log file in the subject output folder since the
+    # output of concurrent ANTs runs would be unreadable on the console
+    def run(self, jobs, on_finished=None):
+        print(f"Running {len(jobs)} motion correction jobs with up to {self.jobs} in parallel "
+              f"using {self.budget.threads} threads each")
+        supervisor = JobSupervisor(self.jobs, self.budget, memory_budget=self.memory_budget)
+        supervisor.run(jobs, on_finished=lambda job, returncode: self._finished(on_finished, job, returncode))
+
+class QbatchBackend(ExecutionBackend):
+    name = 'qbatch'
+    remote_analysis = True
+
+    def __init__(self, budget : CpuBudget, memory_budget=None):
+        super().__init__(budget, memory_budget)
+        self.run_id = f"hmc{os.getpid()}{int(time.time()) % 100000}"
+        self.batch_folder = None
+
+    # Folder unique to this run holding the files read by its jobs, so that concurrent runs do not clobber each other
+    def batchFolder(self, root : str):
+        if self.batch_folder is None:
+            os.makedirs(root, exist_ok=True)
+            self.batch_folder = tempfile.mkdtemp(prefix=f"{self.run_id}_", dir=root)
+        return self.batch_folder
+
+    # Prefix of a job command removing the given files of the run folder when the command exits, whether it
+    # succeeds or not, the last job removing the emptied run folder. The exit status of the command is kept.
+    def cleanupPrefix(self, files):
+        return f"trap 'rm -f {' '.join(files)}; rmdir {self.batch_folder} 2>/dev/null || true' EXIT; "
+
+    # The commands are given to the submitter on its standard input and copied in its own job script, so that
+    # no command file is left behind
+    def submit(self, name : str, commands, depend=None):
+        options = ['-N', name]
+        if depend is not None:
+            options += ['--depend', depend]
+        result = subprocess.run(["./launch_batch.sh"] + options + ['-'], input='\n'.join(commands) + '\n',
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+        print(result.stdout, end='')
+        if result.returncode != 0:
+            print(f"[ WARNING ] - Failed to submit job {name}")
+        return result.returncode == 0
+
+    # Each job may hold several subjects. Jobs without a command only submit the
+    # analysis of subjects that are already corrected.
+    def run(self, jobs, on_finished=None):
+        submitted = 0
+        for index, job in enumerate(jobs):
+            motcorr_name = f"{self.run_id}_moco_{index}"
+            analysis_name = f"{self.run_id}_analysis_{index}"
+            print(f"Submitting jobs {motcorr_name} and {analysis_name} for {jobName(job)}")
+            depend = None
+            if job["command"] is not None:
+                if not self.submit(motcorr_name, [job["command"]]):
+                    continue
+                depend = motcorr_name
+            if self.submit(analysis_name, [job["analysis_command"]], depend):
+                submitted += 1
+        print(f"Submitted {submitted}/{len(jobs)} jobs, the analysis of each job "
+              f"will start as soon as its motion correction is done")
+
+BACKENDS = {backend.name : backend for backend in (SerialBackend, LocalPoolBackend, QbatchBackend)}
+
+def getBackend(name : str, budget : CpuBudget, memory_budget=None):
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown execution backend {name}, expected one of {', '.join(BACKENDS)}")
+    return BACKENDS[name](budget, memory_budget)
@@ -0,0 +1,97 @@
+'''
+    CPU budgeting of the concurrent ANTs motion correction jobs. The CPU budget
+    is split into a number of subjects processed in parallel and a number of ITK
+    threads given to each of them, so that concurrent antsMotionCorr processes
+    do not oversubscribe the machine. Each job can optionally be pinned to its
+    own disjoint set of cores.
+'''
+
+import os, json, queue
+
+BUDGET_FILENAME = "thread_budget.json"
+ITK_THREADS_VARIABLE = "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"
+
+def availableCores():
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+# Candidate (subjects in parallel, threads per subject) splits of the CPU budget
+def candidateSplits(cpus : int):
+    threads = set([1, cpus])
+    t = 2
+    while t < cpus:
+        threads.add(t)
+        t *= 2
+    return sorted(set((cpus // t, t) for t in threads), reverse=True)
+
+# Resolve the split from the options given on the command line. When neither is given,
+# the budget is spread over as many subjects as there is to process.
+def resolveSplit(cpus : int, jobs, threads, n_subjects : int):
+    if jobs is None and threads is None:
+        jobs = max(1, min(cpus, n_subjects))
+    if jobs is None:
+        jobs = max(1, cpus // threads)
+    if threads is None:
+        threads = max(1, cpus // jobs)
+    if jobs * threads > cpus:
+        print(f"[ WARNING ] - {jobs} subjects with {threads} threads each exceeds the budget of {cpus} cores")
+    return jobs, threads
+
+# Pick the split with the best throughput. run_trial(jobs, threads) runs the calibration
+# workload with the given split and returns its duration in seconds.
+def calibrateSplit(run_trial, cpus : int, candidates=None):
+    if candidates is None:
+        candidates = candidateSplits(cpus)
+    results = []
+    for jobs, threads in candidates:
+        elapsed = run_trial(jobs, threads)
+        throughput = jobs / elapsed if elapsed > 0 else float('inf')
+        print(f"   - {jobs} subjects x {threads} threads: {elapsed:.1f} s ({throughput * 3600:.1f} subjects/hour)")
+        results.append({"jobs" : jobs, "threads" : threads, "seconds" : elapsed, "throughput" : throughput})
+    best = max(results, key=lambda result: result["throughput"])
+    return best["jobs"], best["threads"], results
+
+class CpuBudget:
+
+    def __init__(self, cpus : int, jobs : int, threads : int, pin : bool = False, calibration=None):
+        self.cpus = cpus
+        self.jobs = jobs
+        self.threads = threads
+        self.pin = pin
+        self.calibration = calibration
+        self._slots = queue.Queue()
+        cores = availableCores()
+        for slot in range(jobs):
+            slot_cores = None
+            if pin:
+                slot_cores = cores[slot * threads:(slot + 1) * threads]
+                if len(slot_cores) == 0:
+                    print(f"[ WARNING ] - Not enough cores to pin job slot {slot}, it will not be pinned")
+                    slot_cores = None
+            self._slots.put(slot_cores)
+
+    # Reserve the cores of a job slot, None is returned when jobs are not pinned
+    def acquire(self):
+        return self._slots.get()
+
+    def release(self, cores):
+        self._slots.put(cores)
+
+    def environment(self):
+        env = dict(os.environ)
+        env[ITK_THREADS_VARIABLE] = str(self.threads)
+        return env
+
+    # Function executed in the child process before ANTs starts to pin it to its cores
+    def affinity(self, cores):
+        if cores is None or not hasattr(os, "sched_setaffinity"):
+            return None
+        return lambda: os.sched_setaffinity(0, cores)
+
+    # Record the split in the output folder of a subject
+    def record(self, output : str, cores=None):
+        record = {"cpus" : self.cpus, "jobs" : self.jobs, "threads" : self.threads,
+                  "pinned_cores" : cores, "calibration" : self.calibration}
+        with open(os.path.join(output, BUDGET_FILENAME), 'w') as budget_fp:
+            json.dump(record, budget_fp, indent=2)
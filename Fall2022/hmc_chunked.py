@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+'''
+    Frame-chunked motion correction of a single subject. antsMotCor.sh registers
+    every frame to the same fixed reference (--useFixedReferenceImage 1), so the
+    frames of a long timeseries can be corrected independently. The 4D moving image
+    is split into K chunks of consecutive frames, antsMotCor.sh corrects the chunks
+    concurrently with the ITK threads of the job split between them, and the results
+    are stitched back in the output folder:
+     - motcorrMOCOparams.csv : the rows of the chunks in frame order, under one header
+     - motcorr_warped.nii.gz : the warped frames of the chunks concatenated in time
+     - motcorr_avg.nii.gz    : the average of the stitched warped timeseries
+    The framewise displacement is then computed on the stitched parameters of the
+    whole timeseries, as for a single run.
+
+        python3 hmc_chunked.py -m <moving> -r <reference> -x <mask> -o <output> --chunks 4 [-l] [-c] [-p]
+'''
+
+import argparse, os, shutil, subprocess, sys, time
+from hmc_budget import CpuBudget, ITK_THREADS_VARIABLE
+from hmc_supervisor import JobSupervisor
+
+CHUNKS_FOLDER = ".hmc_chunks"
+
+def parseArguments():
+    parser = argparse.ArgumentParser(description='Frame-chunked ANTs motion correction of a subject', formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('-m', '--moving', required=True, help='4D moving image')
+    parser.add_argument('-r', '--reference', required=True, help='Reference image')
+    parser.add_argument('-x', '--mask', required=True, help='Mask image')
+    parser.add_argument('-o', '--output', required=True, help='Output folder')
+    parser.add_argument('--chunks', type=int, default=2, help='Number of frame chunks corrected in parallel (default: 2)')
+    parser.add_argument('--motcor_path', default='./', help='Folder holding antsMotCor.sh (default: ./)')
+    parser.add_argument('-l', '--latest_ants', action='store_true', help='Passed to antsMotCor.sh')
+    parser.add_argument('-c', '--containerized', action='store_true', help='Passed to antsMotCor.sh')
+    parser.add_argument('-p', '--performance', action='store_true', help='Passed to antsMotCor.sh')
+    return parser.parse_args()
+
+# Balanced (start, stop) frame ranges of the chunks
+def chunkRanges(frames : int, chunks : int):
+    chunks = max(1, min(chunks, frames))
+    bounds = [frames * chunk // chunks for chunk in range(chunks + 1)]
+    return [(bounds[chunk], bounds[chunk + 1]) for chunk in range(chunks)]
+
+def splitMoving(moving : str, ranges, folder : str):
+    import nibabel as nb
+    moving_obj = nb.load(moving)
+    chunk_paths = []
+    for index, (start, stop) in enumerate(ranges):
+        chunk_folder = os.path.join(folder, f"chunk{index:03d}")
+        os.makedirs(chunk_folder, exist_ok=True)
+        chunk_path = os.path.join(chunk_folder, 'moving.nii.gz')
+        # The slicer keeps the header, datatype and scaling so that ANTs reads the same voxels
+        nb.save(moving_obj.slicer[..., start:stop], chunk_path)
+        chunk_paths.append((chunk_path, chunk_folder))
+    return chunk_paths
+
+def stitchParameters(chunk_folders, output : str):
+    with open(os.path.join(output, 'motcorrMOCOparams.csv'), 'w') as stitched_fp:
+        header = None
+        frame = 0
+        for chunk_folder in chunk_folders:
+            with open(os.path.join(chunk_folder, 'motcorrMOCOparams.csv'), 'r') as chunk_fp:
+                lines = [line for line in chunk_fp.read().splitlines() if line.strip() != '']
+            if header is None:
+                header = lines[0]
+                stitched_fp.write(header + '\n')
+            for line in lines[1:]:
+                # Parameter files written with a row index column are renumbered with the frame of the whole timeseries
+                if header.split(',')[0].strip('"') == '':
+                    line = str(frame) + line[line.index(','):]
+                stitched_fp.write(line + '\n')
+                frame += 1
+    return frame
+
+# The warped frames of the chunks are streamed to the stitched image one chunk at a time, after the header of
+# the whole timeseries, so that only one chunk and the running sum of the average are held in memory
+def stitchImages(chunk_folders, output : str):
+    import nibabel as nb
+    import numpy as np
+    from nibabel.openers import ImageOpener
+    warped_objs = [nb.load(os.path.join(chunk_folder, 'motcorr_warped.nii.gz')) for chunk_folder in chunk_folders]
+    header = warped_objs[0].header.copy()
+    dtype = header.get_data_dtype()
+    # Scaled chunks are written as float32 since their values do not fit the stored datatype
+    if any(np.isfinite(warped_obj.dataobj.slope) and (warped_obj.dataobj.slope, warped_obj.dataobj.inter) != (1, 0) for warped_obj in warped_objs):
+        dtype = np.dtype(np.float32)
+        header.set_data_dtype(dtype)
+    header.set_data_shape(warped_objs[0].shape[:3] + (sum(warped_obj.shape[3] for warped_obj in warped_objs), ))
+    header.set_slope_inter(np.nan, np.nan)
+    total = np.zeros(warped_objs[0].shape[:3])
+    with ImageOpener(os.path.join(output, 'motcorr_warped.nii.gz'), 'wb') as warped_fp:
+        header.write_to(warped_fp)
+        warped_fp.write(b'\0' * (int(header['vox_offset']) - warped_fp.tell()))
+        for warped_obj in warped_objs:
+            warped = np.asanyarray(warped_obj.dataobj)
+            total += warped.sum(axis=3, dtype=np.float64)
+            # NIfTI voxels are stored in Fortran order, the frames of each chunk following the previous ones
+            warped_fp.write(warped.astype(dtype, copy=False).tobytes(order='F'))
+            del warped
+    avg_obj = nb.load(os.path.join(chunk_folders[0], 'motcorr_avg.nii.gz'))
+    average = (total / header.get_data_shape()[3]).astype(avg_obj.get_data_dtype())
+    nb.save(nb.Nifti1Image(average, avg_obj.affine, avg_obj.header), os.path.join(output, 'motcorr_avg.nii.gz'))
+
+def antsOptions(args):
+    return ' '.join(option for option, selected in (('-l', args.latest_ants), ('-c', args.containerized), ('-p', args.performance)) if selected)
+
+# Correct the chunks of the moving image and stitch them in the output folder, without the framewise
+# displacement. Returns 0 on success.
+def correctChunks(moving : str, reference : str, mask : str, output : str, chunks : int, motcor_path : str, ants_opts : str):
+    import nibabel as nb
+    frames = nb.load(moving).shape[3]
+    ranges = chunkRanges(frames, chunks)
+    folder = os.path.join(output, CHUNKS_FOLDER)
+    shutil.rmtree(folder, ignore_errors=True)
+    os.makedirs(folder)
+    try:
+        chunk_paths = splitMoving(moving, ranges, folder)
+        # The chunks share the threads given to the job
+        threads = int(os.environ.get(ITK_THREADS_VARIABLE, 0)) or os.cpu_count() or 1
+        budget = CpuBudget(threads, len(ranges), max(1, threads // len(ranges)))
+        jobs = [{"name"    : f"frames {start}-{stop - 1}",
+                 "log"     : os.path.join(chunk_folder, 'hmc_log.txt'),
+                 "command" : f"{motcor_path}antsMotCor.sh -m {chunk_path} -r {reference} -x {mask} -o {chunk_folder} --no_stats {ants_opts}"}
+                for (start, stop), (chunk_path, chunk_folder) in zip(ranges, chunk_paths)]
+        print(f"Correcting {frames} frames of {moving} in {len(jobs)} chunks with {budget.threads} threads each")
+        start = time.time()
+        returncodes = JobSupervisor(len(jobs), budget, status_interval=0).run(jobs)
+        for job, returncode in zip(jobs, returncodes):
+            with open(job["log"], 'r') as log_fp:
+                sys.stdout.write(f"--- {job['name']} ---\n" + log_fp.read())
+        if any(returncode != 0 for returncode in returncodes):
+            print(f"Motion correction failed for the chunks {', '.join(job['name'] for job, returncode in zip(jobs, returncodes) if returncode != 0)}")
+            return 1
+        chunk_folders = [chunk_folder for _, chunk_folder in chunk_paths]
+        stitched = stitchParameters(chunk_folders, output)
+        if stitched != frames:
+            print(f"Stitched {stitched} frames of motion parameters instead of {frames}")
+            return 1
+        stitchImages(chunk_folders, output)
+        elapsed = int(time.time() - start)
+        # The runtime model learns the time of the whole correction, as given by the chunks added up
+        chunk_seconds = 0
+        for chunk_folder in chunk_folders:
+            with open(os.path.join(chunk_folder, 'execution_time.txt'), 'r') as time_fp:
+                chunk_seconds += int(time_fp.read().split()[0])
+        with open(os.path.join(output, 'execution_time.txt'), 'w') as time_fp:
+            time_fp.write(f"{chunk_seconds} s\n")
+        print(f"Stitched {len(jobs)} chunks in {output} ({elapsed} s wall-clock time, {chunk_seconds} s of motion correction)")
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    return 0
+
+def chunkedMotionCorr(args):
+    ants_opts = antsOptions(args)
+    returncode = correctChunks(args.moving, args.reference, args.mask, args.output, args.chunks, args.motcor_path, ants_opts)
+    if returncode != 0:
+        return returncode
+    return subprocess.call(f"{args.motcor_path}antsMotCor.sh -m {args.moving} -r {args.reference} -x {args.mask} -o {args.output} --stats_only {ants_opts}", shell=True)
+
+if __name__ == "__main__":
+    args = parseArguments()
+    sys.exit(chunkedMotionCorr(args))
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+'''
+    Thin client of the HMC daemon (hmc_daemon.py). Runs one of the HMC scripts in
+    the daemon, which already holds SimpleITK, nibabel, numpy, matplotlib and pandas
+    in memory, and streams the output of the script back as it is produced. The
+    client only imports the standard library so that it starts instantly.
+
+        python3 hmc_client.py HMC_isolated.py <input> <output> --analysis_only
+        python3 hmc_client.py animation.py <input> <output> -d
+        python3 hmc_client.py combined_analysis.py <input> <output>
+
+    When no daemon is listening, the script is executed directly with the same
+    arguments, so the client can be used in place of python3 in any command.
+'''
+
+import json, os, socket, sys, tempfile
+
+SCRIPTS = ('HMC_isolated', 'animation', 'combined_analysis')
+EXIT_MARKER = b'\n\x00HMC_EXIT '
+CHUNK_SIZE = 65536
+
+def defaultSocket():
+    folder = os.environ.get("XDG_RUNTIME_DIR", tempfile.gettempdir())
+    return os.environ.get("HMC_DAEMON_SOCKET", os.path.join(folder, f"hmc_daemon-{os.getuid()}.sock"))
+
+def connect(socket_path : str):
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+    except OSError:
+        client.close()
+        return None
+    return client
+
+def request(client, message):
+    client.sendall(json.dumps(message).encode("utf-8") + b'\n')
+
+# Write the output of the script as it arrives, holding back what could be the start of the exit marker
+def streamOutput(client):
+    out = sys.stdout.buffer
+    pending = b''
+    while True:
+        chunk = client.recv(CHUNK_SIZE)
+        if not chunk:
+            break
+        pending += chunk
+        marker = pending.rfind(EXIT_MARKER)
+        if marker != -1:
+            if pending.endswith(b'\n'):
+                break
+            continue
+        flushable = max(0, len(pending) - len(EXIT_MARKER))
+        out.write(pending[:flushable])
+        out.flush()
+        pending = pending[flushable:]
+    marker = pending.rfind(EXIT_MARKER)
+    if marker == -1:
+        out.write(pending)
+        out.flush()
+        print("[ WARNING ] - Connection to the HMC daemon lost before the script finished")
+        return 1
+    out.write(pending[:marker])
+    out.flush()
+    return int(pending[marker + len(EXIT_MARKER):].decode("utf-8").strip() or 1)
+
+def runScript(script : str, args, socket_path : str):
+    name = os.path.splitext(os.path.basename(script))[0]
+    if name not in SCRIPTS:
+        print(f"Unknown script {script}, expected one of {', '.join(SCRIPTS)}")
+        return 1
+    client = connect(socket_path)
+    if client is None:
+        script_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), f"{name}.py")
+        os.execv(sys.executable, [sys.executable, script_path] + args)
+    with client:
+        request(client, {"command" : 'run', "script" : name, "args" : args, "cwd" : os.getcwd(), "env" : dict(os.environ)})
+        return streamOutput(client)
+
+def control(command : str, socket_path : str):
+    client = connect(socket_path)
+    if client is None:
+        print(f"No HMC daemon listening on {socket_path}")
+        return 1
+    with client:
+        request(client, {"command" : command})
+        return streamOutput(client)
+
+if __name__ == "__main__":
+    socket_path = defaultSocket()
+    if len(sys.argv) < 2 or sys.argv[1] in ('-h', '--help'):
+        print(__doc__)
+        print("    Use --status to check that the daemon is running and --stop to stop it.")
+        sys.exit(0)
+    if sys.argv[1] in ('--status', '--stop'):
+        sys.exit(control(sys.argv[1][2:], socket_path))
+    sys.exit(runScript(sys.argv[1], sys.argv[2:], socket_path))
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+'''
+    Motion correction of a subject cropped to the bounding box of its mask. EPI
+    volumes have large empty margins on which antsMotionCorr spends most of its
+    metric evaluations, so the moving and reference images are cropped to the
+    bounding box of the mask plus a margin before the correction.
+
+    Cropping keeps the physical position of every voxel, but moves the center of
+    the reference grid about which the rigid rotation is parameterized. With R the
+    rotation and t the translation found about the center c of the cropped grid,
+    the same transform about the center c' of the full grid has the translation
+
+        t' = t + (R - I)(c' - c)
+
+    The parameters are mapped this way to the full image space. The warped output is
+    then resampled on the full reference grid from the full moving image with the
+    mapped transforms, rather than taken from ANTs, since near the edges of the box
+    ANTs sampled the cropped moving image and moved the zeros outside the crop into
+    the frames. The framewise displacement is computed on the full images.
+
+        python3 hmc_crop.py -m <moving> -r <reference> -x <mask> -o <output> --margin 4 [--chunks K] [-l] [-c] [-p]
+'''
+
+import argparse, csv, os, shutil, subprocess, sys
+from hmc_chunked import correctChunks, antsOptions
+from hmc_loaders import loadMotionTable, rigidParameters
+
+CROP_FOLDER = ".hmc_crop"
+
+def parseArguments():
+    parser = argparse.ArgumentParser(description='ANTs motion correction of a subject cropped to its mask', formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('-m', '--moving', required=True, help='4D moving image')
+    parser.add_argument('-r', '--reference', required=True, help='Reference image')
+    parser.add_argument('-x', '--mask', required=True, help='Mask image')
+    parser.add_argument('-o', '--output', required=True, help='Output folder')
+    parser.add_argument('--margin', type=int, default=4, help='Margin in voxels added around the bounding box of the mask (default: 4)')
+    parser.add_argument('--chunks', type=int, default=1, help='Number of frame chunks of the cropped images corrected in parallel (default: 1)')
+    parser.add_argument('--motcor_path', default='./', help='Folder holding antsMotCor.sh (default: ./)')
+    parser.add_argument('-l', '--latest_ants', action='store_true', help='Passed to antsMotCor.sh')
+    parser.add_argument('-c', '--containerized', action='store_true', help='Passed to antsMotCor.sh')
+    parser.add_argument('-p', '--performance', action='store_true', help='Passed to antsMotCor.sh')
+    return parser.parse_args()
+
+# Voxel (start, stop) ranges of the bounding box of the mask grown by the margin, None when the mask is empty
+def maskBoundingBox(mask : str, margin : int):
+    import nibabel as nb
+    import numpy as np
+    mask_obj = nb.load(mask)
+    mask_data = np.asanyarray(mask_obj.dataobj).reshape(mask_obj.shape[:3]) != 0
+    if not mask_data.any():
+        return None
+    box = []
+    for axis in range(3):
+        indices = np.nonzero(mask_data.any(axis=tuple(other for other in range(3) if other != axis)))[0]
+        box.append((max(0, int(indices[0]) - margin), min(mask_data.shape[axis], int(indices[-1]) + 1 + margin)))
+    return box
+
+def cropImages(args, box, folder : str):
+    import nibabel as nb
+    slices = tuple(slice(start, stop) for start, stop in box)
+    cropped = {}
+    for name in ('moving', 'reference', 'mask'):
+        image = nb.load(getattr(args, name))
+        # The slicer updates the affine so that the cropped voxels keep their physical position
+        cropped_image = image.slicer[slices + (slice(None), ) * (len(image.shape) - 3)]
+        cropped[name] = os.path.join(folder, f"{name}.nii.gz")
+        nb.save(cropped_image, cropped[name])
+    return cropped
+
+# Physical center of the grid of an image, in the ITK coordinates used by ANTs
+def gridCenter(image):
+    return image.TransformContinuousIndexToPhysicalPoint([(size - 1) / 2.0 for size in image.GetSize()])
+
+# Rigid parameters (Euler angles, translation) about the full grid center from the parameters about the cropped grid center
+def mapParameters(parameters, cropped_center, full_center):
+    import SimpleITK as sitk
+    import numpy as np
+    transform = sitk.Euler3DTransform(cropped_center, *parameters[:3], parameters[3:6])
+    rotation = np.array(transform.GetMatrix()).reshape(3, 3)
+    translation = np.array(parameters[3:6]) + (rotation - np.eye(3)).dot(np.array(full_center) - np.array(cropped_center))
+    return list(parameters[:3]) + translation.tolist()
+
+def mapParametersFile(cropped_csv : str, output_csv : str, cropped_center, full_center):
+    with open(cropped_csv, 'r') as cropped_fp, open(output_csv, 'w') as output_fp:
+        rows = [row for row in csv.reader(cropped_fp) if len(row) != 0]
+        output_w = csv.writer(output_fp, delimiter=',', lineterminator='\n')
+        output_w.writerow(rows[0])
+        # The 6 rigid parameters are the last columns, after the metric values
+        for row in rows[1:]:
+            parameters = mapParameters([float(value) for value in row[-6:]], cropped_center, full_center)
+            output_w.writerow(row[:-6] + [repr(float(value)) for value in parameters])
+
+# Warped timeseries and its average on the full reference grid, resampled from the full moving image with the
+# mapped transforms
+def resampleWarped(args, full_center):
+    import SimpleITK as sitk
+    import numpy as np
+    reference = sitk.ReadImage(args.reference, sitk.sitkFloat32)
+    moving = sitk.ReadImage(args.moving, sitk.sitkFloat32)
+    parameters = rigidParameters(loadMotionTable(os.path.join(args.output, 'motcorrMOCOparams.csv'))).tolist()
+    frames = []
+    total = np.zeros(reference.GetSize()[::-1])
+    for frame, frame_parameters in enumerate(parameters):
+        transform = sitk.Euler3DTransform(full_center, *frame_parameters[:3], frame_parameters[3:6])
+        frames.append(sitk.Resample(moving[:, :, :, frame], reference, transform, sitk.sitkLinear, 0.0))
+        total += sitk.GetArrayViewFromImage(frames[-1])
+    # The frames carry the geometry of the reference, the time axis is the one of the moving image
+    warped_image = sitk.JoinSeries(frames, moving.GetOrigin()[3], moving.GetSpacing()[3])
+    sitk.WriteImage(warped_image, os.path.join(args.output, 'motcorr_warped.nii.gz'))
+    average_image = sitk.GetImageFromArray((total / len(frames)).astype(np.float32))
+    average_image.CopyInformation(reference)
+    sitk.WriteImage(average_image, os.path.join(args.output, 'motcorr_avg.nii.gz'))
+
+def croppedMotionCorr(args):
+    import SimpleITK as sitk
+    ants_opts = antsOptions(args)
+    stats_command = f"{args.motcor_path}antsMotCor.sh -m {args.moving} -r {args.reference} -x {args.mask} -o {args.output} --stats_only {ants_opts}"
+    box = maskBoundingBox(args.mask, args.margin)
+    full_shape = sitk.ReadImage(args.reference).GetSize()
+    if box is None or all(start == 0 and stop == size for (start, stop), size in zip(box, full_shape)):
+        print(f"[ WARNING ] - The mask of {args.moving} is empty or covers the whole image, correcting it without cropping")
+        return subprocess.call(f"{args.motcor_path}antsMotCor.sh -m {args.moving} -r {args.reference} -x {args.mask} -o {args.output} {ants_opts}", shell=True)
+    folder = os.path.join(args.output, CROP_FOLDER)
+    shutil.rmtree(folder, ignore_errors=True)
+    os.makedirs(folder)
+    try:
+        cropped = cropImages(args, box, folder)
+        cropped_voxels = 1
+        for start, stop in box:
+            cropped_voxels *= stop - start
+        print(f"Cropping {args.moving} to the voxels {box} of its mask, {100.0 * cropped_voxels / (full_shape[0] * full_shape[1] * full_shape[2]):.0f}% of the volume")
+        if args.chunks > 1:
+            returncode = correctChunks(cropped["moving"], cropped["reference"], cropped["mask"], folder, args.chunks, args.motcor_path, ants_opts)
+        else:
+            returncode = subprocess.call(f"{args.motcor_path}antsMotCor.sh -m {cropped['moving']} -r {cropped['reference']} -x {cropped['mask']} -o {folder} --no_stats {ants_opts}", shell=True)
+        if returncode != 0:
+            return returncode
+        full_center = gridCenter(sitk.ReadImage(args.reference))
+        cropped_center = gridCenter(sitk.ReadImage(cropped["reference"]))
+        mapParametersFile(os.path.join(folder, 'motcorrMOCOparams.csv'), os.path.join(args.output, 'motcorrMOCOparams.csv'), cropped_center, full_center)
+        resampleWarped(args, full_center)
+        shutil.copyfile(os.path.join(folder, 'execution_time.txt'), os.path.join(args.output, 'execution_time.txt'))
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    return subprocess.call(stats_command, shell=True)
+
+if __name__ == "__main__":
+    args = parseArguments()
+    sys.exit(croppedMotionCorr(args))
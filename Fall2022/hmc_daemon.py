@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+'''
+    Daemon keeping SimpleITK, nibabel, numpy, matplotlib and pandas loaded so that
+    the HMC scripts do not pay for importing them on every run. The daemon listens
+    on a Unix socket for the requests of hmc_client.py and forks a child for each
+    request. The child inherits the loaded modules, runs the requested script with
+    the arguments, working directory and environment of the client, and writes its
+    output directly to the client connection.
+
+        python3 hmc_daemon.py &
+        python3 hmc_client.py HMC_isolated.py <input> <output> --analysis_only
+
+    The daemon is single threaded, requests run concurrently in their own child
+    processes, and the exit code of each script is sent to the client once its
+    child has exited.
+'''
+
+import argparse, json, os, runpy, selectors, signal, socket, sys, time, traceback
+from hmc_client import SCRIPTS, EXIT_MARKER, defaultSocket
+
+PRELOADED_MODULES = ('numpy', 'nibabel', 'SimpleITK', 'pandas', 'matplotlib.pyplot', 'matplotlib.animation')
+REQUEST_TIMEOUT = 5.0
+REAP_INTERVAL = 0.5
+
+def parseArguments():
+    parser = argparse.ArgumentParser(description='Daemon running the HMC scripts with their dependencies preloaded', formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--socket', default=defaultSocket(), help=f'Path of the Unix socket (default: {defaultSocket()})')
+    return parser.parse_args()
+
+# Import the scripts and the heavy modules they import lazily, once for all the requests
+def preloadScripts():
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    start = time.time()
+    import matplotlib
+    matplotlib.use('Agg')
+    for module in PRELOADED_MODULES + SCRIPTS:
+        try:
+            __import__(module)
+        except ImportError as error:
+            print(f"[ WARNING ] - Failed to preload {module}: {error}")
+    print(f"Preloaded the HMC scripts in {time.time() - start:.2f} s")
+
+def readRequest(connection):
+    connection.settimeout(REQUEST_TIMEOUT)
+    data = b''
+    while not data.endswith(b'\n'):
+        chunk = connection.recv(65536)
+        if not chunk:
+            return None
+        data += chunk
+    connection.settimeout(None)
+    return json.loads(data.decode("utf-8"))
+
+# Executed in the forked child: the script output goes straight to the client connection
+def runRequest(connection, message):
+    code = 1
+    try:
+        os.dup2(connection.fileno(), 1)
+        os.dup2(connection.fileno(), 2)
+        devnull = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(devnull, 0)
+        sys.stdout = os.fdopen(1, 'w', buffering=1)
+        sys.stderr = os.fdopen(2, 'w', buffering=1)
+        os.chdir(message["cwd"])
+        os.environ.clear()
+        os.environ.update(message["env"])
+        sys.argv = [message["script"] + '.py'] + message["args"]
+        runpy.run_module(message["script"], run_name='__main__', alter_sys=True)
+        code = 0
+    except SystemExit as exit:
+        code = exit.code if isinstance(exit.code, int) else (0 if exit.code is None else 1)
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(code)
+
+def exitCode(status : int):
+    if os.WIFEXITED(status):
+        return os.WEXITSTATUS(status)
+    return 128 + os.WTERMSIG(status)
+
+class HmcDaemon:
+
+    def __init__(self, socket_path : str):
+        self.socket_path = socket_path
+        self.children = {}
+        self.running = True
+        self.server = None
+
+    def serve(self):
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        server = self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.socket_path)
+        os.chmod(self.socket_path, 0o600)
+        server.listen(64)
+        selector = selectors.DefaultSelector()
+        selector.register(server, selectors.EVENT_READ)
+        print(f"HMC daemon listening on {self.socket_path}")
+        sys.stdout.flush()
+        try:
+            while self.running or len(self.children) != 0:
+                if self.running and len(selector.select(REAP_INTERVAL)) != 0:
+                    connection, _ = server.accept()
+                    self.handle(connection)
+                elif not self.running:
+                    time.sleep(REAP_INTERVAL)
+                self.reapChildren()
+        finally:
+            selector.close()
+            server.close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+    def handle(self, connection):
+        try:
+            message = readRequest(connection)
+        except (OSError, ValueError) as error:
+            print(f"[ WARNING ] - Invalid request: {error}")
+            connection.close()
+            return
+        if message is None:
+            connection.close()
+        elif message["command"] == 'status':
+            connection.sendall(f"HMC daemon {os.getpid()} running {len(self.children)} requests\n".encode("utf-8") + EXIT_MARKER + b'0\n')
+            connection.close()
+        elif message["command"] == 'stop':
+            self.running = False
+            connection.sendall(f"Stopping the HMC daemon after {len(self.children)} running requests\n".encode("utf-8") + EXIT_MARKER + b'0\n')
+            connection.close()
+        elif message["command"] == 'run' and message.get("script") in SCRIPTS:
+            pid = os.fork()
+            if pid == 0:
+                # The child only keeps its own connection open, so that the other clients see the end of their output
+                self.server.close()
+                for other in self.children.values():
+                    other.close()
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                runRequest(connection, message)
+            print(f"Running {message['script']} {' '.join(message['args'])} in process {pid}")
+            sys.stdout.flush()
+            self.children[pid] = connection
+        else:
+            connection.sendall(b"Invalid request" + EXIT_MARKER + b'1\n')
+            connection.close()
+
+    # Send the exit code of the finished scripts to their clients
+    def reapChildren(self):
+        while len(self.children) != 0:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                return
+            connection = self.children.pop(pid, None)
+            if connection is None:
+                continue
+            try:
+                connection.sendall(EXIT_MARKER + f"{exitCode(status)}\n".encode("utf-8"))
+            except OSError:
+                pass
+            connection.close()
+
+if __name__ == "__main__":
+    args = parseArguments()
+    preloadScripts()
+    HmcDaemon(args.socket).serve()
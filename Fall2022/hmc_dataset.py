@@ -0,0 +1,187 @@
+'''
+    Discovery of the fMRI runs of a dataset preprocessed by RABIES. The tree is walked
+    once with os.scandir, instead of globbing every file of every subject, and each
+    run of each session of each subject is found:
+
+        sub-0XX/ses-Y/func/sub-0XX_ses-Y[_run-Z]_task-rest_acq-EPI_bold.nii.gz       moving
+        sub-0XX/ses-Y/func/sub-0XX_ses-Y_func_<moving name>.json                     scan info
+        sub-0XX/ses-Y/func/_scan_info_subject_id0XX.sessionY.runZ_split_name_<moving name>/
+                                                    *mask.nii.gz and *ref.nii.gz     mask and reference
+
+    The session folder is optional. The index of a dataset is saved to a cache file
+    holding the modification time of every folder that was read. Adding or removing
+    a file changes the modification time of its folder, so only the subjects whose
+    folders changed are read again on the next run.
+
+    Runs missing some of their files are reported instead of stopping the whole run.
+'''
+
+import json, os, re
+
+DATASET_INDEX_FILENAME = ".hmc_dataset_index.json"
+INDEX_VERSION = 1
+RUN_FILES = ('moving', 'mask', 'scan_info', 'reference')
+RUN_ENTITY = re.compile(r'_run-([a-zA-Z0-9]+)')
+
+def listFolder(path : str, folders):
+    folders[path] = os.stat(path).st_mtime_ns
+    with os.scandir(path) as entries:
+        return sorted((entry.name, entry.is_dir()) for entry in entries)
+
+# Scan info folder or json file of a moving image, matched on the name of the moving image. When
+# the names do not match, the only candidate of the folder is used.
+def matchRunFile(candidates, stem : str):
+    matching = [name for name in candidates if name.endswith(stem) or name.endswith(stem + '.json')]
+    if len(matching) == 0 and len(candidates) == 1:
+        matching = candidates
+    return matching[0] if len(matching) > 0 else None
+
+def indexFunc(func_folder : str, subject : str, session, folders):
+    entries = listFolder(func_folder, folders)
+    movings = [name for name, is_dir in entries if not is_dir and name.endswith('.nii.gz')]
+    scan_infos = [name for name, is_dir in entries if not is_dir and name.endswith('.json')]
+    scan_info_folders = [name for name, is_dir in entries if is_dir and name.startswith('_scan_info_subject_id')]
+    runs = []
+    for moving in movings:
+        stem = moving[:-len('.nii.gz')]
+        run_entity = RUN_ENTITY.search(stem)
+        run = {"subject"   : subject,
+               "session"   : session,
+               "run"       : run_entity.group(1) if run_entity else None,
+               "func"      : func_folder,
+               "moving"    : os.path.join(func_folder, moving),
+               "scan_info" : None,
+               "mask"      : None,
+               "reference" : None}
+        scan_info = matchRunFile(scan_infos, stem)
+        if scan_info is not None:
+            run["scan_info"] = os.path.join(func_folder, scan_info)
+        scan_info_folder = matchRunFile(scan_info_folders, stem)
+        if scan_info_folder is not None:
+            scan_info_path = os.path.join(func_folder, scan_info_folder)
+            for name, is_dir in listFolder(scan_info_path, folders):
+                if not is_dir and name.endswith('mask.nii.gz'):
+                    run["mask"] = os.path.join(scan_info_path, name)
+                elif not is_dir and name.endswith('ref.nii.gz'):
+                    run["reference"] = os.path.join(scan_info_path, name)
+        runs.append(run)
+    if len(movings) == 0:
+        runs.append({"subject" : subject, "session" : session, "run" : None, "func" : func_folder,
+                     "moving" : None, "scan_info" : None, "mask" : None, "reference" : None})
+    return runs
+
+# Runs of a subject folder, together with the modification time of the folders read
+def indexSubject(subject_folder : str):
+    subject_folder = os.path.normpath(subject_folder)
+    subject = os.path.basename(subject_folder)
+    folders = {}
+    runs = []
+    entries = listFolder(subject_folder, folders)
+    sessions = [name for name, is_dir in entries if is_dir and name.startswith('ses-')]
+    if len(sessions) == 0 and ('func', True) in entries:
+        runs += indexFunc(os.path.join(subject_folder, 'func'), subject, None, folders)
+    for session in sessions:
+        session_folder = os.path.join(subject_folder, session)
+        if ('func', True) in listFolder(session_folder, folders):
+            runs += indexFunc(os.path.join(session_folder, 'func'), subject, session, folders)
+        else:
+            runs.append({"subject" : subject, "session" : session, "run" : None, "func" : os.path.join(session_folder, 'func'),
+                         "moving" : None, "scan_info" : None, "mask" : None, "reference" : None})
+    if len(runs) == 0:
+        runs.append({"subject" : subject, "session" : None, "run" : None, "func" : os.path.join(subject_folder, 'ses-*', 'func'),
+                     "moving" : None, "scan_info" : None, "mask" : None, "reference" : None})
+    for run in runs:
+        run["folder"] = subject_folder
+    return runs, folders
+
+def unchanged(folders):
+    for path, mtime in folders.items():
+        try:
+            if os.stat(path).st_mtime_ns != mtime:
+                return False
+        except OSError:
+            return False
+    return True
+
+def loadIndex(cache_path : str, input_folder : str):
+    try:
+        with open(cache_path, 'r') as cache_fp:
+            index = json.load(cache_fp)
+    except (OSError, ValueError):
+        return None
+    if index.get("version") != INDEX_VERSION or index.get("input_folder") != input_folder:
+        return None
+    return index
+
+def saveIndex(cache_path : str, index):
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as tmp_fp:
+            json.dump(index, tmp_fp)
+        os.replace(tmp_path, cache_path)
+    except OSError as error:
+        print(f"[ WARNING ] - Failed to save the dataset index to {cache_path}: {error}")
+
+# Runs of every sub-* folder of a dataset. Subjects whose folders are unchanged since the index
+# was cached are taken from the cache file when one is given.
+def indexDataset(input_folder : str, cache_path = None):
+    input_folder = os.path.abspath(input_folder)
+    cached = loadIndex(cache_path, input_folder) if cache_path is not None else None
+    cached_subjects = cached["subjects"] if cached is not None else {}
+    index = {"version" : INDEX_VERSION, "input_folder" : input_folder, "subjects" : {}}
+    rescanned = 0
+    with os.scandir(input_folder) as entries:
+        subject_folders = sorted(entry.path for entry in entries if entry.is_dir() and entry.name.startswith('sub-'))
+    for subject_folder in subject_folders:
+        entry = cached_subjects.get(subject_folder)
+        if entry is None or not unchanged(entry["folders"]):
+            runs, folders = indexSubject(subject_folder)
+            entry = {"runs" : runs, "folders" : folders}
+            rescanned += 1
+        index["subjects"][subject_folder] = entry
+    if cache_path is not None and (rescanned > 0 or cached is None or len(cached_subjects) != len(subject_folders)):
+        saveIndex(cache_path, index)
+    print(f"Indexed {len(subject_folders)} subjects of {input_folder} ({rescanned} read, {len(subject_folders) - rescanned} from the index cache)")
+    return [run for entry in index["subjects"].values() for run in entry["runs"]]
+
+def defaultIndexCache(output_folder : str):
+    return os.path.join(os.path.abspath(output_folder), DATASET_INDEX_FILENAME)
+
+# Name of each run, with the session and run entities only for subjects with several runs so that
+# the outputs of single run subjects keep their sub-0XX name
+def runNames(runs):
+    counts = {}
+    for run in runs:
+        if run["moving"] is not None:
+            counts[run["subject"]] = counts.get(run["subject"], 0) + 1
+    names = []
+    for run in runs:
+        name = run["subject"]
+        if counts.get(run["subject"], 0) > 1:
+            if run["session"] is not None:
+                name += '_' + run["session"]
+            if run["run"] is not None:
+                name += '_run-' + run["run"]
+        names.append(name)
+    return names
+
+def missingFiles(run, required = RUN_FILES):
+    return [name for name in required if run.get(name) is None]
+
+# Complete runs, named after runNames. The runs missing some of the required files are reported.
+def completeRuns(runs, required = RUN_FILES):
+    complete = []
+    incomplete = []
+    for run, name in zip(runs, runNames(runs)):
+        run = dict(run, name=name)
+        missing = missingFiles(run, required)
+        if len(missing) == 0:
+            complete.append(run)
+        else:
+            incomplete.append((run, missing))
+    if len(incomplete) > 0:
+        print(f"[ WARNING ] - Skipping {len(incomplete)} incomplete runs:")
+        for run, missing in incomplete:
+            print(f"    {run['name']} : missing {', '.join(missing)} in {run['func']}")
+    return complete
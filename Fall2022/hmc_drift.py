@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+'''
+    Drift estimation of the motion parameters of many subjects at once. The seven
+    traces of each subject, the 6 rigid parameters against the frame index and the
+    framewise displacement without its first frame, are concatenated into one ragged
+    array and the least-squares line of every trace is computed in a single
+    vectorized pass, the sums of the traces being gathered with np.bincount. For the frames 0 .. n-1 of a trace the mean and the
+    spread of the frame index have a closed form,
+
+        x_mean = (n - 1) / 2        Sxx = n (n^2 - 1) / 12
+
+    so that the slope is sum((x - x_mean) y) / Sxx and the intercept
+    y_mean - slope x_mean, without a solve per trace.
+
+    The least-squares slopes are swung by a single motion spike, so robust estimators
+    can be selected instead, vectorized the same way over the ragged traces:
+     - theil_sen       : median of the slopes between pairs of frames. All the pairs are
+                         used for short traces, and THEIL_SEN_PAIRS random pairs for
+                         long ones, keeping the cost linear in the number of frames
+     - repeated_median : median over the frames of the median slope to the other
+                         frames, on up to REPEATED_MEDIAN_POINTS random frames and
+                         partners per frame for long traces
+     - huber           : Huber M-estimator fitted by iteratively reweighted least
+                         squares, the scale being the MAD of the residuals
+    The intercept of the median estimators is the median of y - slope x.
+
+    Run as a script, the drift table of every output folder found under a folder is
+    written to a CSV file, with the columns used by combined_analysis.py:
+
+        python3 hmc_drift.py <dataset output folder> -o drift_table.csv [--drift_estimator theil_sen]
+'''
+
+import argparse, csv, glob, os
+from hmc_loaders import loadSubjectsMotion
+
+DRIFT_NAMES = ['Drift Rotation X', 'Drift Rotation Y', 'Drift Rotation Z',
+               'Drift Translation X', 'Drift Translation Y', 'Drift Translation Z', 'Drift Framewise']
+INTERCEPT_NAMES = [name.replace('Drift', 'Intercept') for name in DRIFT_NAMES]
+DRIFT_TABLE_FIELDNAMES = ['Output', 'Dataset', 'Algorithm Version', 'Frames'] + DRIFT_NAMES + INTERCEPT_NAMES + ['Framewise Displacement STD']
+DRIFT_ESTIMATORS = ('ols', 'theil_sen', 'repeated_median', 'huber')
+THEIL_SEN_PAIRS = 20000
+REPEATED_MEDIAN_POINTS = 128
+HUBER_K = 1.345
+HUBER_ITERATIONS = 50
+MAD_SCALE = 0.6744897501960817 # MAD of the standard normal distribution
+# Maximum number of pairwise slopes held in memory at once, the traces being processed in chunks
+CHUNK_ELEMENTS = 8000000
+SEED = 0
+
+def parseArguments():
+    parser = argparse.ArgumentParser(description='Drift table of the motion corrected subjects of one or several datasets', formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('input_folder', help='Folder searched for the output folders of the subjects (holding motcorrMOCOparams.csv)')
+    parser.add_argument('-o', '--output', default='drift_table.csv', help='CSV file receiving the drift table (default: drift_table.csv)')
+    parser.add_argument('--drift_estimator', choices=DRIFT_ESTIMATORS, default='ols', help='Estimator of the drift slopes (default: ols)')
+    return parser.parse_args()
+
+# The 7 drift traces of a subject: the rigid parameters and the framewise displacement without its first frame
+def driftTraces(parameters, fd):
+    return [parameters[:, index] for index in range(parameters.shape[1])] + [fd[1:]]
+
+# Ragged array of the traces of the subjects, concatenated one after the other, and their (subjects, traces) lengths
+def concatTraces(subjects_traces):
+    import numpy as np
+    traces = max(len(subject_traces) for subject_traces in subjects_traces)
+    lengths = np.zeros((len(subjects_traces), traces), dtype=np.int64)
+    for subject, subject_traces in enumerate(subjects_traces):
+        lengths[subject, :len(subject_traces)] = [len(trace) for trace in subject_traces]
+    values = np.concatenate([np.asarray(trace, dtype=np.float64) for subject_traces in subjects_traces for trace in subject_traces] + [np.zeros(0)])
+    return values, lengths
+
+# Least-squares slopes and intercepts of the ragged traces against their frame index, in the shape of the
+# lengths. Traces with less than 2 frames have no drift (nan).
+def linearDrift(values, lengths):
+    import numpy as np
+    counts = lengths.ravel()
+    n = counts.astype(np.float64)
+    trace = np.repeat(np.arange(len(counts)), counts)
+    frames = np.arange(len(values), dtype=np.float64) - np.repeat(np.cumsum(counts) - counts, counts)
+    x_mean = (n - 1) / 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        y_mean = np.bincount(trace, weights=values, minlength=len(counts)) / n
+        # Both the frame index and the trace are centered, to avoid the cancellation of large sums
+        s_xy = np.bincount(trace, weights=(values - y_mean[trace]) * (frames - x_mean[trace]), minlength=len(counts))
+        slopes = np.where(n >= 2, s_xy / (n * (n ** 2 - 1) / 12), np.nan)
+    return slopes.reshape(lengths.shape), (y_mean - slopes * x_mean).reshape(lengths.shape)
+
+# Trace of each element of a ragged array with the given trace lengths, its position in its trace and the
+# start of each trace
+def raggedIndex(counts):
+    import numpy as np
+    starts = np.cumsum(counts) - counts
+    trace = np.repeat(np.arange(len(counts)), counts)
+    return trace, np.arange(len(trace)) - starts[trace], starts
+
+# Median of each trace of a ragged array whose elements are grouped by trace, nan for the empty traces. The
+# traces are laid in the rows of a matrix padded with -inf before and +inf after their values, so that the
+# middle elements of every trace land in the same two columns and a single np.partition finds them all.
+def raggedMedian(values, trace, traces : int):
+    import numpy as np
+    counts = np.bincount(trace, minlength=traces)
+    middle = int(counts.max()) // 2 if traces > 0 else 0
+    before = middle - (counts - 1) // 2
+    padded = np.full((traces, 2 * middle + 2), np.inf)
+    padded[np.arange(2 * middle + 2)[None, :] < before[:, None]] = -np.inf
+    starts = np.cumsum(counts) - counts
+    padded[trace, before[trace] + np.arange(len(trace)) - starts[trace]] = values
+    padded.partition([middle, middle + 1], axis=1)
+    with np.errstate(invalid='ignore'):
+        median = np.where(counts % 2 == 1, padded[:, middle], (padded[:, middle] + padded[:, middle + 1]) / 2)
+    median[counts == 0] = np.nan
+    return median
+
+# Median of y - slope x of each trace, nan for the traces without a slope
+def medianIntercepts(values, counts, slopes):
+    import numpy as np
+    trace, frames, _ = raggedIndex(counts)
+    intercepts = raggedMedian(values - slopes[trace] * frames, trace, len(counts))
+    intercepts[np.isnan(slopes)] = np.nan
+    return intercepts
+
+# Pair k of the triangular enumeration (0, 1), (0, 2), (1, 2), (0, 3)...
+def trianglePairs(k):
+    import numpy as np
+    j = np.floor((1 + np.sqrt(1 + 8 * k.astype(np.float64))) / 2).astype(np.int64)
+    j -= j * (j - 1) // 2 > k
+    j += (j + 1) * j // 2 <= k
+    return k - j * (j - 1) // 2, j
+
+# Uniform pairs of distinct frames of traces of n frames, the slope not depending on their order
+def randomPairs(n, rng):
+    import numpy as np
+    uniform = rng.random_sample((2, len(n)))
+    i = (uniform[0] * n).astype(np.int64)
+    j = (uniform[1] * (n - 1)).astype(np.int64)
+    j += j >= i
+    return i, j
+
+# Pairs of distinct frames (i, j) of each trace: all the pairs when there are at most `pairs`, else random ones
+def samplePairs(counts, pairs : int, rng):
+    import numpy as np
+    total = counts * (counts - 1) // 2
+    pair_trace, k, _ = raggedIndex(np.minimum(total, pairs))
+    sampled = total[pair_trace] > pairs
+    if not sampled.any():
+        return (pair_trace, ) + trianglePairs(k)
+    if sampled.all():
+        return (pair_trace, ) + randomPairs(counts[pair_trace], rng)
+    i, j = trianglePairs(k)
+    i[sampled], j[sampled] = randomPairs(counts[pair_trace][sampled], rng)
+    return pair_trace, i, j
+
+def theilSenChunk(values, counts, rng):
+    import numpy as np
+    _, _, starts = raggedIndex(counts)
+    pair_trace, i, j = samplePairs(counts, THEIL_SEN_PAIRS, rng)
+    start = starts[pair_trace]
+    slopes = raggedMedian((values[start + j] - values[start + i]) / (j - i), pair_trace, len(counts))
+    slopes[counts < 2] = np.nan
+    return slopes, medianIntercepts(values, counts, slopes)
+
+def repeatedMedianChunk(values, counts, rng):
+    import numpy as np
+    _, _, starts = raggedIndex(counts)
+    # Anchor frames of each trace, all of them for short traces
+    anchor_trace, anchor, _ = raggedIndex(np.minimum(counts, REPEATED_MEDIAN_POINTS))
+    sampled = counts[anchor_trace] > REPEATED_MEDIAN_POINTS
+    anchor[sampled] = (rng.random_sample(int(sampled.sum())) * counts[anchor_trace][sampled]).astype(np.int64)
+    # Partner frames of each anchor, other than the anchor
+    others = counts[anchor_trace] - 1
+    pair_anchor, partner, _ = raggedIndex(np.minimum(others, REPEATED_MEDIAN_POINTS))
+    sampled = others[pair_anchor] > REPEATED_MEDIAN_POINTS
+    partner[sampled] = (rng.random_sample(int(sampled.sum())) * others[pair_anchor][sampled]).astype(np.int64)
+    i = anchor[pair_anchor]
+    j = partner + (partner >= i)
+    start = starts[anchor_trace][pair_anchor]
+    anchor_slopes = raggedMedian((values[start + j] - values[start + i]) / (j - i), pair_anchor, len(anchor_trace))
+    slopes = raggedMedian(anchor_slopes, anchor_trace, len(counts))
+    slopes[counts < 2] = np.nan
+    return slopes, medianIntercepts(values, counts, slopes)
+
+def huberChunk(values, counts, rng):
+    import numpy as np
+    trace, frames, _ = raggedIndex(counts)
+    weights = np.ones(len(values))
+    slopes = np.full(len(counts), np.nan)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for _ in range(HUBER_ITERATIONS):
+            # Weighted least-squares line of each trace, about the weighted means
+            sum_w = np.bincount(trace, weights=weights, minlength=len(counts))
+            x_mean = np.bincount(trace, weights=weights * frames, minlength=len(counts)) / sum_w
+            y_mean = np.bincount(trace, weights=weights * values, minlength=len(counts)) / sum_w
+            dx = frames - x_mean[trace]
+            previous = slopes
+            slopes = (np.bincount(trace, weights=weights * dx * (values - y_mean[trace]), minlength=len(counts))
+                      / np.bincount(trace, weights=weights * dx * dx, minlength=len(counts)))
+            intercepts = y_mean - slopes * x_mean
+            residuals = np.abs(values - intercepts[trace] - slopes[trace] * frames)
+            scale = raggedMedian(residuals, trace, len(counts)) / MAD_SCALE
+            # Residuals within K scales keep their full weight, the others are down-weighted by K scale / |r|
+            weights = np.where(residuals > HUBER_K * scale[trace], HUBER_K * scale[trace] / residuals, 1.0)
+            if np.allclose(slopes, previous, rtol=1e-10, atol=0, equal_nan=True):
+                break
+    slopes[counts < 2] = np.nan
+    intercepts[counts < 2] = np.nan
+    return slopes, intercepts
+
+# Apply an estimator to chunks of consecutive traces, each holding at most CHUNK_ELEMENTS pairwise slopes
+def chunkedDrift(estimator, values, lengths, elements):
+    import numpy as np
+    counts = lengths.ravel()
+    _, _, starts = raggedIndex(counts)
+    slopes = np.full(len(counts), np.nan)
+    intercepts = np.full(len(counts), np.nan)
+    rng = np.random.RandomState(SEED)
+    first = 0
+    while first < len(counts):
+        last = first + 1
+        held = elements[first]
+        while last < len(counts) and held + elements[last] <= CHUNK_ELEMENTS:
+            held += elements[last]
+            last += 1
+        begin = starts[first]
+        end = starts[last - 1] + counts[last - 1]
+        slopes[first:last], intercepts[first:last] = estimator(values[begin:end], counts[first:last], rng)
+        first = last
+    return slopes.reshape(lengths.shape), intercepts.reshape(lengths.shape)
+
+# Slopes and intercepts of the ragged traces with the selected estimator, in the shape of the lengths
+def fitDrift(values, lengths, estimator : str = 'ols'):
+    import numpy as np
+    counts = lengths.ravel().astype(np.int64)
+    if estimator == 'ols':
+        return linearDrift(values, lengths)
+    if estimator == 'theil_sen':
+        return chunkedDrift(theilSenChunk, values, lengths, np.minimum(counts * (counts - 1) // 2, THEIL_SEN_PAIRS) + counts)
+    if estimator == 'repeated_median':
+        points = np.minimum(counts, REPEATED_MEDIAN_POINTS)
+        return chunkedDrift(repeatedMedianChunk, values, lengths, points * np.minimum(np.maximum(counts - 1, 0), REPEATED_MEDIAN_POINTS) + counts)
+    if estimator == 'huber':
+        return chunkedDrift(huberChunk, values, lengths, counts)
+    raise ValueError(f"Unknown drift estimator {estimator}, expected one of {', '.join(DRIFT_ESTIMATORS)}")
+
+# Slopes and intercepts of the 7 drift traces of one subject
+def subjectDrift(parameters, fd, estimator : str = 'ols'):
+    slopes, intercepts = fitDrift(*concatTraces([driftTraces(parameters, fd)]), estimator)
+    return slopes[0], intercepts[0]
+
+# Drift table of the output folders: a dictionary of columns, one row per subject whose tables could be loaded
+def driftTable(outputs, estimator : str = 'ols'):
+    import numpy as np
+    loaded = [(output, motion) for output, motion in loadSubjectsMotion(outputs).items() if motion is not None]
+    table = {name : [] for name in DRIFT_TABLE_FIELDNAMES}
+    if len(loaded) == 0:
+        return table
+    slopes, intercepts = fitDrift(*concatTraces([driftTraces(parameters, fd) for _, (parameters, fd) in loaded]), estimator)
+    for output, (parameters, fd) in loaded:
+        table['Output'].append(output)
+        # As in combined_analysis.py, the dataset is the folder holding the subject folders
+        table['Dataset'].append(os.path.join(output, 'analysis_data.csv').split('/')[-4])
+        table['Algorithm Version'].append('new' if os.path.exists(os.path.join(output, "new_ants.txt")) else 'old')
+        table['Frames'].append(parameters.shape[0])
+        table['Framewise Displacement STD'].append(float(np.std(fd)))
+    for index, (drift_name, intercept_name) in enumerate(zip(DRIFT_NAMES, INTERCEPT_NAMES)):
+        table[drift_name] = slopes[:, index].tolist()
+        table[intercept_name] = intercepts[:, index].tolist()
+    return table
+
+def writeDriftTable(table, path : str):
+    with open(path, 'w') as table_fp:
+        table_w = csv.writer(table_fp, delimiter=',', quotechar='|')
+        table_w.writerow(DRIFT_TABLE_FIELDNAMES)
+        table_w.writerows(zip(*[table[name] for name in DRIFT_TABLE_FIELDNAMES]))
+
+def findOutputs(input_folder : str):
+    return sorted(os.path.dirname(os.path.abspath(motcorr_csv))
+                  for motcorr_csv in glob.glob(os.path.join(input_folder, "**/motcorrMOCOparams.csv"), recursive=True))
+
+if __name__ == "__main__":
+    args = parseArguments()
+    outputs = findOutputs(args.input_folder)
+    table = driftTable(outputs, args.drift_estimator)
+    writeDriftTable(table, args.output)
+    print(f"Drift table of {len(table['Output'])} of {len(outputs)} subjects written to {args.output}")
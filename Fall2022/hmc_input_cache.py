@@ -0,0 +1,63 @@
+'''
+    Cache of the products derived from the input timeseries alone, shared by every
+    configuration run on the same subject (old ANTs, new ANTs, performance...). The
+    products of an input are stored in a folder named after the SHA-256 of the input
+    file, so that they are computed once per input content no matter how many output
+    subfolders are analysed, and recomputed as soon as the input changes.
+
+    A lock per input makes concurrent analyses of the same input compute the
+    products once, the other analyses waiting for them.
+'''
+
+import fcntl, json, os, shutil
+
+INPUT_CACHE_FOLDER = ".hmc_input_cache"
+CACHE_VERSION = 1
+CACHE_INFO_FILENAME = "cache_info.json"
+
+# The cache is shared by the subfolders of the subjects of a dataset. In single subject mode, the
+# output folder already holds the subfolder so the cache goes one level up.
+def defaultInputCache(output_folder : str, dataset : bool):
+    root = os.path.abspath(output_folder)
+    return os.path.join(root if dataset else os.path.dirname(root), INPUT_CACHE_FOLDER)
+
+class InputCache:
+
+    def __init__(self, root : str):
+        self.root = root
+
+    # Folder holding the products of the input with the given digest. compute(folder) writes
+    # them to the folder when they are not cached yet.
+    def products(self, digest : str, moving : str, compute):
+        folder = os.path.join(self.root, digest)
+        os.makedirs(self.root, exist_ok=True)
+        with open(folder + '.lock', 'w') as lock_fp:
+            fcntl.flock(lock_fp, fcntl.LOCK_EX)
+            if self._valid(folder):
+                print(f"Reusing the input products of {moving} from {folder}")
+                return folder
+            shutil.rmtree(folder, ignore_errors=True)
+            tmp_folder = f"{folder}.{os.getpid()}.tmp"
+            shutil.rmtree(tmp_folder, ignore_errors=True)
+            os.makedirs(tmp_folder)
+            compute(tmp_folder)
+            with open(os.path.join(tmp_folder, CACHE_INFO_FILENAME), 'w') as info_fp:
+                json.dump({"version" : CACHE_VERSION, "moving" : moving}, info_fp, indent=2)
+            os.rename(tmp_folder, folder)
+        return folder
+
+    def _valid(self, folder : str):
+        try:
+            with open(os.path.join(folder, CACHE_INFO_FILENAME), 'r') as info_fp:
+                return json.load(info_fp)["version"] == CACHE_VERSION
+        except (OSError, ValueError, KeyError):
+            return False
+
+# Place a cached product in an output folder, as a hard link when the filesystem allows it
+def linkProduct(cached : str, destination : str):
+    if os.path.lexists(destination):
+        os.remove(destination)
+    try:
+        os.link(cached, destination)
+    except OSError:
+        shutil.copyfile(cached, destination)
@@ -0,0 +1,75 @@
+'''
+    Loaders of the numeric tables written by the motion correction: the rigid
+    parameters of motcorrMOCOparams.csv, the framewise displacement of
+    FD_calculations.csv and the mov_params.csv of the analysis. The body of a table
+    is parsed in one vectorized pass into a float64 array, instead of one array
+    stacked per row, so that loading a 10k-frame timeseries, or every subject of a
+    dataset, stays fast. The columns are kept by their header name.
+'''
+
+import csv, os
+from concurrent.futures import ThreadPoolExecutor
+
+LOADER_THREADS = 16
+RIGID_PARAMETERS = 6
+
+# Float64 table whose columns are accessed by their header name
+class CsvTable:
+
+    def __init__(self, columns, data):
+        self.columns = columns
+        self.data = data
+
+    def __getitem__(self, name : str):
+        return self.data[:, self.columns.index(name)]
+
+    def __len__(self):
+        return self.data.shape[0]
+
+def loadCsvTable(path : str, quotechar : str = '|'):
+    import numpy as np
+    with open(path, 'r') as csv_fp:
+        columns = next(csv.reader([csv_fp.readline()], delimiter=',', quotechar=quotechar))
+        rows = [line for line in csv_fp.read().splitlines() if line.strip() != '']
+    if len(rows) == 0:
+        return CsvTable(columns, np.zeros((0, len(columns))))
+    # Every row must hold the fields of the header, the whitespace around the fields being ignored by the
+    # float conversion of the joined rows
+    ragged = [row for row, line in enumerate(rows) if line.count(',') != len(columns) - 1]
+    if len(ragged) != 0:
+        raise ValueError(f"{path} has {len(ragged)} rows that do not have the {len(columns)} columns of its header, "
+                         f"the first one being row {ragged[0] + 1}")
+    values = np.array(','.join(rows).split(','), dtype=np.float64)
+    return CsvTable(columns, values.reshape(-1, len(columns)))
+
+# Table of motcorrMOCOparams.csv, the 6 rigid parameters being its last columns after the metric values
+def loadMotionTable(motcorr_csv : str):
+    table = loadCsvTable(motcorr_csv)
+    if len(table.columns) < RIGID_PARAMETERS:
+        raise ValueError(f"{motcorr_csv} has {len(table.columns)} columns instead of at least {RIGID_PARAMETERS} rigid parameters")
+    return table
+
+# Frames x 6 array of the rigid parameters (rotations about X, Y, Z then translations)
+def rigidParameters(table):
+    return table.data[:, -RIGID_PARAMETERS:]
+
+# Framewise displacement of each frame, from the first (mean) column of FD_calculations.csv
+def loadFramewiseDisplacement(fd_csv : str):
+    return loadCsvTable(fd_csv).data[:, 0]
+
+# Rigid parameters and framewise displacement of the output folders of several subjects, read in parallel
+# threads. Subjects whose tables are missing or malformed are None.
+def loadSubjectsMotion(outputs, threads : int = LOADER_THREADS):
+    def load(output):
+        try:
+            return (rigidParameters(loadMotionTable(os.path.join(output, "motcorrMOCOparams.csv"))),
+                    loadFramewiseDisplacement(os.path.join(output, "FD_calculations.csv")))
+        except (OSError, ValueError) as error:
+            print(f"[ WARNING ] - Failed to load the motion parameters of {output}: {error}")
+            return None
+    outputs = list(outputs)
+    if len(outputs) == 0:
+        return {}
+    import numpy # Loaded once before the threads import it
+    with ThreadPoolExecutor(max_workers=max(1, min(threads, len(outputs)))) as executor:
+        return dict(zip(outputs, executor.map(load, outputs)))
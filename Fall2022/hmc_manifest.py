@@ -0,0 +1,155 @@
+'''
+    Per-subject manifest used to make the HMC runs resumable and incremental. The
+    hmc_manifest.json file of each subject output folder holds an entry for each
+    processing stage with:
+     - the paths and SHA-256 digests of the inputs of the stage
+     - the parameters of the stage (ANTs version and arguments, analysis version...)
+     - the SHA-256 digests of the outputs of the stage
+    A stage is only skipped when its entry is complete, its inputs and parameters
+    are unchanged and its outputs are still present and unmodified. The inputs of a
+    stage include the outputs of the previous stages, so redoing a stage makes the
+    following ones stale.
+
+    Digests are cached in the manifest by file size and modification time, so that
+    unchanged files are not read again on every run.
+'''
+
+import fcntl, hashlib, json, os, time
+
+MANIFEST_FILENAME = "hmc_manifest.json"
+HASH_CHUNK_SIZE = 4 * 1024 * 1024
+CLOCK_TOLERANCE = 60 # Seconds of clock skew allowed between the submitting node and the filesystem
+STAGES = ('motion_correction', 'fd_stats', 'analysis', 'figures')
+STAGE_OUTPUTS = {'motion_correction' : ['motcorrMOCOparams.csv', 'motcorr_warped.nii.gz', 'motcorr_avg.nii.gz'],
+                 'fd_stats'          : ['FD_calculations.csv'],
+                 'analysis'          : ['mov_params.csv', 'lin_reg_params.csv', 'analysis_data.csv',
+                                        'inputSTD.nii.gz', 'outputSTD.nii.gz', 'diffSTD.nii.gz'],
+                 'figures'           : ['temporal_features.png']}
+
+def sha256File(path : str):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file_fp:
+        for chunk in iter(lambda: file_fp.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class Manifest:
+
+    def __init__(self, output : str):
+        self.output = output
+        self.path = os.path.join(output, MANIFEST_FILENAME)
+        content = self._load()
+        self.stages = content["stages"]
+        self.files = content["files"]
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return {"stages" : {}, "files" : {}}
+        try:
+            with open(self.path, 'r') as manifest_fp:
+                content = json.load(manifest_fp)
+        except ValueError:
+            print(f"[ WARNING ] - Ignoring the corrupted manifest {self.path}")
+            return {"stages" : {}, "files" : {}}
+        content.setdefault("stages", {})
+        content.setdefault("files", {})
+        return content
+
+    # Write the given stage entry, merged with the entries written by other processes since the manifest was loaded
+    def _save(self, stage : str):
+        with open(self.path + '.lock', 'w') as lock_fp:
+            fcntl.flock(lock_fp, fcntl.LOCK_EX)
+            content = self._load()
+            if stage in self.stages:
+                content["stages"][stage] = self.stages[stage]
+            else:
+                content["stages"].pop(stage, None)
+            content["files"].update(self.files)
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w') as tmp_fp:
+                json.dump(content, tmp_fp, indent=2)
+            os.replace(tmp_path, self.path)
+            self.stages = content["stages"]
+            self.files = content["files"]
+
+    # SHA-256 of a file, None when it does not exist. Reuses the cached digest while the size and modification time are unchanged.
+    def digest(self, path : str):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        key = os.path.abspath(path)
+        cached = self.files.get(key)
+        if cached is not None and cached["size"] == stat.st_size and cached["mtime"] == stat.st_mtime_ns:
+            return cached["sha256"]
+        digest = sha256File(path)
+        self.files[key] = {"size" : stat.st_size, "mtime" : stat.st_mtime_ns, "sha256" : digest}
+        return digest
+
+    def _outputPaths(self, stage : str):
+        return {name : os.path.join(self.output, name) for name in STAGE_OUTPUTS[stage]}
+
+    # Reason why the stage must be executed again, None when its entry is still valid
+    def staleReason(self, stage : str, inputs, params):
+        entry = self.stages.get(stage)
+        if entry is None:
+            return "no manifest entry"
+        if entry.get("outputs") is None:
+            return "previous execution did not complete"
+        if entry["params"] != params:
+            changed = sorted(name for name in set(entry["params"]) | set(params) if entry["params"].get(name) != params.get(name))
+            return f"parameters changed ({', '.join(changed)})"
+        if sorted(entry["inputs"]) != sorted(inputs):
+            return "inputs changed"
+        for name, path in inputs.items():
+            if self.digest(path) != entry["inputs"][name]:
+                return f"input {name} changed"
+        for name, path in self._outputPaths(stage).items():
+            if self.digest(path) != entry["outputs"].get(name):
+                return f"output {name} missing or modified"
+        return None
+
+    # Record that the stage is about to be executed, its entry only becomes valid once finalized
+    def plan(self, stage : str, inputs, params):
+        self.stages[stage] = {"input_paths" : inputs, "params" : params, "inputs" : None, "outputs" : None, "planned" : time.time()}
+        self._save(stage)
+
+    # Complete the entry of a planned stage with the digests of its inputs and outputs, once it executed successfully
+    def finalize(self, stage : str):
+        entry = self.stages.get(stage)
+        if entry is None or entry.get("outputs") is not None:
+            return False
+        outputs = {name : self.digest(path) for name, path in self._outputPaths(stage).items()}
+        if None in outputs.values():
+            return False
+        entry["inputs"] = {name : self.digest(path) for name, path in entry["input_paths"].items()}
+        entry["outputs"] = outputs
+        entry["completed"] = time.time()
+        self._save(stage)
+        return True
+
+    # Finalize the planned stages whose outputs were all written after they were planned, for stages executed by batch jobs
+    def finalizePlanned(self):
+        finalized = []
+        for stage in STAGES:
+            entry = self.stages.get(stage)
+            if entry is None or entry.get("outputs") is not None:
+                continue
+            paths = self._outputPaths(stage).values()
+            if all(os.path.exists(path) and os.path.getmtime(path) >= entry["planned"] - CLOCK_TOLERANCE for path in paths):
+                if self.finalize(stage):
+                    finalized.append(stage)
+        return finalized
+
+    def record(self, stage : str, inputs, params):
+        self.plan(stage, inputs, params)
+        self.finalize(stage)
+
+    # Record the outputs of a stage executed before the manifest existed, when they are all present. The
+    # entry is marked as adopted since the parameters that produced the outputs are not known.
+    def adopt(self, stage : str, inputs, params):
+        if stage in self.stages or not all(os.path.exists(path) for path in self._outputPaths(stage).values()):
+            return False
+        self.plan(stage, inputs, params)
+        self.stages[stage]["adopted"] = True
+        return self.finalize(stage)
@@ -0,0 +1,93 @@
+'''
+    Memory estimation of the motion correction jobs used for admission control.
+    The peak memory of a subject is estimated from the dimensions and datatype in
+    the NIfTI header of its moving image, and scaled by the ratio between the
+    actual peak resident memory and the estimate observed for previous subjects.
+    The actual peak of each job is measured by sampling the resident memory of
+    its process tree in /proc.
+'''
+
+import glob, json, os
+
+MEMORY_FILENAME = "memory_usage.json"
+FLOAT_BYTES = 4
+BASE_BYTES = 256 * 1024 ** 2
+SAFETY_MARGIN = 1.2
+GIGABYTE = 1024 ** 3
+
+# The 4D input in its file datatype, plus the float input and warped output held by ANTs
+def headerEstimate(moving : str):
+    import nibabel as nb
+    header = nb.load(moving).header
+    shape = header.get_data_shape()
+    voxels = int(shape[0] * shape[1] * shape[2]) * (shape[3] if len(shape) > 3 else 1)
+    return BASE_BYTES + voxels * (header.get_data_dtype().itemsize + 2 * FLOAT_BYTES)
+
+def physicalMemory():
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+# Default budget in GB
+def defaultMemoryBudget():
+    memory = physicalMemory()
+    return None if memory is None else 0.8 * memory / GIGABYTE
+
+def recordMemoryUsage(output : str, estimate, peak_rss):
+    with open(os.path.join(output, MEMORY_FILENAME), 'w') as memory_fp:
+        json.dump({"header_estimate" : estimate, "peak_rss" : peak_rss}, memory_fp, indent=2)
+
+class MemoryModel:
+
+    # The scale is the largest ratio observed between the measured peak and the header estimate,
+    # with a margin for the peaks missed between two samples, so that the refined estimates stay
+    # on the safe side
+    def __init__(self, ratios):
+        self.ratios = ratios
+        self.scale = SAFETY_MARGIN * max(ratios) if len(ratios) != 0 else 1.0
+
+    @classmethod
+    def fromHistory(cls, folders):
+        ratios = []
+        for folder in folders:
+            for memory_file in glob.glob(os.path.join(folder, "**", MEMORY_FILENAME), recursive=True):
+                with open(memory_file, 'r') as memory_fp:
+                    usage = json.load(memory_fp)
+                if usage.get("peak_rss") and usage.get("header_estimate"):
+                    ratios.append(usage["peak_rss"] / usage["header_estimate"])
+        return cls(ratios)
+
+    def predict(self, header_estimate : int):
+        return int(header_estimate * self.scale)
+
+# Resident memory in bytes of the process trees rooted at the given pids, from a single scan of /proc
+def processTreeRss(roots):
+    if not os.path.isdir('/proc'):
+        return {}
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    children = {}
+    rss = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat', 'r') as stat_fp:
+                stat = stat_fp.read()
+            with open(f'/proc/{entry}/statm', 'r') as statm_fp:
+                resident = int(statm_fp.read().split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        ppid = int(stat[stat.rindex(')') + 2:].split()[1])
+        children.setdefault(ppid, []).append(int(entry))
+        rss[int(entry)] = resident * page_size
+    totals = {}
+    for root in roots:
+        total = 0
+        stack = [root]
+        while len(stack) != 0:
+            pid = stack.pop()
+            total += rss.get(pid, 0)
+            stack.extend(children.get(pid, []))
+        totals[root] = total
+    return totals
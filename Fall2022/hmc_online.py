@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+'''
+    Online monitoring of the motion of an acquisition, frame by frame, while the
+    motion parameters are produced. The rows of a growing motcorrMOCOparams.csv are
+    followed as they are appended (or read from the standard input with -m -, for
+    frames exported by the scanner side), and the seven drift slopes fitted by the
+    analysis of HMC_isolated.py are updated with each frame:
+     - the slope of each of the 6 rigid parameters against the frame index
+     - the slope of the framewise displacement, without its first frame
+    together with the running STD of the framewise displacement.
+
+    Each least-squares slope is updated in O(1) from the running means and co-moments
+    of the frame index and the parameter (Welford updates, which avoid the
+    cancellation of the raw sums), so that after the last frame the slopes are the
+    ones of the full fit. The framewise displacement is computed on the frame
+    transforms as the mean displacement of the voxels of the mask between consecutive
+    frames, since FD_calculations.csv is only written once the run is over.
+
+    An alert is printed as soon as a slope or the FD STD exceeds its threshold, once
+    --min_frames frames are in, so that a drifting acquisition is flagged while the
+    animal is still in the magnet.
+
+        python3 hmc_online.py -m <output>/motcorrMOCOparams.csv -x <mask> -r <reference> --translation_threshold 1e-4 [-o online_drift.csv]
+'''
+
+import argparse, csv, math, os, sys, time
+
+DRIFT_NAMES = ['Drift Rotation X', 'Drift Rotation Y', 'Drift Rotation Z',
+               'Drift Translation X', 'Drift Translation Y', 'Drift Translation Z', 'Drift Framewise']
+ONLINE_FIELDNAMES = ['Frame'] + DRIFT_NAMES + ['Framewise Displacement', 'Framewise Displacement STD']
+FD_SAMPLE_POINTS = 20000
+
+def parseArguments():
+    parser = argparse.ArgumentParser(description='Online drift monitoring of the motion parameters of an acquisition', formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('-m', '--motion', required=True, help='motcorrMOCOparams.csv followed as it grows, or - to read the rows from the standard input')
+    parser.add_argument('-x', '--mask', default=None, help='Mask on which the framewise displacement is computed, the framewise displacement is not monitored without it')
+    parser.add_argument('-r', '--reference', default=None, help='Reference image about whose center the rigid parameters are defined (default: the mask)')
+    parser.add_argument('-o', '--output', default=None, help='CSV file receiving the drift slopes and FD STD after each frame')
+    parser.add_argument('--rotation_threshold', type=float, default=None, help='Alert when the drift of a rotation exceeds this slope (per frame)')
+    parser.add_argument('--translation_threshold', type=float, default=None, help='Alert when the drift of a translation exceeds this slope (per frame)')
+    parser.add_argument('--fd_drift_threshold', type=float, default=None, help='Alert when the drift of the framewise displacement exceeds this slope (per frame)')
+    parser.add_argument('--fd_std_threshold', type=float, default=None, help='Alert when the STD of the framewise displacement exceeds this value')
+    parser.add_argument('--fd_threshold', type=float, default=None, help='Alert on every frame whose framewise displacement exceeds this value')
+    parser.add_argument('--min_frames', type=int, default=20, help='Number of frames before the drift alerts are raised (default: 20)')
+    parser.add_argument('--poll_seconds', type=float, default=1, help='Time between two reads of the growing files (default: 1)')
+    parser.add_argument('--idle_seconds', type=float, default=300, help='Stop once no frame was appended for this time (default: 300)')
+    return parser.parse_args()
+
+# Least-squares line y = m x + c updated one point at a time
+class OnlineLinearFit:
+
+    def __init__(self):
+        self.n = 0
+        self.mean_x = 0.0
+        self.mean_y = 0.0
+        self.m2_x = 0.0
+        self.c_xy = 0.0
+
+    def update(self, x : float, y : float):
+        self.n += 1
+        dx = x - self.mean_x
+        self.mean_x += dx / self.n
+        self.mean_y += (y - self.mean_y) / self.n
+        self.m2_x += dx * (x - self.mean_x)
+        self.c_xy += dx * (y - self.mean_y)
+
+    def slope(self):
+        return self.c_xy / self.m2_x if self.m2_x > 0 else float('nan')
+
+    def intercept(self):
+        return self.mean_y - self.slope() * self.mean_x
+
+# Population STD updated one value at a time
+class RunningStd:
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def update(self, value : float):
+        self.n += 1
+        delta = value - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (value - self.mean)
+
+    def std(self):
+        return math.sqrt(self.m2 / self.n) if self.n > 0 else float('nan')
+
+# Framewise displacement between consecutive rigid transforms, averaged over a sample of the voxels of the mask
+class FramewiseDisplacement:
+
+    def __init__(self, mask : str, reference : str = None):
+        import SimpleITK as sitk
+        import numpy as np
+        from hmc_crop import gridCenter
+        mask_image = sitk.ReadImage(mask)
+        if mask_image.GetDimension() == 4:
+            mask_image = mask_image[:, :, :, 0]
+        indices = np.argwhere(sitk.GetArrayViewFromImage(mask_image) != 0)[:, ::-1].astype(np.float64)
+        indices = indices[::max(1, len(indices) // FD_SAMPLE_POINTS)]
+        direction = np.array(mask_image.GetDirection()).reshape(3, 3)
+        points = np.array(mask_image.GetOrigin()) + (indices * np.array(mask_image.GetSpacing())).dot(direction.T)
+        self.center = gridCenter(sitk.ReadImage(reference) if reference is not None else mask_image)
+        self.offsets = points - np.array(self.center)
+        self.previous = None
+
+    def update(self, parameters):
+        import SimpleITK as sitk
+        import numpy as np
+        transform = sitk.Euler3DTransform(self.center, *parameters[:3], parameters[3:6])
+        matrix = np.array(transform.GetMatrix()).reshape(3, 3)
+        translation = np.array(parameters[3:6])
+        previous, self.previous = self.previous, (matrix, translation)
+        if previous is None or len(self.offsets) == 0:
+            return 0.0
+        displacement = self.offsets.dot((matrix - previous[0]).T) + (translation - previous[1])
+        return float(np.sqrt((displacement ** 2).sum(axis=1)).mean())
+
+# Drift slopes and FD STD of the frames received so far, and the alerts raised on them
+class OnlineDriftMonitor:
+
+    def __init__(self, thresholds, min_frames : int = 20, fd_threshold : float = None):
+        self.thresholds = thresholds        # Drift name or 'Framewise Displacement STD' -> threshold
+        self.min_frames = min_frames
+        self.fd_threshold = fd_threshold
+        self.motion_fits = [OnlineLinearFit() for _ in range(6)]
+        self.fd_fit = OnlineLinearFit()
+        self.fd_std = RunningStd()
+        self.frames = 0
+        self.raised = set()
+
+    def drifts(self):
+        return [fit.slope() for fit in self.motion_fits] + [self.fd_fit.slope()]
+
+    def values(self):
+        return dict(zip(DRIFT_NAMES, self.drifts()), **{'Framewise Displacement STD' : self.fd_std.std()})
+
+    # Add the 6 rigid parameters and the framewise displacement of the next frame, returns the new alerts
+    def update(self, parameters, fd : float = None):
+        frame = self.frames
+        for fit, value in zip(self.motion_fits, parameters):
+            fit.update(frame, value)
+        if fd is not None:
+            # As in the analysis, the drift of the framewise displacement leaves out its first frame
+            if self.fd_std.n > 0:
+                self.fd_fit.update(self.fd_std.n - 1, fd)
+            self.fd_std.update(fd)
+        self.frames += 1
+        alerts = []
+        if fd is not None and self.fd_threshold is not None and fd > self.fd_threshold:
+            alerts.append(f"framewise displacement {fd:.4g} of frame {frame} above {self.fd_threshold:.4g}")
+        if self.frames < self.min_frames:
+            return alerts
+        for name, value in self.values().items():
+            threshold = self.thresholds.get(name)
+            if threshold is None or name in self.raised or math.isnan(value):
+                continue
+            if abs(value) > threshold:
+                self.raised.add(name)
+                alerts.append(f"{name} {value:.4g} above {threshold:.4g} after {self.frames} frames")
+        return alerts
+
+# Rows of a csv file as they are appended to it, skipping its header. Stops once the file did not grow for idle_seconds.
+def followCsv(path : str, poll_seconds : float, idle_seconds : float):
+    while path != '-' and not os.path.exists(path):
+        time.sleep(poll_seconds)
+    csv_fp = sys.stdin if path == '-' else open(path, 'r')
+    try:
+        header = True
+        pending = ''
+        last_frame = time.time()
+        while True:
+            line = csv_fp.readline()
+            if line == '':
+                if path == '-' or time.time() - last_frame > idle_seconds:
+                    return
+                time.sleep(poll_seconds)
+                continue
+            # A line still being written is completed by the next reads
+            pending += line
+            if not pending.endswith('\n'):
+                continue
+            line, pending = pending.strip(), ''
+            last_frame = time.time()
+            if line == '':
+                continue
+            if header:
+                header = False
+                continue
+            yield next(csv.reader([line], delimiter=',', quotechar='|'))
+    finally:
+        if csv_fp is not sys.stdin:
+            csv_fp.close()
+
+def monitorMotion(args):
+    thresholds = {'Framewise Displacement STD' : args.fd_std_threshold, 'Drift Framewise' : args.fd_drift_threshold}
+    for axis in ('X', 'Y', 'Z'):
+        thresholds[f'Drift Rotation {axis}'] = args.rotation_threshold
+        thresholds[f'Drift Translation {axis}'] = args.translation_threshold
+    monitor = OnlineDriftMonitor(thresholds, args.min_frames, args.fd_threshold)
+    displacement = FramewiseDisplacement(args.mask, args.reference) if args.mask is not None else None
+    output_fp = open(args.output, 'w') if args.output is not None else None
+    output_w = csv.writer(output_fp, delimiter=',', quotechar='|') if output_fp is not None else None
+    if output_w is not None:
+        output_w.writerow(ONLINE_FIELDNAMES)
+    alerts = 0
+    try:
+        for row in followCsv(args.motion, args.poll_seconds, args.idle_seconds):
+            # The 6 rigid parameters are the last columns, after the metric values
+            parameters = [float(value) for value in row[-6:]]
+            fd = displacement.update(parameters) if displacement is not None else None
+            for alert in monitor.update(parameters, fd):
+                print(f"[ WARNING ] - {args.motion}: {alert}")
+                alerts += 1
+            if output_w is not None:
+                values = monitor.values()
+                output_w.writerow([monitor.frames - 1] + [values[name] for name in DRIFT_NAMES] + [fd if fd is not None else '', values['Framewise Displacement STD']])
+                output_fp.flush()
+    finally:
+        if output_fp is not None:
+            output_fp.close()
+    values = monitor.values()
+    print(f"Monitored {monitor.frames} frames of {args.motion}, {alerts} alerts")
+    for name in DRIFT_NAMES + ['Framewise Displacement STD']:
+        print(f"    {name} : {values[name]:.6g}")
+    return 0
+
+if __name__ == "__main__":
+    args = parseArguments()
+    sys.exit(monitorMotion(args))
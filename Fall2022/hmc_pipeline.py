@@ -0,0 +1,71 @@
+'''
+    Producer/consumer pipeline overlapping the motion correction of the next
+    subjects with the analysis of the subjects already corrected. Analyses are
+    executed by a pool of worker processes and the number of analyses queued or
+    running at any time is bounded, so that memory use stays predictable no
+    matter how far ahead the motion correction gets.
+'''
+
+import multiprocessing, threading, traceback
+
+# Executed in the worker processes. Exceptions are returned as text since tracebacks
+# do not survive the trip back to the parent process.
+def runAnalysisTask(function, args):
+    try:
+        function(*args)
+        return None
+    except Exception:
+        return traceback.format_exc()
+
+class AnalysisPipeline:
+
+    # The workers are forked on creation, so the pipeline should be created before
+    # any other thread is started in the process.
+    # on_done(name) is called once the analysis of a subject finished, successfully or not
+    def __init__(self, function, workers : int = 1, max_queued : int = 2, on_done=None):
+        self.function = function
+        self.on_done = on_done
+        self.workers = max(1, workers)
+        self._slots = threading.BoundedSemaphore(self.workers + max(0, max_queued))
+        self._pool = multiprocessing.get_context('fork').Pool(self.workers)
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._running = 0
+        self.failed = []
+        self.completed = 0
+
+    # Queue the analysis of a subject. Blocks while the queue is full.
+    def submit(self, name : str, *args):
+        self._slots.acquire()
+        with self._lock:
+            self._running += 1
+        self._pool.apply_async(runAnalysisTask, (self.function, args),
+                               callback=lambda error: self._done(name, error),
+                               error_callback=lambda exception: self._done(name, repr(exception)))
+
+    def _done(self, name, error):
+        with self._lock:
+            if error is None:
+                self.completed += 1
+            else:
+                print(f"[ WARNING ] - Analysis failed for {name}:\n{error}")
+                self.failed.append(name)
+        if self.on_done is not None:
+            self.on_done(name)
+        self._slots.release()
+        with self._lock:
+            self._running -= 1
+            self._idle.notify_all()
+
+    # Wait for the queued analyses to finish, keeping the workers for the next subjects
+    def drain(self):
+        with self._lock:
+            while self._running > 0:
+                self._idle.wait()
+
+    # Wait for all the queued analyses to finish and stop the workers
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+        print(f"Analysis completed for {self.completed} subjects, {len(self.failed)} failed")
+        return self.failed
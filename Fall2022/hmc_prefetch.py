@@ -0,0 +1,147 @@
+'''
+    Prefetch of the inputs of the next subjects to a local scratch folder while the
+    motion correction of the current subjects is running. A background thread
+    copies the moving image, reference and mask of the subjects in the order their
+    jobs will start, optionally decompressing the .nii.gz files on the way so that
+    neither ANTs nor the analysis pay for the gunzip.
+
+    At most `depth` subjects are staged ahead of the jobs already started, and the
+    staged files of all the subjects never exceed the scratch budget. The files of a
+    subject are deleted once its analysis is done, or as soon as its motion correction
+    failed. A subject that cannot be staged is processed from its original files.
+'''
+
+import gzip, os, shutil, tempfile, threading
+
+PREFETCHED_FILES = ('moving', 'reference', 'mask')
+COPY_BUFFER_SIZE = 4 * 1024 * 1024
+
+# Size of a file once staged, from the NIfTI header for the files decompressed on the way
+def stagedSize(path : str, decompress : bool):
+    if decompress and path.endswith('.nii.gz'):
+        import nibabel as nb
+        header = nb.load(path).header
+        voxels = 1
+        for size in header.get_data_shape():
+            voxels *= int(size)
+        return int(header.get_data_offset()) + voxels * header.get_data_dtype().itemsize
+    return os.path.getsize(path)
+
+def stageFile(path : str, folder : str, decompress : bool):
+    if decompress and path.endswith('.nii.gz'):
+        staged = os.path.join(folder, os.path.basename(path)[:-len('.gz')])
+        with gzip.open(path, 'rb') as source_fp, open(staged, 'wb') as staged_fp:
+            shutil.copyfileobj(source_fp, staged_fp, COPY_BUFFER_SIZE)
+    else:
+        staged = os.path.join(folder, os.path.basename(path))
+        shutil.copyfile(path, staged)
+    return staged
+
+class Prefetcher:
+
+    def __init__(self, scratch : str, depth : int, budget_bytes : int, decompress : bool = False):
+        os.makedirs(scratch, exist_ok=True)
+        self.folder = tempfile.mkdtemp(prefix='hmc_prefetch_', dir=scratch)
+        self.depth = max(1, depth)
+        self.budget_bytes = budget_bytes
+        self.decompress = decompress
+        self._condition = threading.Condition()
+        self._staged = {}     # Output folder -> staged paths, None when staging failed
+        self._sizes = {}
+        self._waiting = 0     # Subjects staged whose job has not started yet
+        self._in_use = 0
+        self._closed = False
+        self._prefetched = set()
+        self._thread = None
+
+    # Start staging the subjects in the order their jobs will start
+    def start(self, subjects):
+        self._prefetched = set(subject["output"] for subject in subjects)
+        print(f"Prefetching up to {self.depth} subjects ahead to {self.folder} "
+              f"({self.budget_bytes / 1024 ** 3:.2f} GB of scratch{', decompressed' if self.decompress else ''})")
+        self._thread = threading.Thread(target=self._stageAll, args=(list(subjects), ), daemon=True)
+        self._thread.start()
+
+    def _stageAll(self, subjects):
+        for index, subject in enumerate(subjects):
+            try:
+                paths = {name : subject[name] for name in PREFETCHED_FILES}
+                size = sum(stagedSize(path, self.decompress) for path in paths.values())
+            except Exception as error:
+                print(f"[ WARNING ] - Failed to read the inputs of {subject['output']} for the prefetch: {error}")
+                self._publish(subject["output"], None, 0)
+                continue
+            if size > self.budget_bytes:
+                print(f"[ WARNING ] - Inputs of {subject['output']} larger than the scratch budget, reading them in place")
+                self._publish(subject["output"], None, 0)
+                continue
+            with self._condition:
+                self._condition.wait_for(lambda: self._closed or (self._waiting < self.depth and self._in_use + size <= self.budget_bytes))
+                if self._closed:
+                    return
+                self._in_use += size
+            folder = os.path.join(self.folder, f"{index:05d}")
+            try:
+                os.makedirs(folder)
+                staged = {name : stageFile(path, folder, self.decompress) for name, path in paths.items()}
+            except Exception as error:
+                print(f"[ WARNING ] - Failed to prefetch the inputs of {subject['output']}, reading them in place: {error}")
+                shutil.rmtree(folder, ignore_errors=True)
+                with self._condition:
+                    self._in_use -= size
+                self._publish(subject["output"], None, 0)
+                continue
+            staged["folder"] = folder
+            self._publish(subject["output"], staged, size)
+
+    def _publish(self, output : str, staged, size : int):
+        with self._condition:
+            self._staged[output] = staged
+            self._sizes[output] = size
+            if staged is not None:
+                self._waiting += 1
+            self._condition.notify_all()
+
+    # Subject dictionary pointing at the staged inputs, called when its job starts. Waits for the
+    # inputs to be staged, subjects that are not prefetched keep their original inputs.
+    def stagedSubject(self, subject):
+        if subject["output"] not in self._prefetched:
+            return subject
+        with self._condition:
+            self._condition.wait_for(lambda: self._closed or subject["output"] in self._staged)
+            staged = self._staged.get(subject["output"])
+            if staged is None:
+                return subject
+            if not staged.get("started"):
+                staged["started"] = True
+                self._waiting -= 1
+                self._condition.notify_all()
+        return dict(subject, **{name : staged[name] for name in PREFETCHED_FILES})
+
+    # Staged path of one of the inputs of a subject, or its original path
+    def path(self, subject, name : str):
+        with self._condition:
+            staged = self._staged.get(subject["output"])
+        return staged[name] if staged is not None else subject[name]
+
+    # Delete the staged inputs of a subject once they are no longer needed
+    def release(self, output : str):
+        with self._condition:
+            staged = self._staged.get(output)
+            if staged is None:
+                return
+            self._staged[output] = None
+            if not staged.get("started"):
+                self._waiting -= 1
+        shutil.rmtree(staged["folder"], ignore_errors=True)
+        with self._condition:
+            self._in_use -= self._sizes.pop(output, 0)
+            self._condition.notify_all()
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+        shutil.rmtree(self.folder, ignore_errors=True)
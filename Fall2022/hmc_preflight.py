@@ -0,0 +1,109 @@
+'''
+    Pre-flight validation of the inputs of the subjects, executed before any motion
+    correction is scheduled. Only the NIfTI headers and the JSON sidecars are read,
+    in parallel threads since the time is spent waiting on the filesystem, so the
+    whole dataset is validated in seconds instead of discovering a mismatched mask
+    after the motion correction has run for an hour.
+
+    Errors make the subject fail the validation:
+     - unreadable NIfTI header or JSON sidecar
+     - moving image that is not 4D, reference or mask that is not 3D
+     - reference or mask grid (dimensions and affine) different from the moving image
+     - missing or non numeric EchoTime, subject number not in the scan info name
+    Warnings are reported without excluding the subject:
+     - space or time unit of the moving image that is not set in xyzt_units
+'''
+
+import csv, json, os
+from concurrent.futures import ThreadPoolExecutor
+
+PREFLIGHT_FILENAME = "preflight_report.csv"
+PREFLIGHT_THREADS = 16
+AFFINE_TOLERANCE = 1e-3
+FIELDNAMES = ['Output', 'Status', 'Problems']
+
+def loadHeader(path : str, problems):
+    import nibabel as nb
+    try:
+        return nb.load(path).header
+    except Exception as error:
+        problems.append(("error", f"unreadable header of {os.path.basename(path)} ({error})"))
+        return None
+
+def checkGrid(name : str, header, moving_header, problems):
+    import numpy as np
+    if header is None or moving_header is None:
+        return
+    shape = header.get_data_shape()
+    if len(shape) != 3 and not (len(shape) == 4 and shape[3] == 1):
+        problems.append(("error", f"{name} is not a 3D image (dimensions {shape})"))
+    if tuple(shape[:3]) != tuple(moving_header.get_data_shape()[:3]):
+        problems.append(("error", f"{name} dimensions {tuple(shape[:3])} differ from the moving image {tuple(moving_header.get_data_shape()[:3])}"))
+    elif not np.allclose(header.get_best_affine(), moving_header.get_best_affine(), atol=AFFINE_TOLERANCE):
+        problems.append(("error", f"{name} affine differs from the moving image"))
+
+def checkScanInfo(scan_info : str, problems):
+    try:
+        with open(scan_info, 'r') as scan_info_fp:
+            echo_time = json.load(scan_info_fp).get('EchoTime')
+    except (OSError, ValueError) as error:
+        problems.append(("error", f"unreadable scan info {os.path.basename(scan_info)} ({error})"))
+        return
+    if echo_time is None:
+        problems.append(("error", "EchoTime missing from the scan info"))
+    elif isinstance(echo_time, bool) or not isinstance(echo_time, (int, float)):
+        problems.append(("error", f"EchoTime {echo_time!r} is not a number"))
+    # The analysis takes the subject number from the name of the scan info file
+    if not os.path.basename(scan_info)[4:7].isdigit():
+        problems.append(("error", f"no subject number in the scan info name {os.path.basename(scan_info)}"))
+
+# List of (severity, description) problems found in the inputs of a subject
+def validateSubject(subject):
+    problems = []
+    moving_header = loadHeader(subject["moving"], problems)
+    if moving_header is not None:
+        shape = moving_header.get_data_shape()
+        if len(shape) != 4 or shape[3] < 2:
+            problems.append(("error", f"moving image is not a 4D timeseries (dimensions {shape})"))
+        space_unit, time_unit = moving_header.get_xyzt_units()
+        if space_unit not in ('meter', 'mm', 'micron'):
+            problems.append(("warning", "space unit of the moving image is unknown, millimeters are assumed"))
+        if time_unit not in ('sec', 'msec', 'usec'):
+            problems.append(("warning", "time unit of the moving image is unknown, seconds are assumed"))
+    checkGrid("reference", loadHeader(subject["reference"], problems), moving_header, problems)
+    checkGrid("mask", loadHeader(subject["mask"], problems), moving_header, problems)
+    checkScanInfo(subject["scan_info"], problems)
+    return problems
+
+def writeReport(report_path : str, subjects, results):
+    os.makedirs(os.path.dirname(os.path.abspath(report_path)), exist_ok=True)
+    with open(report_path, 'w') as report_fp:
+        report_w = csv.writer(report_fp, delimiter=',', quotechar='"')
+        report_w.writerow(FIELDNAMES)
+        for subject, problems in zip(subjects, results):
+            status = 'error' if any(severity == "error" for severity, _ in problems) else ('warning' if problems else 'ok')
+            report_w.writerow([subject["output"], status, '; '.join(description for _, description in problems)])
+
+# Validate the subjects in parallel, report the problems found and return the subjects without errors
+def preflight(subjects, report_path = None, threads : int = PREFLIGHT_THREADS):
+    if len(subjects) == 0:
+        return subjects
+    import nibabel, numpy # Loaded once before the threads import them
+    with ThreadPoolExecutor(max_workers=max(1, min(threads, len(subjects)))) as executor:
+        results = list(executor.map(validateSubject, subjects))
+    valid = []
+    warnings = 0
+    for subject, problems in zip(subjects, results):
+        errors = [description for severity, description in problems if severity == "error"]
+        if len(errors) == 0:
+            valid.append(subject)
+        if len(problems) != 0:
+            warnings += len(errors) == 0
+            print(f"[ WARNING ] - Pre-flight of {subject['output']} {'failed' if len(errors) != 0 else 'has warnings'}:")
+            for severity, description in problems:
+                print(f"    {severity} : {description}")
+    if report_path is not None:
+        writeReport(report_path, subjects, results)
+    print(f"Pre-flight validation: {len(valid)} of {len(subjects)} subjects valid, {len(subjects) - len(valid)} failed, {warnings} with warnings"
+          + (f", report in {report_path}" if report_path is not None else ''))
+    return valid
@@ -0,0 +1,213 @@
+'''
+    Work queue shared through the filesystem by any number of HMC workers, on any
+    number of nodes mounting the output folder. The queue is a folder holding one
+    JSON file per subject in each of the following states:
+     - subjects : every subject ever added, named after its output folder and
+                  created exclusively so that a subject is only queued once, whichever
+                  worker finds it first and whenever it starts
+     - pending  : subjects waiting for a worker, the name of each file starting with
+                  the inverted size of its scan so that the longest scans sort first
+     - claimed  : subjects being processed, named after the worker holding the lease
+     - done     : subjects processed successfully
+     - failed   : subjects that failed on every attempt
+
+    Every transition is a rename, which is atomic on POSIX and NFS filesystems, so
+    that exactly one worker wins each subject. A worker keeps its lease alive by
+    touching its claim file. The claim of a worker that stopped touching it for
+    longer than the lease duration is taken back and the subject is queued again,
+    or marked failed after too many attempts. Lease ages are measured with the
+    clock of the filesystem, not of the node, so that clock skew between nodes
+    does not expire leases early.
+'''
+
+import json, os, random, socket, threading, time
+
+QUEUE_FOLDER = ".hmc_queue"
+STATES = ('subjects', 'pending', 'claimed', 'done', 'failed')
+CLAIM_SEPARATOR = '@'
+ORDER_DIGITS = 15
+ORDER_LIMIT = 10 ** ORDER_DIGITS - 1
+
+def workerId():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+# Key of a subject in the queue, its output folder relative to the output root. It does not depend on the
+# other subjects, so that every worker gives the same key to a subject.
+def subjectKey(subject, output_root : str):
+    relative = os.path.relpath(os.path.abspath(subject["output"]), output_root)
+    return relative.strip(os.sep).replace(os.sep, '_') or os.path.basename(output_root)
+
+# Name of the pending file of a queue entry, prefixed so that the largest scans are claimed first
+def pendingName(entry):
+    return f"{max(0, ORDER_LIMIT - entry.get('size', 0)):0{ORDER_DIGITS}d}-{entry['key']}.json"
+
+def pendingKey(name : str):
+    return name[ORDER_DIGITS + 1:-len('.json')]
+
+def writeJson(path : str, content):
+    tmp_path = f"{path}.{workerId()}.tmp"
+    with open(tmp_path, 'w') as tmp_fp:
+        json.dump(content, tmp_fp, indent=2)
+    os.replace(tmp_path, path)
+
+def readJson(path : str):
+    with open(path, 'r') as json_fp:
+        return json.load(json_fp)
+
+class WorkQueue:
+
+    def __init__(self, output_folder : str, lease_seconds : float = 600, max_attempts : int = 3):
+        self.folder = os.path.join(output_folder, QUEUE_FOLDER)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max(1, max_attempts)
+        self.worker = workerId()
+        for state in STATES:
+            os.makedirs(os.path.join(self.folder, state), exist_ok=True)
+
+    def _path(self, state : str, name : str):
+        return os.path.join(self.folder, state, name)
+
+    def _entries(self, state : str):
+        return sorted(name for name in os.listdir(os.path.join(self.folder, state)) if name.endswith('.json'))
+
+    # Current time of the filesystem holding the queue, so that all the workers share the same clock
+    def now(self):
+        probe = self._path('claimed', f".clock{CLAIM_SEPARATOR}{self.worker}")
+        with open(probe, 'w'):
+            pass
+        try:
+            return os.stat(probe).st_mtime
+        finally:
+            os.remove(probe)
+
+    # Add the subjects that were never queued, returns the number of subjects added. sizes gives the size of
+    # the scan of each output folder, the pending subjects being claimed largest first.
+    def enqueue(self, subjects, output_root : str, sizes=None):
+        added = 0
+        for subject in subjects:
+            key = subjectKey(subject, output_root)
+            size = sizes.get(subject["output"], 0) if sizes is not None else 0
+            entry = {"key" : key, "subject" : subject, "size" : size, "attempts" : 0}
+            try:
+                fd = os.open(self._path('subjects', f"{key}.json"), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                continue
+            with os.fdopen(fd, 'w') as subject_fp:
+                json.dump(entry, subject_fp, indent=2)
+            writeJson(self._path('pending', pendingName(entry)), entry)
+            added += 1
+        return added
+
+    # Claim the first pending subject. Returns a Lease, or None when nothing is pending.
+    def claim(self):
+        self.reclaimExpired()
+        for name in self._entries('pending'):
+            key = pendingKey(name)
+            claim_path = self._path('claimed', f"{key}{CLAIM_SEPARATOR}{self.worker}.json")
+            try:
+                # Renaming keeps the modification time, refresh it so that the new claim is not seen as expired
+                os.utime(self._path('pending', name))
+                os.rename(self._path('pending', name), claim_path)
+            except FileNotFoundError:
+                continue # Claimed by another worker
+            entry = readJson(claim_path)
+            entry["attempts"] += 1
+            entry["worker"] = self.worker
+            with open(claim_path, 'w') as claim_fp:
+                json.dump(entry, claim_fp, indent=2)
+            return Lease(self, claim_path, entry)
+        return None
+
+    # Queue again the subjects whose worker stopped renewing its lease
+    def reclaimExpired(self):
+        now = self.now()
+        for name in self._entries('claimed'):
+            claim_path = self._path('claimed', name)
+            try:
+                if now - os.stat(claim_path).st_mtime < self.lease_seconds:
+                    continue
+                # Move the claim out of the way first, so that the worker holding it notices it lost its lease
+                expired_path = f"{claim_path}.expired{CLAIM_SEPARATOR}{self.worker}"
+                os.rename(claim_path, expired_path)
+            except FileNotFoundError:
+                continue
+            entry = readJson(expired_path)
+            state = 'pending' if entry["attempts"] < self.max_attempts else 'failed'
+            print(f"[ WARNING ] - Lease of {entry.get('worker')} on {entry['key']} expired, moving the subject to {state}")
+            writeJson(self._path(state, pendingName(entry) if state == 'pending' else f"{entry['key']}.json"), entry)
+            os.remove(expired_path)
+
+    def counts(self):
+        return {state : len(self._entries(state)) for state in STATES[1:]}
+
+    def finished(self):
+        counts = self.counts()
+        return counts["pending"] == 0 and counts["claimed"] == 0
+
+class Lease:
+
+    def __init__(self, queue : WorkQueue, claim_path : str, entry):
+        self.queue = queue
+        self.claim_path = claim_path
+        self.entry = entry
+        self.subject = entry["subject"]
+        self.lost = False
+        self._stop = threading.Event()
+        self._heartbeat = threading.Thread(target=self._renew, daemon=True)
+        self._heartbeat.start()
+
+    def _renew(self):
+        while not self._stop.wait(self.queue.lease_seconds / 4):
+            try:
+                os.utime(self.claim_path)
+            except FileNotFoundError:
+                print(f"[ WARNING ] - Lease on {self.entry['key']} was taken back by another worker")
+                self.lost = True
+                return
+
+    # Release the lease, moving the subject to done, or back to pending until it ran out of attempts. The claim
+    # itself is renamed to its new state, so that a claim taken back by another worker is never released twice.
+    def finish(self, success : bool, error : str = None):
+        self._stop.set()
+        self._heartbeat.join()
+        if self.lost:
+            return
+        if success:
+            state = 'done'
+        else:
+            state = 'pending' if self.entry["attempts"] < self.queue.max_attempts else 'failed'
+        target = self.queue._path(state, pendingName(self.entry) if state == 'pending' else f"{self.entry['key']}.json")
+        try:
+            os.rename(self.claim_path, target)
+        except FileNotFoundError:
+            print(f"[ WARNING ] - Lease on {self.entry['key']} was taken back by another worker, leaving the subject to it")
+            self.lost = True
+            return
+        # A pending subject may already be claimed again, only the final states are completed
+        if state != 'pending':
+            self.entry["finished"] = time.time()
+            if error is not None:
+                self.entry["error"] = error
+            writeJson(target, self.entry)
+
+# Claim subjects until the queue is drained. process(subject) returns True on success.
+# Workers keep polling while other workers hold leases since an expired lease puts its subject back in the queue.
+def runWorker(queue : WorkQueue, process, poll_seconds : float = 10):
+    processed = 0
+    while True:
+        lease = queue.claim()
+        if lease is None:
+            if queue.finished():
+                break
+            time.sleep(poll_seconds * (0.5 + random.random()))
+            continue
+        print(f"Worker {queue.worker} claimed {lease.entry['key']} (attempt {lease.entry['attempts']}/{queue.max_attempts})")
+        try:
+            lease.finish(process(lease.subject))
+        except Exception as error:
+            print(f"[ WARNING ] - Processing of {lease.entry['key']} failed: {error!r}")
+            lease.finish(False, repr(error))
+        processed += 1
+    counts = queue.counts()
+    print(f"Worker {queue.worker} processed {processed} subjects, queue: {counts['done']} done, {counts['failed']} failed")
+    return processed
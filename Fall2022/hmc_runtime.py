@@ -0,0 +1,126 @@
+'''
+    Runtime prediction of the ANTs motion correction. The model is learned from
+    the execution_time.txt files written by antsMotCor.sh in previous output
+    folders, paired with the size of the scan (voxels x frames) and the ANTs
+    parameter set that was used. The predictions are used to launch the longest
+    subjects first, to pack batch jobs and to estimate the wall-clock time and
+    CPU-hours of a run before it starts.
+'''
+
+import glob, heapq, json, os
+
+JOB_INFO_FILENAME = "job_info.json"
+EXECUTION_TIME_FILENAME = "execution_time.txt"
+PARAMETER_SETS = ('old', 'new', 'performance')
+
+# Parameter set selected by antsMotCor.sh for the given options
+def parameterSet(latest_ants : bool, containerized : bool, performance : bool):
+    if containerized or not latest_ants:
+        return 'old'
+    return 'performance' if performance else 'new'
+
+def scanSize(moving : str):
+    import nibabel as nb
+    shape = nb.load(moving).shape
+    frames = shape[3] if len(shape) > 3 else 1
+    return int(shape[0] * shape[1] * shape[2]), int(frames)
+
+# Describe the motion correction of a subject in its output folder so that its runtime can be learned from later
+def recordJobInfo(subject, parameter_set : str):
+    voxels, frames = scanSize(subject["moving"])
+    info = {"moving" : subject["moving"], "voxels" : voxels, "frames" : frames, "parameter_set" : parameter_set}
+    with open(os.path.join(subject["output"], JOB_INFO_FILENAME), 'w') as info_fp:
+        json.dump(info, info_fp, indent=2)
+    return info
+
+# Job information of older outputs is recovered from info.txt and new_ants.txt
+def loadJobInfo(output : str):
+    info_path = os.path.join(output, JOB_INFO_FILENAME)
+    if os.path.exists(info_path):
+        with open(info_path, 'r') as info_fp:
+            return json.load(info_fp)
+    legacy_path = os.path.join(output, "info.txt")
+    if not os.path.exists(legacy_path):
+        return None
+    with open(legacy_path, 'r') as legacy_fp:
+        moving = [line.split('=', 1)[1].strip() for line in legacy_fp if line.startswith('- Moving =')]
+    if len(moving) == 0 or not os.path.exists(moving[0]):
+        return None
+    voxels, frames = scanSize(moving[0])
+    parameter_set = 'new' if os.path.exists(os.path.join(output, "new_ants.txt")) else 'old'
+    return {"moving" : moving[0], "voxels" : voxels, "frames" : frames, "parameter_set" : parameter_set}
+
+def loadHistory(folders):
+    samples = []
+    for folder in folders:
+        for execution_time in glob.glob(os.path.join(folder, "**", EXECUTION_TIME_FILENAME), recursive=True):
+            info = loadJobInfo(os.path.dirname(execution_time))
+            if info is None:
+                continue
+            with open(execution_time, 'r') as execution_time_fp:
+                seconds = float(execution_time_fp.read().split()[0])
+            samples.append((info["parameter_set"], info["voxels"] * info["frames"], seconds))
+    return samples
+
+# Fit seconds = a * voxels * frames + b, or a pure rate when the samples do not constrain the intercept
+def fitRuntime(work, seconds):
+    import numpy as np
+    work = np.asarray(work, dtype=np.float64)
+    seconds = np.asarray(seconds, dtype=np.float64)
+    if len(np.unique(work)) >= 2:
+        A = np.vstack([work, np.ones(len(work))]).T
+        a, b = np.linalg.lstsq(A, seconds, rcond=None)[0]
+        if a > 0 and b >= 0:
+            return float(a), float(b)
+    return float(np.sum(seconds) / np.sum(work)), 0.0
+
+class RuntimeModel:
+
+    def __init__(self, samples):
+        self.samples = samples
+        self.coefficients = {}
+        for parameter_set in PARAMETER_SETS:
+            subset = [(work, seconds) for name, work, seconds in samples if name == parameter_set]
+            if len(subset) != 0:
+                self.coefficients[parameter_set] = fitRuntime(*zip(*subset))
+        self.fallback = fitRuntime(*zip(*[(work, seconds) for name, work, seconds in samples])) if len(samples) != 0 else None
+
+    @classmethod
+    def fromHistory(cls, folders):
+        return cls(loadHistory(folders))
+
+    def available(self):
+        return self.fallback is not None
+
+    # Predicted runtime in seconds, None when nothing was learned yet
+    def predict(self, info):
+        a, b = self.coefficients.get(info["parameter_set"], (None, None))
+        if a is None:
+            if self.fallback is None:
+                return None
+            a, b = self.fallback
+        return a * info["voxels"] * info["frames"] + b
+
+def formatDuration(seconds : float):
+    minutes = int(round(seconds / 60))
+    return f"{minutes // 60} h {minutes % 60:02d} min"
+
+# Wall-clock time of running the jobs longest first on the given number of slots
+def estimateMakespan(runtimes, slots : int):
+    finish = [0.0] * max(1, slots)
+    for runtime in sorted(runtimes, reverse=True):
+        heapq.heappush(finish, heapq.heappop(finish) + runtime)
+    return max(finish)
+
+# Group the subjects, longest first, into packs running for about the target duration
+def packByRuntime(subjects, runtimes, target : float):
+    packs = []
+    for subject, runtime in sorted(zip(subjects, runtimes), key=lambda item: -item[1]):
+        for pack in packs:
+            if pack["seconds"] + runtime <= target:
+                pack["subjects"].append(subject)
+                pack["seconds"] += runtime
+                break
+        else:
+            packs.append({"subjects" : [subject], "seconds" : runtime})
+    return [pack["subjects"] for pack in packs]
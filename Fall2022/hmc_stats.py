@@ -0,0 +1,65 @@
+'''
+    Temporal statistics of 4D timeseries computed out of core. Instead of loading
+    the whole timeseries, and a float copy of it, to take its STD along time, the
+    frames are read in blocks through the array proxy of nibabel and the mean and
+    variance of every voxel are accumulated in float64. The moments of each block
+    are merged with the running ones by the update of Chan et al.:
+
+        n = n_a + n_b        delta = mean_b - mean_a
+        mean = mean_a + delta n_b / n
+        M2 = M2_a + M2_b + delta^2 n_a n_b / n
+
+    so the peak memory is a few blocks whatever the number of frames. The arrays are
+    returned in the (z, y, x) order of SimpleITK, and the geometry of the image is
+    read from its header alone with ReadImageInformation.
+'''
+
+BLOCK_BYTES = 64 * 1024 ** 2
+
+# Running count, mean and sum of squared deviations of each voxel, merged with the moments of the block.
+# The block is overwritten by its squared deviations, to hold no other copy of it.
+def mergeMoments(count : int, mean, m2, block):
+    block_count = block.shape[-1]
+    block_mean = block.mean(axis=-1)
+    block -= block_mean[..., None]
+    block **= 2
+    block_m2 = block.sum(axis=-1)
+    if count == 0:
+        return block_count, block_mean, block_m2
+    total = count + block_count
+    delta = block_mean - mean
+    mean = mean + delta * (block_count / total)
+    m2 = m2 + block_m2 + delta ** 2 * (count * block_count / total)
+    return total, mean, m2
+
+# Number of frames, temporal mean and population variance of each voxel, as float64 (x, y, z) arrays
+def temporalMoments(path : str, block_bytes : int = BLOCK_BYTES):
+    import nibabel as nb
+    import numpy as np
+    # The file stays open between the blocks, so that a gzipped file is decompressed in a single pass
+    image = nb.load(path, keep_file_open=True)
+    shape = image.shape
+    if len(shape) == 3:
+        data = np.asanyarray(image.dataobj).astype(np.float64)
+        return 1, data, np.zeros(shape)
+    frames = shape[3]
+    frames_per_block = max(1, block_bytes // (int(np.prod(shape[:3])) * 8))
+    count, mean, m2 = 0, None, None
+    for start in range(0, frames, frames_per_block):
+        block = np.asarray(image.dataobj[..., start:min(frames, start + frames_per_block)], dtype=np.float64)
+        count, mean, m2 = mergeMoments(count, mean, m2, block.reshape(shape[:3] + (-1, )))
+    return count, mean, m2 / count
+
+# Temporal STD of each voxel in the (z, y, x) order of SimpleITK, as float32 like the images read by the analysis
+def temporalStd(path : str, block_bytes : int = BLOCK_BYTES):
+    import numpy as np
+    _, _, variance = temporalMoments(path, block_bytes)
+    return np.sqrt(variance).T.astype(np.float32)
+
+# SimpleITK reader holding the dimension, spacing, origin and direction of an image, without its voxels
+def imageInformation(path : str):
+    import SimpleITK as sitk
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(path)
+    reader.ReadImageInformation()
+    return reader
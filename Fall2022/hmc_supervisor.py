@@ -0,0 +1,179 @@
+'''
+    Asyncio based supervisor of the motion correction subprocesses. The output
+    of each job is read line by line as it is produced and written to a log file
+    in the subject output folder, optionally echoed to the console, while a
+    compact status view of the running jobs is printed periodically. The event
+    loop sleeps while the children are busy, so supervising dozens of concurrent
+    ANTs processes costs next to no CPU.
+
+    When a memory budget is given, a job is only started while the sum of the
+    memory estimates of the running jobs, including its own, stays under the
+    budget. The peak resident memory of each job is sampled while it runs.
+'''
+
+import asyncio, os, sys, time
+from concurrent.futures import ThreadPoolExecutor
+from hmc_memory import processTreeRss, recordMemoryUsage, GIGABYTE
+
+LOG_FILENAME = "hmc_log.txt"
+STREAM_LIMIT = 1024 * 1024
+STATUS_LINE_WIDTH = 100
+MEMORY_SAMPLE_INTERVAL = 1.0
+
+def jobName(job):
+    if "name" in job:
+        return job["name"]
+    return job["subject"]["output"]
+
+def jobLog(job):
+    if "log" in job:
+        return job["log"]
+    return os.path.join(job["subject"]["output"], LOG_FILENAME)
+
+class JobSupervisor:
+
+    def __init__(self, max_concurrent : int = 1, budget=None, echo : bool = False, status_interval : float = 30.0, memory_budget=None):
+        self.max_concurrent = max(1, max_concurrent)
+        self.budget = budget
+        self.memory_budget = memory_budget
+        self._memory_in_use = 0
+        self._memory_condition = None
+        self.echo = echo
+        self.status_interval = status_interval
+        self._running = {}
+        self._done = 0
+        self._failed = 0
+        self._total = 0
+
+    # Run all the jobs and return the exit code of each of them, in the order of the jobs.
+    # on_finished(job, returncode) is called as each job finishes, outside of the event loop thread
+    # so that a slow callback does not stall the supervision of the other jobs.
+    def run(self, jobs, on_finished=None):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        callbacks = ThreadPoolExecutor(max_workers=1)
+        try:
+            return loop.run_until_complete(self._runAll(jobs, on_finished, callbacks))
+        finally:
+            callbacks.shutdown(wait=True)
+            asyncio.set_event_loop(None)
+            loop.close()
+
+    async def _runAll(self, jobs, on_finished, callbacks):
+        self._total = len(jobs)
+        self._done = 0
+        self._failed = 0
+        semaphore = asyncio.Semaphore(self.max_concurrent)
+        self._memory_in_use = 0
+        self._memory_condition = asyncio.Condition()
+        tasks = [asyncio.ensure_future(self._memoryLoop())]
+        if not self.echo and self.status_interval > 0:
+            tasks.append(asyncio.ensure_future(self._statusLoop()))
+        try:
+            return await asyncio.gather(*[self._runJob(job, semaphore, on_finished, callbacks) for job in jobs])
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    # Jobs with a "prepare" callable get their command from it when they are about to start,
+    # outside of the event loop thread since it may wait for their inputs
+    async def _runJob(self, job, semaphore, on_finished, callbacks):
+        async with semaphore:
+            if "prepare" in job:
+                job["command"] = await asyncio.get_event_loop().run_in_executor(None, job["prepare"])
+            memory = await self._admit(job)
+            try:
+                returncode = await self._execute(job)
+            finally:
+                await self._releaseMemory(memory)
+        self._done += 1
+        if returncode != 0:
+            self._failed += 1
+        if not self.echo:
+            print(f"[{self._done}/{self._total}] Finished {jobName(job)} (exit code {returncode})")
+        if on_finished is not None:
+            await asyncio.get_event_loop().run_in_executor(callbacks, on_finished, job, returncode)
+        return returncode
+
+    # Wait until the memory estimate of the job fits in the budget. A job is always admitted
+    # when nothing else is running so that a job larger than the budget still runs.
+    async def _admit(self, job):
+        if self.memory_budget is None:
+            return 0
+        memory = job.get("memory") or 0
+        async with self._memory_condition:
+            if self._memory_in_use != 0 and self._memory_in_use + memory > self.memory_budget:
+                print(f"Waiting for memory to start {jobName(job)} ({memory / GIGABYTE:.1f} GB estimated, "
+                      f"{self._memory_in_use / GIGABYTE:.1f}/{self.memory_budget / GIGABYTE:.1f} GB in use)")
+            await self._memory_condition.wait_for(lambda: self._memory_in_use == 0 or 
+                                                          self._memory_in_use + memory <= self.memory_budget)
+            self._memory_in_use += memory
+        return memory
+
+    async def _releaseMemory(self, memory):
+        if self.memory_budget is None:
+            return
+        async with self._memory_condition:
+            self._memory_in_use -= memory
+            self._memory_condition.notify_all()
+
+    async def _execute(self, job):
+        cores = None
+        env = None
+        preexec_fn = None
+        if self.budget is not None:
+            cores = self.budget.acquire()
+            env = self.budget.environment()
+            preexec_fn = self.budget.affinity(cores)
+            if "subject" in job:
+                self.budget.record(job["subject"]["output"], cores)
+        log_path = jobLog(job)
+        try:
+            process = await asyncio.create_subprocess_shell(job["command"], stdout=asyncio.subprocess.PIPE,
+                                                            stderr=asyncio.subprocess.STDOUT, env=env,
+                                                            preexec_fn=preexec_fn, limit=STREAM_LIMIT)
+            state = {"start" : time.time(), "last" : '', "pid" : process.pid, "peak_rss" : 0}
+            self._running[jobName(job)] = state
+            with (open(log_path, 'w', buffering=1) if log_path is not None else open(os.devnull, 'w')) as log_fp:
+                while True:
+                    line = await process.stdout.readline()
+                    if not line:
+                        break
+                    text = line.decode("utf-8", 'replace')
+                    log_fp.write(text)
+                    if self.echo:
+                        sys.stdout.write(text)
+                        sys.stdout.flush()
+                    elif text.strip() != '':
+                        state["last"] = text.strip()
+            returncode = await process.wait()
+            job["peak_rss"] = state["peak_rss"]
+            if "subject" in job and "header_estimate" in job["subject"]:
+                recordMemoryUsage(job["subject"]["output"], job["subject"]["header_estimate"], state["peak_rss"] or None)
+            return returncode
+        finally:
+            self._running.pop(jobName(job), None)
+            if self.budget is not None:
+                self.budget.release(cores)
+
+    # Sample the resident memory of the process tree of every running job
+    async def _memoryLoop(self):
+        while True:
+            await asyncio.sleep(MEMORY_SAMPLE_INTERVAL)
+            states = list(self._running.values())
+            totals = processTreeRss([state["pid"] for state in states])
+            for state in states:
+                state["peak_rss"] = max(state["peak_rss"], totals.get(state["pid"], 0))
+
+    async def _statusLoop(self):
+        while True:
+            await asyncio.sleep(self.status_interval)
+            now = time.time()
+            memory = ''
+            if self.memory_budget is not None:
+                memory = f" | {self._memory_in_use / GIGABYTE:.1f}/{self.memory_budget / GIGABYTE:.1f} GB reserved"
+            print(f"[ STATUS ] - {len(self._running)} running | {self._done}/{self._total} done | {self._failed} failed{memory}")
+            for name, state in sorted(self._running.items()):
+                line = f"   {name} ({int(now - state['start'])} s): {state['last']}"
+                print(line[:STATUS_LINE_WIDTH])
+            sys.stdout.flush()
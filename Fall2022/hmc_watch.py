@@ -0,0 +1,99 @@
+'''
+    Watch mode of HMC_isolated.py, processing the subjects of a dataset as they land
+    in its folder. The dataset is polled with the cached index of hmc_dataset.py, so
+    a poll only stats the folders of the dataset and reads the subjects whose folders
+    changed. A run is queued once all of its files are present and their size and
+    modification time did not change for the settle time, so that a subject still
+    being copied is not processed. Runs whose files change later are queued again.
+
+    The analysis of each subject processed successfully is added to the combined
+    results used by combined_analysis.py once its analysis_data.csv exists, which for
+    batch jobs may be several polls later, and updated whenever it is rewritten. The
+    subjects whose analysis was already up to date are added as well.
+'''
+
+import os, signal, time
+from hmc_dataset import indexDataset, completeRuns, defaultIndexCache
+from combined_analysis import updateCombinedParams
+
+def fileSignature(run):
+    signature = []
+    for name in ('moving', 'mask', 'scan_info', 'reference'):
+        stat = os.stat(run[name])
+        signature.append((stat.st_size, stat.st_mtime_ns))
+    return tuple(signature)
+
+class DatasetWatcher:
+
+    # make_subject(run) returns the subject dictionary of a run. process(subjects) processes the subjects
+    # and returns the output folders of the ones that failed.
+    def __init__(self, input_folder : str, output_folder : str, make_subject, process, settle_seconds : float, combined_output : str):
+        self.input_folder = input_folder
+        self.output_folder = output_folder
+        self.make_subject = make_subject
+        self.process = process
+        self.settle_seconds = settle_seconds
+        self.combined_output = combined_output
+        self._seen = {}        # Output folder -> (file signature, time it was first seen)
+        self._processed = {}   # Output folder -> file signature when it was queued
+        self._analysed = set() # Output folders processed successfully, whose analysis goes to the combined results
+        self._stop = False
+
+    # Subjects whose files are complete and unchanged for the settle time, and not processed with these files yet
+    def stableSubjects(self):
+        now = time.time()
+        stable = []
+        for run in completeRuns(indexDataset(self.input_folder, defaultIndexCache(self.output_folder))):
+            subject = self.make_subject(run)
+            try:
+                signature = fileSignature(run)
+            except OSError:
+                continue
+            if self._processed.get(subject["output"]) == signature:
+                continue
+            seen = self._seen.get(subject["output"])
+            if seen is None or seen[0] != signature:
+                self._seen[subject["output"]] = (signature, now)
+                if self.settle_seconds > 0:
+                    continue
+            elif now - seen[1] < self.settle_seconds:
+                continue
+            stable.append((subject, signature))
+        return stable
+
+    # Add the analyses of the processed subjects to the combined results, which only reads the ones that changed
+    def refreshCombined(self):
+        drift_files = [os.path.join(output, "analysis_data.csv") for output in sorted(self._analysed)]
+        drift_files = [drift_file for drift_file in drift_files if os.path.exists(drift_file)]
+        if len(drift_files) != 0:
+            updateCombinedParams(self.combined_output, drift_files)
+
+    def poll(self):
+        stable = self.stableSubjects()
+        if len(stable) != 0:
+            print(f"Processing {len(stable)} new or modified subjects")
+            failed = set(self.process([subject for subject, _ in stable]) or [])
+            for subject, signature in stable:
+                self._processed[subject["output"]] = signature
+                self._seen.pop(subject["output"], None)
+                if subject["output"] in failed:
+                    self._analysed.discard(subject["output"])
+                else:
+                    self._analysed.add(subject["output"])
+        self.refreshCombined()
+
+    def stop(self, *_):
+        print("Stopping the watch after the current poll")
+        self._stop = True
+
+    def run(self, interval : float):
+        signal.signal(signal.SIGTERM, self.stop)
+        print(f"Watching {self.input_folder} every {interval:.0f} s, subjects are processed once unchanged for {self.settle_seconds:.0f} s")
+        try:
+            while not self._stop:
+                self.poll()
+                deadline = time.time() + interval
+                while not self._stop and time.time() < deadline:
+                    time.sleep(min(1.0, interval))
+        except KeyboardInterrupt:
+            print("Watch interrupted")
@@ -1,4 +1,13 @@
 #!/bin/bash
-module load minc-toolkit-v2
-module load qbatch
-qbatch batch_cmds.sh
+# Submit a command file with qbatch. All the arguments are passed to qbatch and the
+# command file defaults to batch_cmds.sh. Set HMC_QBATCH to use another qbatch
+# compatible submitter, for example "python3 ./local_qbatch.py" to run locally.
+if [ $# == 0 ]; then
+    set -- batch_cmds.sh
+fi
+if [ "$HMC_QBATCH" == "" ]; then
+    module load minc-toolkit-v2
+    module load qbatch
+    HMC_QBATCH=qbatch
+fi
+$HMC_QBATCH "$@"
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+'''
+    Local stand-in for qbatch used to test the batch submission of HMC_isolated.py
+    on a single machine. It accepts the subset of the qbatch command line used by
+    launch_batch.sh and runs the submitted jobs in the background on the local node,
+    honouring the job dependencies given with --depend.
+
+    Use it by pointing launch_batch.sh to it:
+        HMC_QBATCH="python3 ./local_qbatch.py" ./run_hmc.sh ... -b
+
+    The state of the submitted jobs is kept in $LOCAL_QBATCH_DIR (a folder in the
+    temporary directory by default) and can be inspected with --status, while
+    --wait blocks until every submitted job has finished.
+'''
+
+import argparse, fcntl, fnmatch, glob, json, os, subprocess, sys, tempfile, time
+
+POLL_INTERVAL = 1.0
+FINISHED_STATES = ('done', 'failed')
+
+def stateFolder():
+    folder = os.environ.get("LOCAL_QBATCH_DIR", os.path.join(tempfile.gettempdir(), f"local_qbatch-{os.getuid()}"))
+    os.makedirs(folder, exist_ok=True)
+    return folder
+
+def parseArguments():
+    parser = argparse.ArgumentParser(description='Local stand-in for qbatch', formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('command_file', nargs='?', help="File with one command per line, - to read the commands from stdin")
+    parser.add_argument('-N', '--jobname', default='job', help='Name of the job')
+    parser.add_argument('--depend', action='append', default=[], help='Wait for the jobs whose name matches this pattern to finish')
+    parser.add_argument('--header', action='append', default=[], help='Line executed before the commands of the job')
+    parser.add_argument('--status', action='store_true', help='Print the state of the submitted jobs')
+    parser.add_argument('--wait', action='store_true', help='Wait for all the submitted jobs to finish')
+    parser.add_argument('--run_job', default=None, help=argparse.SUPPRESS)
+    # Other qbatch options (walltime, memory, cores...) have no meaning locally and are ignored
+    args, _ = parser.parse_known_args()
+    return args
+
+def loadJob(path):
+    with open(path, 'r') as job_fp:
+        return json.load(job_fp)
+
+def saveJob(path, job):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as job_fp:
+        json.dump(job, job_fp, indent=2)
+    os.replace(tmp_path, path)
+
+def allJobs(folder):
+    return [(loadJob(path), path) for path in sorted(glob.glob(os.path.join(folder, "*.json")))]
+
+def submit(folder, args):
+    if args.command_file == '-':
+        commands = sys.stdin.read().splitlines()
+    else:
+        with open(args.command_file, 'r') as commands_fp:
+            commands = commands_fp.read().splitlines()
+    commands = [command for command in commands if command.strip() != '']
+
+    # Dependencies are resolved against the jobs already submitted, as qbatch does
+    depends_on = []
+    for job, path in allJobs(folder):
+        if any(fnmatch.fnmatch(job["name"], pattern) for pattern in args.depend):
+            depends_on.append(path)
+
+    job_id = f"{time.time():.6f}-{os.getpid()}"
+    path = os.path.join(folder, f"{job_id}.json")
+    saveJob(path, {"id" : job_id, "name" : args.jobname, "state" : 'queued', "depends_on" : depends_on,
+                   "commands" : args.header + commands, "returncode" : None})
+    with open(os.path.join(folder, f"{job_id}.log"), 'w') as log_fp:
+        subprocess.Popen([sys.executable, os.path.abspath(__file__), '--run_job', path], stdout=log_fp,
+                         stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL, start_new_session=True)
+    print(f"Submitted job {job_id} ({args.jobname})")
+
+# Hold one of the local execution slots for the duration of the job
+def acquireSlot(folder):
+    slots = int(os.environ.get("LOCAL_QBATCH_SLOTS", os.cpu_count() or 1))
+    while True:
+        for slot in range(slots):
+            slot_fp = open(os.path.join(folder, f"slot{slot}.lock"), 'w')
+            try:
+                fcntl.flock(slot_fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return slot_fp
+            except OSError:
+                slot_fp.close()
+        time.sleep(POLL_INTERVAL)
+
+def runJob(folder, path):
+    job = loadJob(path)
+    while True:
+        states = [loadJob(dependency)["state"] for dependency in job["depends_on"]]
+        if all(state in FINISHED_STATES for state in states):
+            break
+        time.sleep(POLL_INTERVAL)
+
+    if 'failed' in states:
+        job["state"] = 'failed'
+        print(f"Job {job['name']} not executed since one of its dependencies failed")
+        saveJob(path, job)
+        return
+
+    slot_fp = acquireSlot(folder)
+    try:
+        job["state"] = 'running'
+        saveJob(path, job)
+        sys.stdout.flush()
+        returncode = subprocess.call('\n'.join(["set -e"] + job["commands"]), shell=True, executable='/bin/bash')
+    finally:
+        slot_fp.close()
+    job["returncode"] = returncode
+    job["state"] = 'done' if returncode == 0 else 'failed'
+    saveJob(path, job)
+
+def printStatus(folder):
+    for job, path in allJobs(folder):
+        print(f"{job['id']}  {job['state']:8s}  {job['name']}")
+
+def waitForJobs(folder):
+    while any(job["state"] not in FINISHED_STATES for job, path in allJobs(folder)):
+        time.sleep(POLL_INTERVAL)
+    failed = [job["name"] for job, path in allJobs(folder) if job["state"] == 'failed']
+    if len(failed) != 0:
+        print(f"Failed jobs: {', '.join(failed)}")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    args = parseArguments()
+    folder = stateFolder()
+    if args.run_job is not None:
+        runJob(folder, args.run_job)
+    elif args.status:
+        printStatus(folder)
+    elif args.wait:
+        sys.exit(waitForJobs(folder))
+    elif args.command_file is not None:
+        submit(folder, args)
+    else:
+        print("No command file provided")
+        sys.exit(1)
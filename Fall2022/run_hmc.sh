@@ -11,6 +11,11 @@ HELP=0
 SINGULARITY=0
 SUBFOLDER=""
 CONTAINER=""
+BACKEND=""
+JOBS=""
+EXECUTION=""
+BIND_ROOT=""
+WORKERS=0
 
 while [[ $# -gt 0 ]]; do
   case $1 in
@@ -51,6 +56,35 @@ while [[ $# -gt 0 ]]; do
       shift # past argument
       shift # past value
       ;;
+    --backend)
+      BACKEND="--backend $2"
+      shift # past argument
+      shift # past value
+      ;;
+    --bind_root)
+      BIND_ROOT="$2"
+      shift # past argument
+      shift # past value
+      ;;
+    --workers)
+      WORKERS="$2"
+      shift # past argument
+      shift # past value
+      ;;
+    -j|--jobs)
+      JOBS="-j $2"
+      shift # past argument
+      shift # past value
+      ;;
+    --cpus|--threads|--calibration_frames|--analysis_workers|--analysis_queue|--pack|--target_job_minutes|--runtime_history|--memory_budget|--lease_minutes|--max_attempts|--input_cache|--run|--prefetch|--scratch|--scratch_budget|--chunks|--crop_margin|--poll_seconds|--settle_seconds|--combined_output|--drift_estimator)
+      EXECUTION="$EXECUTION $1 $2"
+      shift # past argument
+      shift # past value
+      ;;
+    -a|--analysis_only|--pin|--calibrate|-w|--worker|-f|--force|--no_preflight|--preflight_only|--prefetch_decompress|--crop|--watch)
+      EXECUTION="$EXECUTION $1"
+      shift # past argument
+      ;;
     -h|--help)
       HELP=1
       shift # past argument
@@ -67,9 +101,16 @@ while [[ $# -gt 0 ]]; do
   esac
 done
 
+# Python modules made available inside the container
+HMC_MODULES="HMC_isolated.py hmc_backends.py hmc_budget.py hmc_supervisor.py hmc_pipeline.py hmc_runtime.py hmc_memory.py hmc_queue.py hmc_client.py hmc_daemon.py hmc_manifest.py hmc_input_cache.py hmc_dataset.py hmc_preflight.py hmc_prefetch.py hmc_chunked.py hmc_crop.py hmc_watch.py hmc_online.py hmc_loaders.py hmc_drift.py hmc_stats.py"
+MODULE_BINDS=""
+for module in $HMC_MODULES; do
+  MODULE_BINDS="$MODULE_BINDS --bind ./$module:/mnt/$module"
+done
+
 if [ $HELP == 1 ]; then
   if [ $SINGULARITY == 1 ]; then 
-      singularity exec --bind ./HMC_isolated.py:/mnt/HMC_isolated.py \
+      singularity exec $MODULE_BINDS \
                       $CONTAINER \
                       python3 /mnt/HMC_isolated.py -h
   else
@@ -87,13 +128,51 @@ if [ "$OUTPUT" == "" ]; then
     exit 1
 fi
 
-if [ $SINGULARITY == 1 ]; then 
-    singularity exec --bind ./HMC_isolated.py:/mnt/HMC_isolated.py \
-                    --bind ./antsMotCor.sh:/mnt/antsMotCor.sh \
-                    --bind $INPUT:/mnt/input \
-                    --bind $OUTPUT:/mnt/output \
-                    $CONTAINER \
-                    python3 /mnt/HMC_isolated.py /mnt/input /mnt/output $DATASET $LATEST_ANTS $PERFORMANCE $BATCH -c $SUBFOLDER
+# Inside the container, the input and output folders are either bound separately or
+# reached through a single bind of a folder holding both of them
+if [ $SINGULARITY == 1 ]; then
+    if [ "$BIND_ROOT" != "" ]; then
+        BIND_ROOT=$(cd "$BIND_ROOT" && pwd)
+        mkdir -p "$OUTPUT"
+        INPUT_PATH=$(cd "$INPUT" && pwd)
+        OUTPUT_PATH=$(cd "$OUTPUT" && pwd)
+        if [[ "$INPUT_PATH/" != "$BIND_ROOT/"* || "$OUTPUT_PATH/" != "$BIND_ROOT/"* ]]; then
+            echo "The input and output folders must be inside the bind root $BIND_ROOT"
+            exit 1
+        fi
+        DATA_BINDS="--bind $BIND_ROOT:/mnt/data"
+        INPUT_PATH="/mnt/data${INPUT_PATH#$BIND_ROOT}"
+        OUTPUT_PATH="/mnt/data${OUTPUT_PATH#$BIND_ROOT}"
+    else
+        DATA_BINDS="--bind $INPUT:/mnt/input --bind $OUTPUT:/mnt/output"
+        INPUT_PATH="/mnt/input"
+        OUTPUT_PATH="/mnt/output"
+    fi
+    HMC_COMMAND="singularity exec $MODULE_BINDS --bind ./antsMotCor.sh:/mnt/antsMotCor.sh $DATA_BINDS $CONTAINER \
+                 python3 /mnt/HMC_isolated.py $INPUT_PATH $OUTPUT_PATH $DATASET $LATEST_ANTS $PERFORMANCE $BATCH $BACKEND $JOBS $EXECUTION -c $SUBFOLDER"
 else
-    python3 ./HMC_isolated.py $INPUT $OUTPUT $DATASET $LATEST_ANTS $PERFORMANCE $BATCH $SUBFOLDER
+    HMC_COMMAND="python3 ./HMC_isolated.py $INPUT $OUTPUT $DATASET $LATEST_ANTS $PERFORMANCE $BATCH $BACKEND $JOBS $EXECUTION $SUBFOLDER"
 fi
+
+# Persistent workers pay the container and interpreter startup once and then process
+# subjects from the work queue of the output folder until it is empty
+if [ $WORKERS -gt 0 ]; then
+    HMC_COMMAND="$HMC_COMMAND --worker"
+    RUN_ID="hmcworker$$"
+    if [ "$BATCH" != "" ]; then
+        # The command of the workers is given to the submitter on its standard input, so no command file is left behind
+        for ((worker = 0; worker < WORKERS; worker++)); do
+            echo "cd $(pwd) && $HMC_COMMAND" | ./launch_batch.sh -N "${RUN_ID}_$worker" -
+        done
+    else
+        mkdir -p "$OUTPUT"
+        for ((worker = 0; worker < WORKERS; worker++)); do
+            $HMC_COMMAND > "$OUTPUT/${RUN_ID}_$worker.log" 2>&1 &
+        done
+        echo "Started $WORKERS workers, their output is stored in $OUTPUT/${RUN_ID}_<worker>.log"
+        wait
+    fi
+    exit 0
+fi
+
+$HMC_COMMAND